@@ -1,34 +1,46 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
 from aio_pika import IncomingMessage
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Header
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from common.mq_service import RabbitMQService
 from common.types import Message, OrderStatus, ServiceException
 from common.monitoring import monitor_message_processing
-import json
-from typing import Dict, Optional
+from common.tracing import tracer
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
 from datetime import datetime
+from urllib.parse import quote, urlsplit
 import uuid
 from pydantic import BaseModel
 import structlog
-from prometheus_client import Counter, make_asgi_app
-import logging
+from prometheus_client import Counter, Gauge, make_asgi_app
+from common.codec import JsonCodec
 from common.config import Config
+from common.log import configure_logging
 
 # Initialize FastAPI app
 app = FastAPI(title="Döner Order System")
 metrics_app = make_asgi_app()
 app.mount("/metrics", metrics_app)
 
-# Configure basic logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+configure_logging("api_service")
+logger = structlog.get_logger()
 
 # Metrics
 websocket_connections = Counter('websocket_connections_total', 'Number of WebSocket connections')
 websocket_disconnections = Counter('websocket_disconnections_total', 'Number of WebSocket disconnections')
+websocket_evictions = Counter('websocket_evictions_total', 'Slow WebSocket consumers disconnected', ['reason'])
+routed_orders = Gauge('routed_orders', 'Orders of other replicas bound to this replica for their subscribers')
+websocket_subscribers = Gauge('websocket_subscribers', 'Open WebSocket subscriptions')
+websocket_queue_depth = Gauge('websocket_send_queue_depth', 'Updates waiting in all WebSocket send queues')
+websocket_max_queue_depth = Gauge('websocket_send_queue_depth_max', 'Updates waiting in the fullest WebSocket send queue')
+replay_buffered_orders = Gauge('replay_buffered_orders', 'Orders with recent events kept for replay')
+replayed_events = Counter('replayed_events_total', 'Buffered events sent to subscribers on connect')
+status_view_orders = Gauge('status_view_orders', 'Orders in the status read model')
+status_view_evictions = Counter('status_view_evictions_total', 'Orders evicted from the status read model')
 
 # CORS configuration
 app.add_middleware(
@@ -43,41 +55,518 @@ app.add_middleware(
 class ApiServiceSettings:
     rabbitmq_url: str = Config.get_rabbitmq_url()
     service_name: str = "api_service"
-    update_queues: list[str] = ["order_supplied", "doener_supplied", "invoice_supplied"]
+    order_service_url: str = Config.ORDER_SERVICE_URL
 
 settings = ApiServiceSettings()
 
+# Replay buffer
+Event = Tuple[int, str]  # (sequence number, encoded update)
+
+
+class OrderEvents:
+    __slots__ = ("seq", "events", "expires_at")
+
+    def __init__(self, size: int):
+        self.seq = 0
+        self.events: Deque[Event] = deque(maxlen=size)
+        self.expires_at = 0.0
+
+
+class EventLog:
+    """Ring buffer of the most recent events of each order.
+
+    Subscribers connecting late get what they missed replayed, from the
+    start or after the last sequence number they saw. Memory stays bounded:
+    every order keeps at most `size` events, at most `max_orders` orders are
+    kept and an order's events are dropped `ttl` seconds after its last one.
+    """
+
+    def __init__(self, size: int = Config.REPLAY_BUFFER_SIZE, max_orders: int = Config.REPLAY_MAX_ORDERS,
+                 ttl: float = Config.REPLAY_TTL):
+        self.size = size
+        self.max_orders = max_orders
+        self.ttl = ttl
+        self.orders: "OrderedDict[str, OrderEvents]" = OrderedDict()  # least recently updated first
+        self.json_codec = JsonCodec()
+
+    def append(self, order_id: str, message: dict) -> Event:
+        now = time.monotonic()
+        order = self.orders.get(order_id)
+        if order is None:
+            order = self.orders[order_id] = OrderEvents(self.size)
+        else:
+            self.orders.move_to_end(order_id)
+        order.seq += 1
+        order.expires_at = now + self.ttl
+        event = (order.seq, self.json_codec.encode({**message, "seq": order.seq}).decode())
+        order.events.append(event)
+        self._expire(now)
+        return event
+
+    def since(self, order_id: str, after: Optional[int] = None) -> List[Event]:
+        """Buffered events of the order with a sequence number above `after`."""
+        order = self.orders.get(order_id)
+        if order is None or order.expires_at < time.monotonic():
+            return []
+        if after is None:
+            return list(order.events)
+        return [event for event in order.events if event[0] > after]
+
+    def _expire(self, now: float):
+        # every order shares the same ttl, so the least recently updated expire first
+        while self.orders and (len(self.orders) > self.max_orders
+                               or next(iter(self.orders.values())).expires_at < now):
+            self.orders.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+
+# Status read model
+# statuses only move forward, a late event of an earlier saga step is ignored.
+# FAILED is outside the order: it ends any order not invoiced yet and is
+# overridden by progress published after it, e.g. of a replayed dead letter.
+STATUS_RANK = {
+    OrderStatus.CREATED.value: 0,
+    OrderStatus.PROCESSING.value: 1,
+    OrderStatus.DOENER_ASSIGNED.value: 2,
+    OrderStatus.INVOICED.value: 3,
+}
+
+StatusEntry = Tuple[str, str, str, Optional[str], Optional[str]]  # (status, event, updated_at, shop_id, invoice_id)
+
+
+class OrderStatusView:
+    """Latest status of recent orders, folded from the events routed to this replica.
+
+    Covers the orders created on this replica and those a client of it
+    subscribed to, and lets clients look them up without a read on
+    order_service. Any other order, e.g. of a client reconnecting through
+    the load balancer, is looked up with `fetch` by lookup(). Entries
+    are small tuples. At most `max_orders` are kept and the least recently
+    updated order is evicted first. The view is written to `snapshot_path`
+    every `snapshot_interval` seconds and on shutdown, and loaded from it on
+    startup. Events published while the service was down are missed, and
+    events of orders in flight keep going to the replica key of the previous
+    process, so restored entries are revalidated by lookup() until an event
+    updates them or they are invoiced.
+    """
+
+    def __init__(self, max_orders: int = Config.STATUS_VIEW_SIZE, snapshot_path: str = Config.STATUS_SNAPSHOT_PATH,
+                 snapshot_interval: float = Config.STATUS_SNAPSHOT_INTERVAL,
+                 fetch: Optional[Callable[[str], Awaitable[Optional[Dict]]]] = None):
+        self.max_orders = max_orders
+        self.fetch = fetch  # order id -> the order as order_service stores it, None if unknown
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.orders: "OrderedDict[str, StatusEntry]" = OrderedDict()  # least recently updated first
+        self.restored: Set[str] = set()  # orders loaded from the snapshot and not updated since
+        self.json_codec = JsonCodec()
+        self.logger = structlog.get_logger()
+        self._snapshotter: Optional[asyncio.Task] = None
+
+    def apply(self, message: Message):
+        status = message.payload.get("status")
+        if status not in STATUS_RANK and status != OrderStatus.FAILED.value:
+            return
+        current = self.orders.get(message.order_id)
+        if current is not None and current[0] != status:
+            if status == OrderStatus.FAILED.value:
+                if current[0] == OrderStatus.INVOICED.value:
+                    return
+            elif current[0] == OrderStatus.FAILED.value:
+                if message.timestamp <= datetime.fromisoformat(current[2]):
+                    return
+            elif STATUS_RANK[current[0]] >= STATUS_RANK[status]:
+                return
+        _, _, _, shop_id, invoice_id = current or (None, None, None, None, None)
+        shop = message.payload.get("shop")
+        self.restored.discard(message.order_id)
+        self._put(message.order_id, (
+            status,
+            message.message_type,
+            message.timestamp.isoformat(),
+            shop["id"] if shop else shop_id,
+            message.payload.get("invoice_id", invoice_id),
+        ))
+
+    def _put(self, order_id: str, entry: StatusEntry):
+        self.orders[order_id] = entry
+        self.orders.move_to_end(order_id)
+        while len(self.orders) > self.max_orders:
+            evicted, _ = self.orders.popitem(last=False)
+            self.restored.discard(evicted)
+            status_view_evictions.inc()
+
+    def get(self, order_id: str) -> Optional[Dict]:
+        entry = self.orders.get(order_id)
+        if entry is None:
+            return None
+        status, event, updated_at, shop_id, invoice_id = entry
+        return {"order_id": order_id, "status": status, "last_event": event, "updated_at": updated_at,
+                "shop_id": shop_id, "invoice_id": invoice_id}
+
+    async def lookup(self, order_id: str) -> Optional[Dict]:
+        """Status of an order, asked from order_service when the view doesn't follow it or restored it.
+
+        Fetched orders aren't kept, their events are routed to another replica
+        and would never update them.
+        """
+        status = self.get(order_id)
+        if (status is not None and order_id not in self.restored) or self.fetch is None:
+            return status
+        order = await self.fetch(order_id)
+        return status if order is None else self.from_order(order)
+
+    @staticmethod
+    def from_order(order: Dict) -> Dict:
+        updates = order.get("updates") or ()
+        shop = order.get("doener_shop")
+        return {"order_id": order["order_id"], "status": order["status"], "last_event": None,
+                "updated_at": updates[-1]["timestamp"] if updates else order.get("created_at"),
+                "shop_id": shop["id"] if shop else None, "invoice_id": order.get("invoice_id")}
+
+    def load(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                rows = self.json_codec.decode(f.read())
+        except Exception as e:
+            self.logger.error("status_snapshot_unreadable", path=self.snapshot_path, error=str(e))
+            return
+        for order_id, *entry in rows:
+            self._put(order_id, tuple(entry))
+            if entry[0] != OrderStatus.INVOICED.value:
+                self.restored.add(order_id)
+        self.logger.info("status_snapshot_loaded", orders=len(self.orders))
+
+    async def save(self):
+        if not self.snapshot_path:
+            return
+        rows = [(order_id, *entry) for order_id, entry in self.orders.items()]
+
+        def write():
+            # write aside and rename, a crash never leaves a torn snapshot behind
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(self.json_codec.encode(rows))
+            os.replace(tmp_path, self.snapshot_path)
+
+        try:
+            await asyncio.to_thread(write)
+        except Exception as e:
+            self.logger.error("status_snapshot_failed", path=self.snapshot_path, error=str(e))
+
+    async def _snapshot_periodically(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
+
+    def start(self):
+        self.load()
+        if self.snapshot_path:
+            self._snapshotter = asyncio.create_task(self._snapshot_periodically())
+
+    async def close(self):
+        if self._snapshotter is not None:
+            self._snapshotter.cancel()
+        await self.save()
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+
+async def fetch_order(order_id: str) -> Optional[Dict]:
+    """GET /orders/{order_id} of order_service, None if it doesn't know the order."""
+    url = urlsplit(settings.order_service_url)
+
+    async def get() -> bytes:
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+        try:
+            writer.write(f"GET {url.path.rstrip('/')}/orders/{quote(order_id)} HTTP/1.1\r\n"
+                         f"Host: {url.netloc}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    head, _, body = (await asyncio.wait_for(get(), Config.ORDER_LOOKUP_TIMEOUT)).partition(b"\r\n\r\n")
+    status_code = int(head.split(None, 2)[1])
+    if status_code == 404:
+        return None
+    if status_code != 200:
+        raise ServiceException(message="Order lookup failed", details={"order_id": order_id, "status": status_code})
+    return status_view.json_codec.decode(body)
+
+
+status_view = OrderStatusView(fetch=fetch_order)
+
+
 # Connection Manager
+class Subscriber:
+    """One WebSocket or event stream with its own bounded send queue.
+
+    WebSockets are written by a writer task, event streams are consumed by
+    their response body and have no websocket. Coalescing subscribers skip
+    the queue: updates are merged into `state` and the writer sends what
+    changed since `sent_state`.
+    """
+
+    __slots__ = ("order_id", "websocket", "queue", "writer", "coalesce", "state", "sent_state", "seq", "dirty")
+
+    def __init__(self, order_id: str, websocket: Optional[WebSocket], max_queue: int, coalesce: bool = False):
+        self.order_id = order_id
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.writer: Optional[asyncio.Task] = None
+        self.coalesce = coalesce
+        self.state: Dict = {}
+        self.sent_state: Dict = {}
+        self.seq = 0
+        self.dirty = asyncio.Event()
+
+    def merge(self, seq: int, message: dict):
+        payload = {**(self.state.get("payload") or {}), **(message.get("payload") or {})}
+        self.state.update(message)
+        self.state["payload"] = payload
+        self.seq = seq
+        self.dirty.set()
+
+    def delta(self) -> Optional[dict]:
+        """Fields of the merged state the client hasn't seen, payload fields one level deep."""
+        changes = {key: value for key, value in self.state.items()
+                   if key != "payload" and self.sent_state.get(key) != value}
+        sent_payload = self.sent_state.get("payload") or {}
+        payload = {key: value for key, value in self.state["payload"].items() if sent_payload.get(key) != value}
+        if payload:
+            changes["payload"] = payload
+        if not changes:
+            return None
+        # merge() replaces the payload dict instead of mutating it, a shallow copy is enough
+        self.sent_state = dict(self.state)
+        changes["seq"] = self.seq
+        return changes
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
+    """Fans order updates out to every WebSocket subscribed to the order.
+
+    send_update only encodes the update once and enqueues it for each
+    subscriber; network writes happen in per-connection writer tasks, so a
+    slow client never holds up the consumer or other clients. A subscriber
+    whose queue is full or whose send takes longer than `send_timeout` is
+    disconnected. Every update is numbered and buffered in `events`, so it
+    can be replayed to subscribers that connect later.
+
+    Subscribers connecting with coalesce=True get at most one frame per
+    `coalesce_window`, holding only the fields that changed since their last
+    frame, e.g. the shop is sent once and not with every later update.
+    Clients rebuild the order by merging frames, payloads one level deep.
+    """
+
+    def __init__(self, max_queue: int = Config.WS_SEND_QUEUE_SIZE, send_timeout: float = Config.WS_SEND_TIMEOUT,
+                 coalesce_window: float = Config.WS_COALESCE_WINDOW):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.coalesce_window = coalesce_window
+        self.active_connections: Dict[str, Set[Subscriber]] = {}
         self.logger = structlog.get_logger()
-        
-    async def connect(self, order_id: str, websocket: WebSocket):
+        self.json_codec = JsonCodec()
+        self.events = EventLog()
+
+    async def connect(self, order_id: str, websocket: WebSocket, after: Optional[int] = None,
+                      coalesce: bool = False) -> Subscriber:
         await websocket.accept()
-        self.active_connections[order_id] = websocket
+        subscriber = self.subscribe(order_id, websocket, after, coalesce)
+        write = self._write_coalesced if coalesce else self._write
+        subscriber.writer = asyncio.create_task(write(subscriber))
         websocket_connections.inc()
-        self.logger.info("websocket_connected", order_id=order_id)
-        
-    def disconnect(self, order_id: str):
-        if order_id in self.active_connections:
-            del self.active_connections[order_id]
-            websocket_disconnections.inc()
-            self.logger.info("websocket_disconnected", order_id=order_id)
-            
-    async def send_update(self, order_id: str, message: dict):
-        if order_id in self.active_connections:
+        self.logger.info("websocket_connected", order_id=order_id, after=after, coalesce=coalesce)
+        return subscriber
+
+    def subscribe(self, order_id: str, websocket: Optional[WebSocket] = None, after: Optional[int] = None,
+                  coalesce: bool = False) -> Subscriber:
+        """Register a subscriber, with the buffered events after `after` already queued.
+
+        Nothing awaits between the replay and the registration, so no update
+        is missed or delivered twice.
+        """
+        subscriber = Subscriber(order_id, websocket, self.max_queue, coalesce)
+        for seq, text in self.events.since(order_id, after)[-self.max_queue:]:
+            if coalesce:
+                message = self.json_codec.decode(text)
+                del message["seq"]
+                subscriber.merge(seq, message)
+            else:
+                subscriber.queue.put_nowait((seq, text))
+            replayed_events.inc()
+        self.active_connections.setdefault(order_id, set()).add(subscriber)
+        return subscriber
+
+    def disconnect(self, subscriber: Subscriber):
+        subscribers = self.active_connections.get(subscriber.order_id)
+        if subscribers is None or subscriber not in subscribers:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.active_connections[subscriber.order_id]
+        if subscriber.writer is not None and subscriber.writer is not asyncio.current_task():
+            subscriber.writer.cancel()
+        if subscriber.websocket is None:
+            # wake the event stream up so it ends
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(None)
+            return
+        websocket_disconnections.inc()
+        self.logger.info("websocket_disconnected", order_id=subscriber.order_id)
+
+    def _evict(self, subscriber: Subscriber, reason: str):
+        websocket_evictions.labels(reason=reason).inc()
+        self.logger.warning("websocket_evicted", order_id=subscriber.order_id, reason=reason)
+        self.disconnect(subscriber)
+        if subscriber.websocket is not None:
+            asyncio.create_task(self._close(subscriber.websocket, code=1013))  # try again later
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _write(self, subscriber: Subscriber):
+        while True:
+            _, text = await subscriber.queue.get()
             try:
-                await self.active_connections[order_id].send_json(message)
-                self.logger.info("update_sent", order_id=order_id, message_type=message.get('message_type'))
+                await asyncio.wait_for(subscriber.websocket.send_text(text), self.send_timeout)
+            except asyncio.TimeoutError:
+                self._evict(subscriber, "send_timeout")
+                return
             except Exception as e:
-                self.logger.error("send_update_failed", order_id=order_id, error=str(e))
-                self.disconnect(order_id)
-        else:
-            self.logger.warning("can't update user, order id not found in active websocket connections", order_id=order_id)
+                self.logger.error("send_update_failed", order_id=subscriber.order_id, error=str(e))
+                self.disconnect(subscriber)
+                return
+
+    async def _write_coalesced(self, subscriber: Subscriber):
+        while True:
+            await subscriber.dirty.wait()
+            # let the updates arriving shortly after merge into the same frame
+            await asyncio.sleep(self.coalesce_window)
+            subscriber.dirty.clear()
+            changes = subscriber.delta()
+            if changes is None:
+                continue
+            try:
+                await asyncio.wait_for(
+                    subscriber.websocket.send_text(self.json_codec.encode(changes).decode()), self.send_timeout)
+            except asyncio.TimeoutError:
+                self._evict(subscriber, "send_timeout")
+                return
+            except Exception as e:
+                self.logger.error("send_update_failed", order_id=subscriber.order_id, error=str(e))
+                self.disconnect(subscriber)
+                return
+
+    def send_update(self, order_id: str, message: dict):
+        """Enqueue an update for every subscriber of the order, never waits on the network."""
+        event = self.events.append(order_id, message)
+        subscribers = self.active_connections.get(order_id)
+        if not subscribers:
+            self.logger.debug("update_buffered_without_subscribers", order_id=order_id, seq=event[0])
+            return
+        for subscriber in list(subscribers):
+            if subscriber.coalesce:
+                subscriber.merge(event[0], message)
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._evict(subscriber, "queue_full")
+
+    def queue_depth(self) -> int:
+        return sum(subscriber.queue.qsize() for subscribers in self.active_connections.values()
+                   for subscriber in subscribers)
+
+    def max_queue_depth(self) -> int:
+        return max((subscriber.queue.qsize() for subscribers in self.active_connections.values()
+                    for subscriber in subscribers), default=0)
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self.active_connections.values())
+
+    async def close_all(self):
+        for subscribers in list(self.active_connections.values()):
+            for subscriber in list(subscribers):
+                self.disconnect(subscriber)
+                if subscriber.websocket is not None:
+                    await self._close(subscriber.websocket, code=1001)  # going away
 
 manager = ConnectionManager()
 
+
+# Order routing
+class OrderRoutes:
+    """Orders whose updates are routed to this replica.
+
+    Orders created here are published with reply_to set to this replica, the
+    broker routes their events to its private queue through the one binding
+    made by consume_private(). Orders created on another replica are bound
+    one by one while a client is subscribed to them. Updates of an order go
+    to the replicas interested in it only, instead of all replicas competing
+    for one shared queue.
+    """
+
+    def __init__(self, ttl: float = Config.ORDER_ROUTE_TTL):
+        self.ttl = ttl
+        # order id -> monotonic time its record expires, oldest first. Routing
+        # doesn't depend on it, an expired order is merely bound needlessly
+        # when a client subscribes to it later on.
+        self.created: "OrderedDict[str, float]" = OrderedDict()
+        self.holders: Dict[str, int] = {}
+        self.bound: Set[str] = set()
+        self._locks: Dict[str, asyncio.Lock] = {}  # orders bind and unbind one at a time
+
+    def created_here(self, order_id: str):
+        now = time.monotonic()
+        self.created[order_id] = now + self.ttl
+        while next(iter(self.created.values())) <= now:
+            self.created.popitem(last=False)
+
+    async def hold(self, order_id: str, mq_service: RabbitMQService):
+        lock = self._locks.setdefault(order_id, asyncio.Lock())
+        async with lock:
+            self.holders[order_id] = self.holders.get(order_id, 0) + 1
+            if self.holders[order_id] == 1 and order_id not in self.created:
+                await mq_service.subscribe_order(order_id)
+                self.bound.add(order_id)
+
+    async def release(self, order_id: str, mq_service: RabbitMQService):
+        lock = self._locks.get(order_id)
+        if lock is None:
+            return
+        async with lock:
+            if order_id not in self.holders:
+                return
+            self.holders[order_id] -= 1
+            if self.holders[order_id] == 0:
+                del self.holders[order_id]
+                if order_id in self.bound:
+                    self.bound.discard(order_id)
+                    await mq_service.unsubscribe_order(order_id)
+        if order_id not in self.holders and not lock.locked():
+            self._locks.pop(order_id, None)
+
+
+routes = OrderRoutes()
+routed_orders.set_function(lambda: len(routes.bound))
+websocket_queue_depth.set_function(manager.queue_depth)
+websocket_max_queue_depth.set_function(manager.max_queue_depth)
+websocket_subscribers.set_function(manager.subscriber_count)
+replay_buffered_orders.set_function(lambda: len(manager.events))
+status_view_orders.set_function(lambda: len(status_view))
+
 # Request Models
 class OrderRequest(BaseModel):
     customer_id: str
@@ -93,22 +582,21 @@ def get_rabbitmq_service() -> RabbitMQService:
 
 # Message Handlers
 @monitor_message_processing('api_service')
-async def handle_order_update(message: dict):
+async def handle_order_update(message: Message):
     """Handle updates from various services and forward to WebSocket"""
-    order_id = message.get("order_id")
+    order_id = message.order_id
     if not order_id:
-        raise ServiceException(message="Missing order_id in message", details=message)
-    await manager.send_update(order_id, message)
+        raise ServiceException(message="Missing order_id in message", details={"correlation_id": message.correlation_id})
+    status_view.apply(message)
+    manager.send_update(order_id, message.to_json())
 
 async def message_handler(message: IncomingMessage):
 
     try:
-        message_body = json.loads(message.body.decode("utf-8"))
+        message_body = Message.from_amqp(message)
         await handle_order_update(message_body)
-        await message.ack()
     except Exception as e:
         logger.error("message_processing_failed")
-        await message.nack(requeue=True)
         raise
 
 @app.on_event("startup")
@@ -122,8 +610,9 @@ async def startup_event():
 
     app.state.rabbitmq_service = mq_service
     
-    for queue_name in settings.update_queues:
-        await mq_service.consume(queue_name, message_handler)
+    status_view.start()
+    # updates arrive only for the orders routed to this replica
+    await mq_service.consume_private(message_handler)
     
     logger.info("Frontend Service started successfully")
 
@@ -142,11 +631,16 @@ async def create_order(order: OrderRequest, mq_service: RabbitMQService = Depend
             "customer_id": order.customer_id,
             "status": OrderStatus.CREATED.value,
             "details": order.details
-        }
+        },
+        # the services echo it back, the order's updates are routed to this replica
+        reply_to=mq_service.instance_key
     )
     
-    message_json = message.to_json()
-    await mq_service.publish("order_requests", message_json)
+    status_view.apply(message)
+    routes.created_here(order_id)
+    # the order's trace starts here, its id is the correlation id
+    with tracer.span("POST /order/doener", trace_id=correlation_id, order_id=order_id):
+        await mq_service.publish("order_requests", message)
     
     return {
         "order_id": order_id,
@@ -155,20 +649,76 @@ async def create_order(order: OrderRequest, mq_service: RabbitMQService = Depend
         "status": "created"
     }
 
+@app.get("/order/{order_id}/status")
+async def get_order_status(order_id: str):
+    """Latest known status of an order, served from the read model of this replica or by order_service."""
+    try:
+        status = await status_view.lookup(order_id)
+    except Exception as e:
+        logger.error("order_lookup_failed", order_id=order_id, error=str(e))
+        raise HTTPException(status_code=503, detail="Order status unavailable")
+    if status is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return status
+
 @app.get("/health")
 async def get_status(mq_service: RabbitMQService = Depends(get_rabbitmq_service)):
     """Get service status"""
     rabbitmq_status = "connected" if mq_service.connection and mq_service.connection.connected else "disconnected"
     return {"status": "healthy", "rabbitmq_status": rabbitmq_status}
 
+@app.get("/sse/{order_id}")
+async def event_stream(order_id: str, after: Optional[int] = None,
+                       last_event_id: Optional[int] = Header(None)):
+    """Stream the updates of an order as Server-Sent Events.
+
+    Buffered events are replayed first. Reconnecting clients resume after the
+    Last-Event-ID header their EventSource sends, or after `after`.
+    """
+    mq_service = app.state.rabbitmq_service
+    resume_after = last_event_id if last_event_id is not None else after
+
+    async def stream():
+        await routes.hold(order_id, mq_service)
+        subscriber = manager.subscribe(order_id, after=resume_after)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), Config.SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                seq, text = event
+                yield f"id: {seq}\ndata: {text}\n\n"
+        finally:
+            manager.disconnect(subscriber)
+            await routes.release(order_id, mq_service)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.websocket("/ws/{order_id}")
-async def websocket_endpoint(websocket: WebSocket, order_id: str):
-    await manager.connect(order_id, websocket)
+async def websocket_endpoint(websocket: WebSocket, order_id: str, after: Optional[int] = None,
+                             mode: str = "full"):
+    """Push the updates of an order, replaying the buffered ones after `after` first.
+
+    With mode=delta updates are coalesced and only changed fields are sent.
+    """
+    mq_service = app.state.rabbitmq_service
+    await routes.hold(order_id, mq_service)
     try:
-        while True:
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        manager.disconnect(order_id)
+        subscriber = await manager.connect(order_id, websocket, after, coalesce=mode == "delta")
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            manager.disconnect(subscriber)
+    finally:
+        await routes.release(order_id, mq_service)
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -176,5 +726,5 @@ async def shutdown_event():
     mq_service = app.state.rabbitmq_service
     if mq_service:
         await mq_service.close()
-    for order_id in list(manager.active_connections.keys()):
-        manager.disconnect(order_id)
+    await manager.close_all()
+    await status_view.close()
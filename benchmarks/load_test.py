@@ -0,0 +1,233 @@
+"""Open-loop load test of the order saga, from POST /order/doener to INVOICE_CREATED.
+
+Orders arrive at a fixed rate per step, independent of how fast the
+services answer, so queueing shows up as latency instead of being hidden by
+a slower client. Latency is measured from the moment an order was scheduled
+to be sent. Every order opens /ws/{order_id} right after it was created;
+events published before that are replayed by api_service.
+
+    docker compose up -d
+    python benchmarks/load_test.py --rates 10,50,100 --duration 30 --output before.json
+    python benchmarks/load_test.py --rates 10,50,100 --duration 30 --output after.json --compare before.json
+
+The simulated latencies are set on the services, e.g.
+SHOP_LOOKUP_LATENCY=0 INVOICE_BACKEND_LATENCY=0 docker compose up -d. ORDER_DB_LATENCY
+only slows down the in-memory order store, compose runs the SQLite one unless
+ORDER_STORE=memory is set too:
+
+    ORDER_STORE=memory ORDER_DB_LATENCY=0 docker compose up -d
+
+Without RabbitMQ, the services run in one process on the in-memory broker
+and the same knobs apply:
+
+    ORDER_STORE=memory ORDER_DB_LATENCY=0 uvicorn colocated:app --port 8080
+
+These settings are recorded in the report when set in the environment of
+this tool too.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import websockets
+
+STAGES = ("ORDER_ACKNOWLEDGED", "DOENER_ASSIGNED", "INVOICE_CREATED")
+FAILURES = ("ORDER_CREATION_FAILED", "DOENER_ASSIGNMENT_FAILED", "INVOICE_CREATION_FAILED")
+SIMULATED_LATENCIES = ("ORDER_DB_LATENCY", "SHOP_LOOKUP_LATENCY", "INVOICE_BACKEND_LATENCY")
+SERVICE_SETTINGS = ("ORDER_STORE", "TRANSPORT")
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class HttpPool:
+    """Keep-alive HTTP/1.1 connections for JSON POSTs, enough for a load generator."""
+
+    def __init__(self, url: str, size: int):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(size)
+
+    async def post_json(self, path: str, body: dict) -> Tuple[int, dict]:
+        async with self._slots:
+            reader, writer = self._idle.get_nowait() if not self._idle.empty() else \
+                await asyncio.open_connection(self.host, self.port)
+            try:
+                payload = json.dumps(body).encode()
+                writer.write(
+                    f"POST {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+                status_line = await reader.readuntil(b"\r\n")
+                headers = {}
+                while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                response = await reader.readexactly(int(headers.get("content-length", 0)))
+            except BaseException:
+                writer.close()
+                raise
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self._idle.put_nowait((reader, writer))
+            return int(status_line.split()[1]), json.loads(response or b"{}")
+
+    async def close(self):
+        while not self._idle.empty():
+            _, writer = self._idle.get_nowait()
+            writer.close()
+
+
+class OrderResult:
+    __slots__ = ("scheduled", "post", "stages", "outcome")
+
+    def __init__(self, scheduled: float):
+        self.scheduled = scheduled
+        self.post: Optional[float] = None
+        self.stages: Dict[str, float] = {}  # event -> seconds since scheduled
+        self.outcome = "timeout"
+
+
+async def run_order(pool: HttpPool, ws_url: str, scheduled: float, timeout: float) -> OrderResult:
+    result = OrderResult(scheduled)
+    try:
+        status, created = await pool.post_json("/order/doener", {
+            "customer_id": f"load-{random.randrange(1_000_000)}",
+            "details": {"item": "doener", "extras": ["onions", "garlic sauce"]},
+        })
+        result.post = time.perf_counter() - scheduled
+        if status != 200:
+            result.outcome = f"http_{status}"
+            return result
+
+        async with asyncio.timeout(timeout - result.post):
+            async with websockets.connect(f"{ws_url}/ws/{created['order_id']}", compression=None) as ws:
+                async for frame in ws:
+                    event = json.loads(frame)["message_type"]
+                    result.stages.setdefault(event, time.perf_counter() - scheduled)
+                    if event in FAILURES:
+                        result.outcome = "failed"
+                        return result
+                    if event == STAGES[-1]:
+                        result.outcome = "completed"
+                        return result
+    except TimeoutError:
+        pass
+    except Exception as e:
+        result.outcome = f"error_{type(e).__name__}"
+    return result
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    summary = {f"p{int(q * 100)}": values[min(int(q * len(values)), len(values) - 1)] * 1000 for q in PERCENTILES}
+    summary["mean"] = sum(values) / len(values) * 1000
+    summary["max"] = values[-1] * 1000
+    return summary
+
+
+async def run_step(args, rate: float) -> dict:
+    pool = HttpPool(args.url, args.connections)
+    ws_url = args.url.replace("http", "ws", 1)
+    tasks = []
+    started = time.perf_counter()
+    next_arrival = started
+    while next_arrival < started + args.duration:
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_order(pool, ws_url, next_arrival, args.timeout)))
+        gap = random.expovariate(rate) if args.arrival == "poisson" else 1 / rate
+        next_arrival += gap
+    results: List[OrderResult] = await asyncio.gather(*tasks)
+    await pool.close()
+
+    completed = [result for result in results if result.outcome == "completed"]
+    last_completion = max((result.scheduled + result.stages[STAGES[-1]] for result in completed), default=started)
+    outcomes: Dict[str, int] = {}
+    for result in results:
+        outcomes[result.outcome] = outcomes.get(result.outcome, 0) + 1
+    return {
+        "offered_rate": rate,
+        "orders": len(results),
+        "outcomes": outcomes,
+        "throughput": len(completed) / max(last_completion - started, args.duration),
+        "latency_ms": {
+            "post": summarize([result.post for result in results if result.post is not None]),
+            **{stage: summarize([result.stages[stage] for result in completed if stage in result.stages])
+               for stage in STAGES},
+        },
+    }
+
+
+def print_step(step: dict, baseline: Optional[dict]):
+    print(f"\nrate {step['offered_rate']:g}/s  orders {step['orders']}  "
+          f"throughput {step['throughput']:.1f}/s  {step['outcomes']}")
+    if baseline:
+        print(f"  baseline throughput {baseline['throughput']:.1f}/s  {baseline['outcomes']}")
+    print(f"  {'stage':<20}" + "".join(f"{name:>10}" for name in ("p50", "p90", "p99", "max")))
+    for stage, summary in step["latency_ms"].items():
+        if not summary:
+            continue
+        print(f"  {stage:<20}" + "".join(f"{summary[name]:10.1f}" for name in ("p50", "p90", "p99", "max")))
+        before = (baseline or {}).get("latency_ms", {}).get(stage)
+        if before:
+            print(f"  {'  vs baseline':<20}" + "".join(
+                f"{(summary[name] / before[name] - 1) * 100 if before[name] else 0:+9.0f}%"
+                for name in ("p50", "p90", "p99", "max")))
+
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080", help="api_service base url")
+    parser.add_argument("--rates", default="10,25,50", help="comma separated arrival rates in orders per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds orders arrive at each rate")
+    parser.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds an order may take to be invoiced")
+    parser.add_argument("--connections", type=int, default=64, help="keep-alive connections for the POSTs")
+    parser.add_argument("--pause", type=float, default=5, help="seconds between steps")
+    parser.add_argument("--label", default="", help="free text stored with the report, e.g. a git revision")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    parser.add_argument("--compare", help="report JSON of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    baseline_steps = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_steps = {step["offered_rate"]: step for step in json.load(f)["steps"]}
+
+    report = {
+        "label": args.label,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": {**{key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+                   "simulated_latencies": {name: os.environ[name] for name in SIMULATED_LATENCIES
+                                           if name in os.environ},
+                   "services": {name: os.environ[name] for name in SERVICE_SETTINGS if name in os.environ}},
+        "steps": [],
+    }
+    for index, rate in enumerate(float(rate) for rate in args.rates.split(",")):
+        if index:
+            await asyncio.sleep(args.pause)
+        step = await run_step(args, rate)
+        report["steps"].append(step)
+        print_step(step, baseline_steps.get(rate))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
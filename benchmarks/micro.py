@@ -0,0 +1,311 @@
+"""Micro-benchmarks of the code every message runs through, compared against a recorded baseline.
+
+    python benchmarks/micro.py --save          # record benchmarks/baseline.json on this machine
+    python benchmarks/micro.py                 # compare with it
+    python benchmarks/micro.py --filter db     # only the benchmarks whose name contains "db"
+
+Every benchmark reports the fastest of several repeats in microseconds per
+operation, which is the least noisy number on a shared machine, and the
+spread of the repeats, (slowest - fastest) / fastest. The run fails when a
+benchmark got slower than the baseline by more than --threshold plus the
+larger spread of the two runs, so a noisy machine widens the margin instead
+of reporting its noise as a regression. Baselines are only comparable on
+the same machine and Python, which is why none is checked in: record one
+per CI runner or workstation before changing the code.
+"""
+import os
+import tempfile
+
+# simulated latencies off, files out of the way and log output off the terminal,
+# set before the services read their configuration
+_workdir = tempfile.mkdtemp(prefix="micro-")
+os.environ.setdefault("ORDER_DB_LATENCY", "0")
+os.environ.setdefault("ORDER_STORE", "memory")
+os.environ.setdefault("ORDER_DB_PATH", os.path.join(_workdir, "orders.db"))
+os.environ.setdefault("STATUS_SNAPSHOT_PATH", "")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.codec import JsonCodec, decode_body
+from common.monitoring import monitor_message_processing
+from common.order_store import InMemoryOrderStore, SQLiteOrderStore
+from common.transport import AmqpTransport
+from common.types import Message
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(name: str):
+    def register(factory: Callable) -> Callable:
+        BENCHMARKS[name] = factory
+        return factory
+    return register
+
+
+def sample_message(message_type: str = "DOENER_ASSIGNED") -> Message:
+    return Message(
+        correlation_id=str(uuid.uuid4()),
+        order_id=str(uuid.uuid4()),
+        timestamp=datetime.now(),
+        message_type=message_type,
+        payload={
+            "shop": {"id": "shop2", "name": "Döner Palace", "rating": 4.2, "capacity": 10, "prep_time": 300},
+            "price": 7.5,
+            "status": "DOENER_ASSIGNED",
+        }
+    )
+
+
+class Received:
+    """What Message.from_amqp reads of an aio_pika IncomingMessage."""
+
+    def __init__(self, outgoing):
+        self.body = outgoing.body
+        self.headers = outgoing.headers
+        self.content_type = outgoing.content_type
+        self.correlation_id = outgoing.correlation_id
+        self.reply_to = outgoing.reply_to
+        self.type = outgoing.type
+
+
+# Benchmarks return the operation to time, a plain or a coroutine function
+@benchmark("message.to_json")
+def bench_to_json():
+    message = sample_message()
+    return message.to_json
+
+
+@benchmark("message.encode")
+def bench_encode():
+    codec = JsonCodec()
+    message = sample_message()
+    return lambda: codec.encode(message.to_json())
+
+
+@benchmark("handler.decode_full_body")
+def bench_decode_full_body():
+    # what every message_handler used to do: json.loads(message.body.decode())
+    body = JsonCodec().encode(sample_message().to_json())
+    return lambda: decode_body(body, "application/json")
+
+
+@benchmark("handler.from_amqp_headers_only")
+def bench_from_amqp_headers():
+    received = Received(AmqpTransport().message(sample_message(), sample_message().amqp_headers()))
+    return lambda: Message.from_amqp(received)
+
+
+@benchmark("handler.from_amqp_with_payload")
+def bench_from_amqp_payload():
+    received = Received(AmqpTransport().message(sample_message(), sample_message().amqp_headers()))
+    return lambda: Message.from_amqp(received).payload
+
+
+@benchmark("monitor.wrapper_overhead")
+def bench_monitor_overhead():
+    message = sample_message()
+
+    async def handler(message):
+        return None
+
+    wrapped = monitor_message_processing("micro")(handler)
+    return lambda: wrapped(message)
+
+
+@benchmark("monitor.bare_handler")
+def bench_bare_handler():
+    message = sample_message()
+
+    async def handler(message):
+        return None
+
+    return lambda: handler(message)
+
+
+@benchmark("api.send_update_no_subscriber")
+def bench_send_update_nobody():
+    from api_service import ConnectionManager
+    manager = ConnectionManager()
+    message = sample_message().to_json()
+    return lambda: manager.send_update(message["order_id"], message)
+
+
+@benchmark("api.send_update_one_subscriber")
+def bench_send_update_one():
+    from api_service import ConnectionManager
+    manager = ConnectionManager()
+    message = sample_message().to_json()
+    subscriber = manager.subscribe(message["order_id"])
+    queue = subscriber.queue
+
+    def send():
+        manager.send_update(message["order_id"], message)
+        queue.get_nowait()
+    return send
+
+
+def order_database(store):
+    from order_service import OrderDatabase
+    return OrderDatabase(store)
+
+
+@benchmark("db.memory.create_order")
+def bench_memory_create():
+    db = order_database(InMemoryOrderStore(latency=0))
+    return lambda: db.create_order(str(uuid.uuid4()), {"customer_id": "c1", "details": None})
+
+
+@benchmark("db.memory.update_order")
+def bench_memory_update():
+    db = order_database(InMemoryOrderStore(latency=0))
+    order_id = str(uuid.uuid4())
+    asyncio.get_event_loop().run_until_complete(db.create_order(order_id, {"customer_id": "c1"}))
+    return lambda: db.update_order(order_id, {"status": "DOENER_ASSIGNED", "price": 7.5})
+
+
+@benchmark("db.sqlite.create_order")
+def bench_sqlite_create():
+    db = order_database(SQLiteOrderStore(os.path.join(_workdir, f"{uuid.uuid4().hex}.db")))
+    return lambda: db.create_order(str(uuid.uuid4()), {"customer_id": "c1", "details": None})
+
+
+@benchmark("db.sqlite.update_order")
+def bench_sqlite_update():
+    db = order_database(SQLiteOrderStore(os.path.join(_workdir, f"{uuid.uuid4().hex}.db")))
+    order_id = str(uuid.uuid4())
+    asyncio.get_event_loop().run_until_complete(db.create_order(order_id, {"customer_id": "c1"}))
+    return lambda: db.update_order(order_id, {"status": "DOENER_ASSIGNED", "price": 7.5})
+
+
+def calibrate(operation: Callable, min_time: float) -> Callable[[], float]:
+    """A timed run of `operation`, in microseconds per operation, that takes at least `min_time`."""
+    loop = asyncio.get_event_loop()
+    is_async = asyncio.iscoroutine(probe := operation())
+    if is_async:
+        loop.run_until_complete(probe)
+
+        async def run(number: int):
+            for _ in range(number):
+                await operation()
+
+        def timed(number: int) -> float:
+            start = time.perf_counter()
+            loop.run_until_complete(run(number))
+            return time.perf_counter() - start
+    else:
+        def timed(number: int) -> float:
+            start = time.perf_counter()
+            for _ in range(number):
+                operation()
+            return time.perf_counter() - start
+
+    # like timeit: grow the loop until one run takes min_time
+    number = 1
+    while timed(number) < min_time:
+        number *= 2
+    return lambda: timed(number) / number * 1e6
+
+
+def measure(operations: Dict[str, Callable], min_time: float, repeat: int) -> Dict[str, Tuple[float, float]]:
+    """Fastest run and spread of the runs of every operation.
+
+    The repeats go round all operations in turn, so a slow phase of the
+    machine widens the spread of every benchmark it hits instead of
+    shifting one of them as a whole.
+    """
+    runs = {name: calibrate(operation, min_time) for name, operation in operations.items()}
+    times: Dict[str, List[float]] = {name: [] for name in runs}
+    for _ in range(repeat):
+        for name, run in runs.items():
+            times[name].append(run())
+    return {name: (min(t), (max(t) - min(t)) / min(t)) for name, t in times.items()}
+
+
+def cpu_model() -> str:
+    """platform.processor() is empty on most Linux machines, /proc/cpuinfo names the CPU."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def environment() -> Dict[str, str]:
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "system": platform.system(), "processor": platform.processor(),
+            "cpu": cpu_model()}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown on top of the measured spread, 0.25 means 25%%")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds every timed run takes at least")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    baseline: Dict = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("environment") != environment() and not args.save:
+            print("warning: the baseline was recorded on another machine or Python, compare with care\n")
+
+    results: Dict[str, float] = {}
+    spreads: Dict[str, float] = {}
+    regressions = []
+    print(f"{'benchmark':<34}{'us/op':>10}{'spread':>8}{'baseline':>10}{'change':>9}")
+    measured = measure({name: factory() for name, factory in BENCHMARKS.items() if args.filter in name},
+                       args.min_time, args.repeat)
+    for name, (result, spread) in measured.items():
+        results[name], spreads[name] = result, spread
+        before = baseline.get("results", {}).get(name)
+        change = results[name] / before - 1 if before else None
+        noise = max(spreads[name], baseline.get("spreads", {}).get(name, 0.0))
+        flag = ""
+        if change is not None and change > args.threshold + noise:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<34}{results[name]:10.2f}{spreads[name] * 100:7.1f}%{before or float('nan'):10.2f}"
+              f"{'' if change is None else f'{change * 100:+8.1f}%'}{flag}")
+
+    if "monitor.wrapper_overhead" in results and "monitor.bare_handler" in results:
+        overhead = results["monitor.wrapper_overhead"] - results["monitor.bare_handler"]
+        print(f"\nmonitor_message_processing adds {overhead:.2f} us per message")
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "recorded_at": datetime.now().isoformat(),
+                       "results": {**baseline.get("results", {}), **results},
+                       "spreads": {**baseline.get("spreads", {}), **spreads}}, f, indent=2, sort_keys=True)
+        print(f"\nbaseline written to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than "
+              f"{args.threshold * 100:.0f}% plus their spread: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
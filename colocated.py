@@ -0,0 +1,52 @@
+"""All four services in one process, talking through the in-memory broker.
+
+    uvicorn colocated:app --port 8080
+
+api_service is served at the root, the others under /order_service,
+/doener_service and /invoice_service. Messages are passed between the
+services as objects, there is no RabbitMQ to run.
+"""
+import os
+
+# must be set before the services read their configuration
+os.environ.setdefault("TRANSPORT", "memory")
+
+from fastapi import FastAPI
+
+from common.config import Config
+from common.log import configure_logging
+
+configure_logging("colocated")
+
+import api_service
+import doener_service
+import invoice_service
+import order_service
+
+if Config.TRANSPORT != "memory":
+    raise RuntimeError("colocated mode needs TRANSPORT=memory")
+
+app = FastAPI(title="Döner Order System (co-located)")
+
+services = [api_service, order_service, doener_service, invoice_service]
+
+
+@app.on_event("startup")
+async def startup_event():
+    for service in services:
+        await service.app.router.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for service in reversed(services):
+        await service.app.router.shutdown()
+
+
+# orders of the other replicas' clients, here straight from the store
+api_service.status_view.fetch = order_service.db.get_order
+
+app.mount("/order_service", order_service.app)
+app.mount("/doener_service", doener_service.app)
+app.mount("/invoice_service", invoice_service.app)
+app.mount("/", api_service.app)
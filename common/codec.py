@@ -0,0 +1,72 @@
+import json
+from collections import deque
+from typing import Any, Dict, Optional
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional binary codec
+    msgpack = None
+
+from common.config import Config
+
+
+def _encode_default(value: Any) -> Any:
+    # bounded histories are kept in deques
+    if isinstance(value, (deque, set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class JsonCodec:
+    content_type = "application/json"
+
+    def encode(self, message: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(message, default=_encode_default)
+        return json.dumps(message, separators=(",", ":"), default=_encode_default).encode()
+
+    def decode(self, body: bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
+
+
+class MsgpackCodec:
+    content_type = "application/msgpack"
+
+    def encode(self, message: Any) -> bytes:
+        return msgpack.packb(message, use_bin_type=True, default=_encode_default)
+
+    def decode(self, body: bytes) -> Any:
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS: Dict[str, Any] = {JsonCodec.content_type: JsonCodec()}
+if msgpack is not None:
+    CODECS[MsgpackCodec.content_type] = MsgpackCodec()
+
+
+def get_codec(content_type: Optional[str] = None):
+    """Codec for a content type, the configured publishing codec by default.
+
+    Messages without a content type predate the codec layer and are JSON.
+    """
+    content_type = content_type or Config.MESSAGE_CONTENT_TYPE
+    try:
+        return CODECS[content_type]
+    except KeyError:
+        raise ValueError(f"Unsupported message content type: {content_type}")
+
+
+def decode_body(body: bytes, content_type: Optional[str]) -> Any:
+    return get_codec(content_type or JsonCodec.content_type).decode(body)
+
+
+def decode_message(message) -> Any:
+    """Decode an incoming AMQP message according to its content_type header."""
+    return decode_body(message.body, message.content_type)
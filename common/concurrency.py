@@ -0,0 +1,101 @@
+import asyncio
+import time
+from collections import deque
+from functools import wraps
+from typing import Callable
+
+from common.monitoring import concurrency_limit, concurrency_in_flight
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit around a message handler.
+
+    The limit grows by one for every fast, successful message while the
+    consumer is actually using its capacity, and is cut by ``backoff`` whenever
+    a handler fails or takes longer than ``latency_tolerance`` times the
+    baseline latency, the lowest latency seen over the last one to two
+    ``baseline_window`` seconds.
+    """
+
+    def __init__(self, service_name: str, queue_name: str, initial_limit: int = 10,
+                 min_limit: int = 1, max_limit: int = 200, backoff: float = 0.9,
+                 latency_tolerance: float = 2.0, baseline_window: float = 30.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.baseline_window = baseline_window
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.baseline_latency = None
+        self._previous_window_min = float("inf")
+        self._window_min = float("inf")
+        self._window_start = time.perf_counter()
+        self._last_backoff = 0.0
+        self._waiters = deque()
+
+        self._limit_gauge = concurrency_limit.labels(service=service_name, queue=queue_name)
+        self._in_flight_gauge = concurrency_in_flight.labels(service=service_name, queue=queue_name)
+        self._limit_gauge.set(int(self.limit))
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self.in_flight += 1
+        self._in_flight_gauge.set(self.in_flight)
+
+    def release(self, latency: float, failed: bool):
+        # the limit only grows while we are close to it, otherwise a quiet
+        # queue would inflate it without ever testing the new value
+        saturated = self.in_flight * 2 >= self.limit
+        self.in_flight -= 1
+        self._in_flight_gauge.set(self.in_flight)
+
+        now = time.perf_counter()
+        if now - self._window_start >= self.baseline_window:
+            # rotate windows so a permanently slower backend becomes the new normal
+            self._previous_window_min, self._window_min = self._window_min, float("inf")
+            self._window_start = now
+        if not failed:
+            self._window_min = min(self._window_min, latency)
+        self.baseline_latency = min(self._previous_window_min, self._window_min)
+
+        if failed or latency > self.baseline_latency * self.latency_tolerance:
+            # back off once per round trip: messages started before the last
+            # backoff saw the old limit and say nothing about the new one
+            if now - latency >= self._last_backoff:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_backoff = now
+        elif saturated:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._limit_gauge.set(int(self.limit))
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def wrap(self, handler: Callable) -> Callable:
+        @wraps(handler)
+        async def limited_handler(message):
+            await self.acquire()
+            start_time = time.perf_counter()
+            failed = True
+            try:
+                result = await handler(message)
+                failed = False
+                return result
+            finally:
+                self.release(time.perf_counter() - start_time, failed)
+        return limited_handler
@@ -4,6 +4,21 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+
+def _buckets(name: str, default: str) -> tuple:
+    """Histogram buckets in seconds from a comma separated env var."""
+    return tuple(float(bucket) for bucket in os.getenv(name, default).split(','))
+
+
+def _rates(name: str, default: dict) -> dict:
+    """Per event rates from an env var like "order_created=0.1,order_updated=0.5", merged over the defaults."""
+    rates = dict(default)
+    for entry in filter(None, os.getenv(name, '').split(',')):
+        event, rate = entry.rsplit('=', 1)
+        rates[event.strip()] = float(rate)
+    return rates
+
+
 class Config:
     # RabbitMQ Configuration
     RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
@@ -13,6 +28,8 @@ class Config:
     
     # Service Configuration
     SERVICE_NAME = os.getenv('SERVICE_NAME', 'unknown')
+    # amqp talks to RabbitMQ, memory to an in-process broker shared by the services of one process
+    TRANSPORT = os.getenv('TRANSPORT', 'amqp')
     
     # Queue Configuration
     QUEUES = [
@@ -30,11 +47,153 @@ class Config:
     DLX_QUEUE_PREFIX = 'dlq.'
     
     # Retry Configuration
-    MAX_RETRIES = 3
-    RETRY_DELAY = 5  # seconds
+    # failed messages wait in retry.<queue>.<attempt> for RETRY_DELAY * 2^(attempt - 1)
+    # seconds and end up in dlq.<queue> after MAX_RETRIES attempts
+    MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
+    RETRY_DELAY = float(os.getenv('RETRY_DELAY', 5))  # seconds
+    RETRY_QUEUE_PREFIX = 'retry.'
+    RETRY_COUNT_HEADER = 'x-retry-count'
+
+    # Sharding Configuration
+    # order_service consumes order_requests, doener_supplied and invoice_supplied
+    # from ORDER_SHARDS queues each, picked by a hash of the order id. Every
+    # service has to agree on ORDER_SHARDS, changing it moves orders between
+    # shards. Replicas send heartbeats every SHARD_HEARTBEAT_INTERVAL seconds
+    # and are considered gone after three missed ones
+    ORDER_SHARDS = int(os.getenv('ORDER_SHARDS', 16))
+    SHARD_HEARTBEAT_INTERVAL = float(os.getenv('SHARD_HEARTBEAT_INTERVAL', 2))  # seconds
+    SHARD_DRAIN_TIMEOUT = float(os.getenv('SHARD_DRAIN_TIMEOUT', 30))  # seconds a revoked shard may finish in
+
+    # Publisher Configuration
+    # consumers decode by the content_type header, so services can switch one at a time
+    MESSAGE_CONTENT_TYPE = os.getenv('MESSAGE_CONTENT_TYPE', 'application/json')  # or application/msgpack
+    PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', 100))
+    PUBLISH_BATCH_WINDOW = float(os.getenv('PUBLISH_BATCH_WINDOW', 0.005))  # seconds
     
+    # Consumer Configuration
+    # prefetch_count is the QoS of the queue's own channel, concurrency caps
+    # how many of the prefetched messages are handled at the same time. With
+    # adaptive set, concurrency is only the starting point of an AIMD limit
+    # that moves between min_concurrency and max_concurrency
+    DEFAULT_PREFETCH_COUNT = int(os.getenv('DEFAULT_PREFETCH_COUNT', 10))
+    DEFAULT_CONSUMER_CONCURRENCY = int(os.getenv('DEFAULT_CONSUMER_CONCURRENCY', 10))
+    CONSUMER_QOS = {
+        'order_service': {
+            # sharded, the QoS applies to every shard the replica owns
+            'order_requests': {'prefetch_count': 5, 'concurrency': 5},
+            'doener_supplied': {'prefetch_count': 5, 'concurrency': 5},
+            'invoice_supplied': {'prefetch_count': 5, 'concurrency': 5},
+        },
+        'doener_service': {
+            # shop lookups are I/O bound, let the limiter find how many can be in flight
+            'doener_requests': {'prefetch_count': 500, 'concurrency': 50, 'adaptive': True,
+                                'min_concurrency': 5, 'max_concurrency': 500},
+            # the events that release shop capacity, on the instance's own queue
+            'shops': {'prefetch_count': 100, 'concurrency': 100},
+        },
+        'invoice_service': {
+            'invoice_requests': {'prefetch_count': 100, 'concurrency': 20, 'adaptive': True,
+                                 'min_concurrency': 2, 'max_concurrency': 100},
+        },
+        'api_service': {
+            # the replica's own queue carrying the updates of the orders it holds
+            'private': {'prefetch_count': 300, 'concurrency': 300},
+        },
+    }
+
+    # Idempotency Configuration
+    IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 100000))
+    IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 3600))  # seconds
+    IDEMPOTENCY_DB_PATH = os.getenv('IDEMPOTENCY_DB_PATH')  # keeps processed keys across restarts when set
+
+    # Order Storage Configuration
+    # memory keeps the orders in the process, replicas then don't split the
+    # shards, the first one handles all of them and the others stand by
+    ORDER_STORE = os.getenv('ORDER_STORE', 'sqlite')  # sqlite or memory
+    ORDER_DB_PATH = os.getenv('ORDER_DB_PATH', 'orders.db')
+    ORDER_DB_LATENCY = float(os.getenv('ORDER_DB_LATENCY', 0.5))  # simulated latency of the memory store
+    ORDER_HISTORY_LIMIT = int(os.getenv('ORDER_HISTORY_LIMIT', 20))  # updates kept per order
+    # INVOICED / FAILED orders leave the memory store this long after completing,
+    # into the SQLite archive at ORDER_ARCHIVE_PATH when set, dropped otherwise
+    ORDER_RETENTION_TTL = float(os.getenv('ORDER_RETENTION_TTL', 3600))  # seconds
+    ORDER_ARCHIVE_PATH = os.getenv('ORDER_ARCHIVE_PATH')
+
+    # Shop Lookup Configuration
+    SHOP_LOOKUP_LATENCY = float(os.getenv('SHOP_LOOKUP_LATENCY', 1.5))  # simulated upstream round trip
+    SHOP_CACHE_TTL = float(os.getenv('SHOP_CACHE_TTL', 30))  # seconds
+    SHOP_CACHE_STALE_TTL = float(os.getenv('SHOP_CACHE_STALE_TTL', 300))  # served stale while refreshing
+    SHOP_DEFAULT_CAPACITY = int(os.getenv('SHOP_DEFAULT_CAPACITY', 10))  # concurrent orders per shop
+    SHOP_DEFAULT_PREP_TIME = float(os.getenv('SHOP_DEFAULT_PREP_TIME', 300))  # seconds
+    # frees the capacity of lost orders, by default once the two saga steps
+    # after the assignment could have used up all of their retries
+    SHOP_ASSIGNMENT_TIMEOUT = float(os.getenv('SHOP_ASSIGNMENT_TIMEOUT',
+                                              2 * RETRY_DELAY * (2 ** MAX_RETRIES - 1) + 60))  # seconds
+
+    # Invoice Configuration
+    INVOICE_BACKEND_LATENCY = float(os.getenv('INVOICE_BACKEND_LATENCY', 0.5))  # simulated call per batch
+    INVOICE_BATCH_SIZE = int(os.getenv('INVOICE_BATCH_SIZE', 50))
+    INVOICE_BATCH_WINDOW = float(os.getenv('INVOICE_BATCH_WINDOW', 0.05))  # seconds
+
+    # WebSocket Configuration
+    WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 64))  # updates buffered per connection
+    WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT', 5))  # seconds before a stuck client is dropped
+    WS_COALESCE_WINDOW = float(os.getenv('WS_COALESCE_WINDOW', 0.05))  # seconds updates are merged for ?mode=delta
+    ORDER_ROUTE_TTL = float(os.getenv('ORDER_ROUTE_TTL', 600))  # how long a replica remembers the orders created on it
+    REPLAY_BUFFER_SIZE = int(os.getenv('REPLAY_BUFFER_SIZE', 16))  # recent events kept per order
+    REPLAY_MAX_ORDERS = int(os.getenv('REPLAY_MAX_ORDERS', 10000))  # orders with a replay buffer
+    REPLAY_TTL = float(os.getenv('REPLAY_TTL', 600))  # seconds an order's events stay replayable
+    STATUS_VIEW_SIZE = int(os.getenv('STATUS_VIEW_SIZE', 100000))  # orders kept in the status read model
+    STATUS_SNAPSHOT_PATH = os.getenv('STATUS_SNAPSHOT_PATH', 'order_status.json')  # empty disables snapshots
+    STATUS_SNAPSHOT_INTERVAL = float(os.getenv('STATUS_SNAPSHOT_INTERVAL', 30))  # seconds between snapshots
+    # orders the status read model doesn't follow are looked up there
+    ORDER_SERVICE_URL = os.getenv('ORDER_SERVICE_URL', 'http://order_service:8081')
+    ORDER_LOOKUP_TIMEOUT = float(os.getenv('ORDER_LOOKUP_TIMEOUT', 2))  # seconds
+    SSE_KEEPALIVE = float(os.getenv('SSE_KEEPALIVE', 15))  # seconds between comments on idle event streams
+
+    # Logging Configuration
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # log events waiting to be written before new ones are dropped
+    LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', 100))  # log events per second and event name, 0 disables
+    # share of orders whose per-message events are logged, the same orders in every service
+    LOG_SAMPLING = _rates('LOG_SAMPLING', {
+        'processing_doener_request': 0.1,
+        'doener_assigned': 0.1,
+        'order_created': 0.1,
+        'order_updated': 0.1,
+        'requesting_invoice': 0.1,
+        'creating_invoice': 0.1,
+        'invoice_created': 0.1,
+        'order updated with invoice': 0.1,
+        'websocket_connected': 0.1,
+        'websocket_disconnected': 0.1,
+        'update_buffered_without_subscribers': 0.1,
+    })
+
     # Monitoring Configuration
     PROMETHEUS_PORT = int(os.getenv('PROMETHEUS_PORT', 8000))
+    PROCESSING_TIME_BUCKETS = _buckets('PROCESSING_TIME_BUCKETS', '.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10')
+    MESSAGE_LAG_BUCKETS = _buckets('MESSAGE_LAG_BUCKETS', '.001,.005,.01,.05,.1,.5,1,5,10,30,60')
+    SAGA_LATENCY_BUCKETS = _buckets('SAGA_LATENCY_BUCKETS', '.5,1,2,3,4,5,6,8,10,15,30,60')
+    TRACE_DIR = os.getenv('TRACE_DIR', '')  # spans go to <TRACE_DIR>/<service>.jsonl, empty disables tracing
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))  # share of traces recorded
+    TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', 10000))  # spans waiting to be written before new ones are dropped
+    SAGA_TRACKED_ORDERS = int(os.getenv('SAGA_TRACKED_ORDERS', 100000))  # orders whose start time is kept
+
+    @staticmethod
+    def get_consumer_qos(service_name: str, queue_name: str) -> dict:
+        """QoS of a consumed queue, <QUEUE>_PREFETCH / <QUEUE>_CONCURRENCY / <QUEUE>_ADAPTIVE env vars take precedence."""
+        qos = Config.CONSUMER_QOS.get(service_name, {}).get(queue_name, {})
+        env_prefix = queue_name.upper()
+        concurrency = int(os.getenv(f'{env_prefix}_CONCURRENCY',
+                                    qos.get('concurrency', Config.DEFAULT_CONSUMER_CONCURRENCY)))
+        return {
+            'prefetch_count': int(os.getenv(f'{env_prefix}_PREFETCH',
+                                            qos.get('prefetch_count', Config.DEFAULT_PREFETCH_COUNT))),
+            'concurrency': concurrency,
+            'adaptive': os.getenv(f'{env_prefix}_ADAPTIVE', str(qos.get('adaptive', False))).lower() == 'true',
+            'min_concurrency': qos.get('min_concurrency', 1),
+            'max_concurrency': qos.get('max_concurrency', concurrency),
+        }
 
     @staticmethod
     def get_rabbitmq_url():
@@ -0,0 +1,32 @@
+from typing import Callable, Optional
+
+from aiormq.exceptions import ChannelNotFoundEntity
+from fastapi import APIRouter, Depends, HTTPException
+
+
+def create_dlq_router(get_rabbitmq_service: Callable) -> APIRouter:
+    """Endpoints to inspect and replay the dead letter queues of a service.
+
+    A sharded queue is read over all its shards unless `shard` picks one.
+    The endpoints are unauthenticated, so they are only mounted on the
+    internal services, never on the public api_service.
+    """
+    router = APIRouter(prefix="/dlq", tags=["dlq"])
+
+    @router.get("/{queue_name}")
+    async def inspect_dlq(queue_name: str, limit: int = 10, shard: Optional[int] = None,
+                          mq_service=Depends(get_rabbitmq_service)):
+        try:
+            return await mq_service.inspect_dlq(queue_name, limit, shard)
+        except ChannelNotFoundEntity:
+            raise HTTPException(status_code=404, detail="Dead letter queue not found")
+
+    @router.post("/{queue_name}/replay")
+    async def replay_dlq(queue_name: str, limit: Optional[int] = None, shard: Optional[int] = None,
+                         mq_service=Depends(get_rabbitmq_service)):
+        try:
+            return {"replayed": await mq_service.replay_dlq(queue_name, limit, shard)}
+        except ChannelNotFoundEntity:
+            raise HTTPException(status_code=404, detail="Dead letter queue not found")
+
+    return router
@@ -0,0 +1,213 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+
+import structlog
+
+from common.config import Config
+from common.monitoring import idempotency_hits, idempotency_misses
+from common.types import Message
+
+logger = structlog.get_logger()
+
+Key = Tuple[str, str]
+
+
+class SQLiteProcessedStore:
+    """Persistent set of processed message keys, survives restarts of the service.
+
+    Keys are written by one writer thread, keys added while a transaction
+    is being committed go into the next one, so concurrent handlers share a
+    single fsync. Keys older than `ttl` are deleted every `prune_interval`
+    seconds. Lookups run on their own connection and thread.
+    """
+
+    def __init__(self, path: str, ttl: float = Config.IDEMPOTENCY_TTL, max_batch: int = 500,
+                 prune_interval: float = 60.0):
+        self.ttl = ttl
+        self.max_batch = max_batch
+        self.prune_interval = prune_interval
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="idempotency-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="idempotency-reader")
+        self._write_conn = self._connect(path)
+        self._write_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                correlation_id TEXT, message_type TEXT, processed_at REAL,
+                PRIMARY KEY (correlation_id, message_type)
+            );
+            CREATE INDEX IF NOT EXISTS idx_processed_at ON processed_messages (processed_at);
+        """)
+        self._read_conn = self._connect(path)
+        self._pending: Optional[asyncio.Queue] = None
+        self._commit_task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    async def contains(self, key: Key) -> bool:
+        row = await asyncio.get_running_loop().run_in_executor(
+            self._reader,
+            lambda: self._read_conn.execute(
+                "SELECT 1 FROM processed_messages WHERE correlation_id = ? AND message_type = ? "
+                "AND processed_at > ?", (*key, time.time() - self.ttl)
+            ).fetchone()
+        )
+        return row is not None
+
+    async def add(self, key: Key):
+        if self._commit_task is None:
+            self._pending = asyncio.Queue()
+            self._commit_task = asyncio.create_task(self._group_commit())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait((key, future))
+        await future
+
+    async def _group_commit(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._pending.get()]
+            while len(batch) < self.max_batch and not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+            try:
+                await loop.run_in_executor(self._writer, self._commit_batch, [key for key, _ in batch])
+                error = None
+            except Exception as e:
+                logger.error("idempotency_store_commit_failed", error=str(e), size=len(batch))
+                error = e
+            for _, future in batch:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+
+    def _commit_batch(self, keys: List[Key]):
+        now = time.time()
+        conn = self._write_conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO processed_messages VALUES (?, ?, ?)",
+                             [(*key, now) for key in keys])
+            if now - self._pruned_at > self.prune_interval:
+                conn.execute("DELETE FROM processed_messages WHERE processed_at <= ?", (now - self.ttl,))
+                self._pruned_at = now
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def close(self):
+        if self._commit_task:
+            while not self._pending.empty():
+                await asyncio.sleep(0)
+            self._commit_task.cancel()
+            self._commit_task = None
+        self._writer.submit(self._write_conn.close).result()
+        self._reader.submit(self._read_conn.close).result()
+        self._writer.shutdown()
+        self._reader.shutdown()
+
+
+class IdempotencyCache:
+    """Bounded LRU/TTL cache of processed (correlation_id, message_type) keys.
+
+    Handlers opt in with the `idempotent` decorator. A key only counts as
+    processed once its handler succeeded and, with a store, the key was
+    persisted; if that write fails the delivery fails and is retried.
+    Duplicates arriving while the first delivery is still running wait for
+    its outcome instead of running twice.
+    """
+
+    def __init__(self, service_name: str, max_size: int = Config.IDEMPOTENCY_CACHE_SIZE,
+                 ttl: float = Config.IDEMPOTENCY_TTL, store: Optional[SQLiteProcessedStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        if self.store is None and Config.IDEMPOTENCY_DB_PATH:
+            self.store = SQLiteProcessedStore(Config.IDEMPOTENCY_DB_PATH, ttl)
+        self._processed: "OrderedDict[Key, float]" = OrderedDict()  # key -> expiry, oldest first
+        self._in_flight: Dict[Key, asyncio.Future] = {}
+        self._hits = idempotency_hits.labels(service=service_name)
+        self._misses = idempotency_misses.labels(service=service_name)
+
+    def _seen(self, key: Key) -> bool:
+        expires_at = self._processed.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del self._processed[key]
+            return False
+        return True
+
+    def _remember(self, key: Key):
+        now = time.monotonic()
+        self._processed[key] = now + self.ttl
+        self._processed.move_to_end(key)
+        # every entry shares the same ttl, so the oldest entries expire first
+        while self._processed and (len(self._processed) > self.max_size
+                                   or next(iter(self._processed.values())) < now):
+            self._processed.popitem(last=False)
+
+    async def is_duplicate(self, key: Key) -> bool:
+        while key in self._in_flight:
+            try:
+                await asyncio.shield(self._in_flight[key])
+                return True
+            except Exception:
+                # the first delivery failed, this one gets its turn
+                continue
+        if self._seen(key):
+            return True
+        if self.store and await self.store.contains(key):
+            self._remember(key)
+            return True
+        return False
+
+    def idempotent(self, func: Callable) -> Callable:
+        @wraps(func)
+        async def wrapper(message: Message, *args, **kwargs):
+            key = (message.correlation_id, message.message_type)
+            while True:
+                if await self.is_duplicate(key):
+                    self._hits.inc()
+                    logger.info("duplicate_message_dropped", correlation_id=key[0], message_type=key[1])
+                    return None
+                # another delivery may have started while the store was queried
+                if key not in self._in_flight:
+                    break
+
+            self._misses.inc()
+            done = asyncio.get_running_loop().create_future()
+            self._in_flight[key] = done
+            error: Optional[BaseException] = None
+            try:
+                result = await func(message, *args, **kwargs)
+                if self.store:
+                    await self.store.add(key)
+                self._remember(key)
+                return result
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                del self._in_flight[key]
+                if error is None:
+                    done.set_result(None)
+                else:
+                    done.set_exception(error if isinstance(error, Exception) else RuntimeError("handler cancelled"))
+                    done.exception()  # waiters are optional, don't warn about an unretrieved exception
+        return wrapper
+
+    async def close(self):
+        if self.store:
+            await self.store.close()
@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, TextIO
+
+import structlog
+
+from common.config import Config
+from common.monitoring import log_events_dropped
+
+
+class LogSampler:
+    """structlog processor dropping events before anything else is done with them.
+
+    Events listed in `sample_rates` are kept for that share of orders. The
+    decision hashes the order id, so a sampled order keeps all of its
+    events in every service. Every event name is additionally limited to
+    `rate_limit` events per second.
+    """
+
+    def __init__(self, sample_rates: Dict[str, float] = Config.LOG_SAMPLING,
+                 rate_limit: float = Config.LOG_RATE_LIMIT):
+        self.sample_rates = sample_rates
+        self.rate_limit = rate_limit
+        self._buckets: Dict[str, List[float]] = {}  # event -> [tokens, last refill]
+        self._sampled = log_events_dropped.labels(reason="sampled")
+        self._rate_limited = log_events_dropped.labels(reason="rate_limited")
+
+    def __call__(self, logger, method_name: str, event_dict: dict) -> dict:
+        event = event_dict.get("event")
+        rate = self.sample_rates.get(event)
+        if rate is not None and rate < 1:
+            order_id = event_dict.get("order_id")
+            if order_id is not None:
+                keep = zlib.crc32(str(order_id).encode()) % 10000 < rate * 10000
+            else:
+                keep = random.random() < rate
+            if not keep:
+                self._sampled.inc()
+                raise structlog.DropEvent
+
+        if self.rate_limit and not self._take(event):
+            self._rate_limited.inc()
+            raise structlog.DropEvent
+        return event_dict
+
+    def _take(self, event: str) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(event)
+        if bucket is None:
+            bucket = self._buckets[event] = [self.rate_limit, now]
+        tokens = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+
+class BackgroundSink:
+    """Renders event dicts as JSON lines and writes them from a background thread.
+
+    Logging only costs the caller a put on a bounded queue; when the writer
+    falls behind, new events are dropped and counted instead of blocking.
+    """
+
+    def __init__(self, stream: TextIO = sys.stdout, max_queue: int = Config.LOG_QUEUE_SIZE):
+        self.stream = stream
+        self._queue: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=max_queue)
+        self._queue_full = log_events_dropped.labels(reason="queue_full")
+        self._thread = threading.Thread(target=self._write, name="log-sink", daemon=True)
+        self._thread.start()
+
+    def put(self, event_dict: dict):
+        try:
+            self._queue.put_nowait(event_dict)
+        except queue.Full:
+            self._queue_full.inc()
+
+    @staticmethod
+    def render(event_dict: dict) -> str:
+        event_dict["timestamp"] = datetime.fromtimestamp(event_dict.pop("_logged_at"), timezone.utc).isoformat()
+        return json.dumps(event_dict, default=str, ensure_ascii=False) + "\n"
+
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 512:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for event_dict in batch:
+                if event_dict is None:
+                    self.stream.write("".join(lines))
+                    self.stream.flush()
+                    return
+                try:
+                    lines.append(self.render(event_dict))
+                except Exception as e:
+                    lines.append(json.dumps({"event": "log_render_failed", "error": str(e)}) + "\n")
+            self.stream.write("".join(lines))
+            self.stream.flush()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class QueueLogger:
+    """structlog logger handing the processed event dict to the sink."""
+
+    def __init__(self, sink: BackgroundSink):
+        self._sink = sink
+
+    def msg(self, **event_dict):
+        self._sink.put(event_dict)
+
+    debug = info = warning = warn = error = critical = exception = fatal = msg
+
+
+_sink: Optional[BackgroundSink] = None
+
+
+def configure_logging(service_name: str, level: str = Config.LOG_LEVEL) -> None:
+    """Route structlog and stdlib logging of the service through background writers.
+
+    Only sampling, filtering and capturing tracebacks happen on the caller's
+    thread, JSON rendering and the writes don't. Calling it again is a no-op.
+    """
+    global _sink
+    if _sink is not None:
+        return
+    _sink = BackgroundSink()
+
+    def stamp(logger, method_name: str, event_dict: dict) -> dict:
+        event_dict["_logged_at"] = time.time()
+        event_dict["service"] = service_name
+        return event_dict
+
+    structlog.configure(
+        processors=[
+            structlog.contextvars.merge_contextvars,
+            LogSampler(),
+            structlog.processors.add_log_level,
+            stamp,
+            structlog.processors.format_exc_info,
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(logging.getLevelName(level.upper())),
+        logger_factory=lambda *args: QueueLogger(_sink),
+        cache_logger_on_first_use=True,
+    )
+
+    # libraries logging through the stdlib, like aio_pika, get a queue of their own
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(f'%(asctime)s - {service_name} - %(name)s - %(levelname)s - %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level.upper())
+    listener.start()
+
+    atexit.register(listener.stop)
+    atexit.register(_sink.close)
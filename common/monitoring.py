@@ -1,14 +1,33 @@
-from prometheus_client import Counter, Histogram, make_asgi_app
+from prometheus_client import Counter, Gauge, Histogram, make_asgi_app
 import structlog
+from collections import OrderedDict
 from functools import wraps
 import time
-from typing import Callable
+from typing import Callable, Dict, Tuple
 from fastapi import FastAPI
 
+from common.config import Config
+
 # Prometheus metrics
 message_counter = Counter('processed_messages_total', 'Number of processed messages', ['service', 'message_type', 'status'])
-processing_time = Histogram('message_processing_seconds', 'Time spent processing messages', ['service', 'message_type'])
+processing_time = Histogram('message_processing_seconds', 'Time spent processing messages', ['service', 'message_type'],
+                            buckets=Config.PROCESSING_TIME_BUCKETS)
+message_lag = Histogram('message_lag_seconds', 'Time from publishing a message until its handler started, retries included',
+                        ['service', 'message_type'], buckets=Config.MESSAGE_LAG_BUCKETS)
+saga_latency = Histogram('saga_latency_seconds', 'Time from ORDER_CREATED to INVOICE_CREATED of an order',
+                         buckets=Config.SAGA_LATENCY_BUCKETS)
 error_counter = Counter('processing_errors_total', 'Number of processing errors', ['service', 'error_type'])
+concurrency_limit = Gauge('consumer_concurrency_limit', 'Current adaptive concurrency limit of a consumer', ['service', 'queue'])
+concurrency_in_flight = Gauge('consumer_in_flight_messages', 'Messages currently being handled by a consumer', ['service', 'queue'])
+idempotency_hits = Counter('idempotency_cache_hits_total', 'Duplicate messages dropped before their handler ran', ['service'])
+idempotency_misses = Counter('idempotency_cache_misses_total', 'Messages not seen before', ['service'])
+orders_in_memory = Gauge('orders_in_memory', 'Orders held by the in-memory order store')
+order_history_entries = Gauge('order_history_entries', 'Update history entries held by the in-memory order store')
+orders_evicted = Counter('orders_evicted_total', 'Completed orders evicted from the in-memory order store', ['destination'])
+log_events_dropped = Counter('log_events_dropped_total', 'Log events not written', ['reason'])
+trace_spans_dropped = Counter('trace_spans_dropped_total', 'Spans dropped because the span exporter fell behind')
+shards_owned = Gauge('shards_owned', 'Shards consumed by this replica', ['group'])
+shard_rebalances = Counter('shard_rebalances_total', 'Times the shards owned by this replica changed', ['group'])
 
 
 
@@ -22,29 +41,73 @@ def setup_monitoring(app: FastAPI, service_name: str):
     
     return logger
 
-def monitor_message_processing(service_name: str) -> Callable:
+class SagaTimer:
+    """Observes saga_latency from the timestamps of the first and the last saga message.
+
+    Both timestamps are set by their publishers, so the latency doesn't
+    depend on where it is measured, as long as one service sees both.
+    Start times are kept for at most `max_orders` orders in flight.
+    """
+
+    start_type = "ORDER_CREATED"
+    end_type = "INVOICE_CREATED"
+
+    def __init__(self, max_orders: int = Config.SAGA_TRACKED_ORDERS):
+        self.max_orders = max_orders
+        self._started: "OrderedDict[str, float]" = OrderedDict()
+
+    def observe(self, message):
+        if message.message_type == self.start_type:
+            self._started[message.order_id] = message.timestamp.timestamp()
+            if len(self._started) > self.max_orders:
+                self._started.popitem(last=False)
+        elif message.message_type == self.end_type:
+            started = self._started.pop(message.order_id, None)
+            if started is not None:
+                saga_latency.observe(message.timestamp.timestamp() - started)
+
+
+saga_timer = SagaTimer()
+
+
+def monitor_message_processing(service_name: str, track_saga: bool = False) -> Callable:
+    """Count and time a message handler, whose first argument is the Message.
+
+    Label children are looked up once per message type. With track_saga the
+    handler's messages also feed saga_timer.
+    """
+    children: Dict[str, Tuple] = {}
+    errors: Dict[str, Counter] = {}
+
+    def metrics_of(message_type: str) -> Tuple:
+        metrics = children.get(message_type)
+        if metrics is None:
+            metrics = children[message_type] = (
+                message_counter.labels(service=service_name, message_type=message_type, status='success'),
+                processing_time.labels(service=service_name, message_type=message_type),
+            )
+        return metrics
+
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            start_time = time.time()
+            message = args[0]
+            succeeded, duration = metrics_of(message.message_type)
+            start_time = time.perf_counter()
             try:
                 result = await func(*args, **kwargs)
-                message_counter.labels(
-                    service=service_name,
-                    message_type=args[0].get('message_type', 'unknown'),
-                    status='success'
-                ).inc()
+                succeeded.inc()
+                if track_saga:
+                    saga_timer.observe(message)
                 return result
             except Exception as e:
-                error_counter.labels(
-                    service=service_name,
-                    error_type=type(e).__name__
-                ).inc()
+                error_type = type(e).__name__
+                failed = errors.get(error_type)
+                if failed is None:
+                    failed = errors[error_type] = error_counter.labels(service=service_name, error_type=error_type)
+                failed.inc()
                 raise
             finally:
-                processing_time.labels(
-                    service=service_name,
-                    message_type=args[0].get('message_type', 'unknown')
-                ).observe(time.time() - start_time)
+                duration.observe(time.perf_counter() - start_time)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -1,19 +1,46 @@
+import asyncio
+import time
+import uuid
 import structlog
-from aio_pika import connect_robust, Message as AioPikaMessage, IncomingMessage, ExchangeType
-import json
+from aio_pika import IncomingMessage, ExchangeType
+from pamqp.commands import Basic
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from common.codec import decode_body
+from common.concurrency import AdaptiveLimiter
+from common.config import Config
+from common.monitoring import message_lag
+from common.sharding import shard_of
+from common.tracing import PUBLISHED_AT_HEADER, tracer
+from common.transport import create_transport
+from common.types import Message
 
 logger = structlog.get_logger()
 
+Outgoing = Tuple[str, str, Any, asyncio.Future]  # (exchange, routing key, transport message, confirmation)
+
 
 # RabbitMQ Service
 class RabbitMQService:
-    def __init__(self, service_name: str, connection_url: str):
+    def __init__(self, service_name: str, connection_url: str, transport=None):
         self.service_name = service_name
         self.connection_url = connection_url
+        # AMQP unless Config.TRANSPORT selects the in-process broker
+        self.transport = transport or create_transport()
         self.connection = None
-        self.channel = None
+        self.publish_channel = None  # publishes and topology declarations
+        self.consumer_channels: Dict[str, object] = {}  # one channel per consumed queue
         self.direct_exchange = None
         self.fanout_exchange = None
+        self.dlx_exchange = None
+
+        # Outgoing messages are batched by a background publisher task, every
+        # entry carries a future that resolves once the broker confirmed it
+        self.batch_size = Config.PUBLISH_BATCH_SIZE
+        self.batch_window = Config.PUBLISH_BATCH_WINDOW
+        self._publish_queue: Optional[asyncio.Queue] = None
+        self._publisher_task: Optional[asyncio.Task] = None
+        self._closing = False  # set by close(), the publisher flushes what is queued and stops
 
         self.request_queues = [
             "doener_requests",
@@ -27,39 +54,58 @@ class RabbitMQService:
             "invoice_supplied"
         ]  # queues that exist for each service that consumes them so that ALL consumers get ALL messages
 
+        # queues split into Config.ORDER_SHARDS queues by order id. Request queues
+        # listed here are sharded by their publishers, fanout queues are added
+        # by declare_shards() in the service consuming them by shard
+        self.sharded_queues = ["order_requests"]
+        self.shard_consumers: Dict[str, Tuple[Any, str]] = {}  # physical queue -> (queue, consumer tag)
+        self._in_flight: Dict[str, int] = {}  # physical queue -> messages being handled
+
+        # exclusive queue of this instance, receives the events of the orders
+        # created with reply_to=instance_key and of those it subscribed to
+        self.instance_key = uuid.uuid4().hex[:12]
+        self.instance_id = f"{service_name}.{self.instance_key}"
+        self.private_queue = None
+
     async def initialize(self):
-        self.connection = await connect_robust(self.connection_url)
-        self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=10)
+        self.connection = await self.transport.connect(self.connection_url)
+        self.publish_channel = await self.connection.channel(publisher_confirms=True)
+        self.consumer_channels = {}
 
         # Direct exchange for request queues
-        self.direct_exchange = await self.channel.declare_exchange(
+        self.direct_exchange = await self.publish_channel.declare_exchange(
             "order_requests",
             ExchangeType.DIRECT,
             durable=True
         )
 
-        # Topic exchange for fanout queues
-        self.fanout_exchange = await self.channel.declare_exchange(
+        # Topic exchange for fanout queues, events are published as <event>.<shard>.<order_id>
+        # so that instances can also subscribe to single orders or consume single shards
+        self.fanout_exchange = await self.publish_channel.declare_exchange(
             "order_events",
             ExchangeType.TOPIC,
             durable=True
         )
 
+        # Dead letter exchange, dlq.<queue> queues are bound to it by consume() and declare_shards()
+        self.dlx_exchange = await self.publish_channel.declare_exchange(
+            Config.DLX_EXCHANGE,
+            ExchangeType.DIRECT,
+            durable=True
+        )
+
         # Set up request queues
         for queue_name in self.request_queues:
-            queue = await self.channel.declare_queue(queue_name, durable=True)
+            if queue_name in self.sharded_queues:
+                await self.declare_shards(queue_name)
+                continue
+            queue = await self.publish_channel.declare_queue(queue_name, durable=True)
             await queue.bind(self.direct_exchange, routing_key=queue_name)
 
-        # Set up fanout queues
-        for event_type in self.fanout_queues:
-            queue_name = f"{event_type}.{self.service_name}"
-            queue = await self.channel.declare_queue(
-                queue_name,
-                durable=True,
-                auto_delete=True
-            )
-            await queue.bind(self.fanout_exchange, routing_key=event_type)
+        if self._publisher_task is None or self._publisher_task.done():
+            self._publish_queue = asyncio.Queue()
+            self._closing = False
+            self._publisher_task = asyncio.create_task(self._publisher())
 
     async def ensure_connection(self):
         try:
@@ -69,37 +115,421 @@ class RabbitMQService:
             logger.error("connection_recovery_failed", error=str(e))
             raise
 
-    async def publish(self, queue_name: str, message: dict):
-        await self.ensure_connection()
-        message_body = json.dumps(message).encode()
-        logger.info("publishing_message", queue=queue_name)
+    def publish_nowait(self, queue_name: str, message: Union[Message, dict]) -> asyncio.Future:
+        """Queue a message for the next publish batch.
+
+        Returns a future that resolves once the broker confirmed the message
+        and fails if it was nacked or could not be sent.
+        """
+        exchange_name = "order_requests" if queue_name in self.request_queues else "order_events"
+        routing_key = queue_name
+        if isinstance(message, Message):
+            if exchange_name == "order_events":
+                routing_key = f"{queue_name}.{shard_of(message.order_id)}.{message.order_id}"
+                if message.reply_to:
+                    routing_key = f"{routing_key}.{message.reply_to}"
+            elif queue_name in self.sharded_queues:
+                routing_key = self._physical_queue_name(queue_name, shard_of(message.order_id))
+            headers = message.amqp_headers()
+            # message_lag is measured from here, whether the message is traced or not
+            headers[PUBLISHED_AT_HEADER] = time.time()
+            outgoing = self.transport.message(message, tracer.inject(headers))
+        else:
+            outgoing = self.transport.message(message)
+        return self._enqueue(exchange_name, routing_key, outgoing)
+
+    async def publish(self, queue_name: str, message: Union[Message, dict]):
+        await self.publish_nowait(queue_name, message)
+
+    def _enqueue(self, exchange_name: str, routing_key: str, outgoing) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if self._closing:
+            future.set_exception(RuntimeError("publisher closed"))
+        else:
+            self._publish_queue.put_nowait((exchange_name, routing_key, outgoing, future))
+        return future
+
+    def _exchange(self, exchange_name: str):
+        if exchange_name == "":
+            return self.publish_channel.default_exchange
+        return {
+            "order_requests": self.direct_exchange,
+            "order_events": self.fanout_exchange,
+            Config.DLX_EXCHANGE: self.dlx_exchange,
+        }[exchange_name]
+
+    async def _publisher(self):
+        """Publish queued messages in batches, until close() was called and the queue is empty."""
+        while True:
+            batch = []
+            self._add_to(batch, await self._publish_queue.get())
+            self._drain_into(batch)
+            if batch and len(batch) < self.batch_size and self.batch_window > 0 and not self._closing:
+                # give concurrent handlers a moment to join the batch
+                await asyncio.sleep(self.batch_window)
+                self._drain_into(batch)
+            if batch:
+                await self._flush(batch)
+            if self._closing and self._publish_queue.empty():
+                return
+
+    def _drain_into(self, batch: List[Outgoing]):
+        while len(batch) < self.batch_size and not self._publish_queue.empty():
+            self._add_to(batch, self._publish_queue.get_nowait())
+
+    @staticmethod
+    def _add_to(batch: List[Outgoing], entry: Optional[Outgoing]):
+        if entry is not None:  # None only wakes the publisher up on close
+            batch.append(entry)
+
+    async def _flush(self, batch: List[Outgoing]):
+        try:
+            await self.ensure_connection()
+            # publishes are pipelined on the channel, confirms arrive asynchronously
+            confirmations = await asyncio.gather(
+                *(self._exchange(exchange_name).publish(outgoing, routing_key=routing_key)
+                  for exchange_name, routing_key, outgoing, _ in batch),
+                return_exceptions=True
+            )
+        except Exception as e:
+            confirmations = [e] * len(batch)
+
+        failed = 0
+        for (_, routing_key, _, future), confirmation in zip(batch, confirmations):
+            if future.done():
+                continue
+            if isinstance(confirmation, Exception):
+                future.set_exception(confirmation)
+                failed += 1
+            elif isinstance(confirmation, Basic.Nack):
+                future.set_exception(RuntimeError(f"message to {routing_key} was nacked by the broker"))
+                failed += 1
+            else:
+                future.set_result(confirmation)
+
+        if failed:
+            logger.error("publish_batch_failed", size=len(batch), failed=failed)
+        else:
+            logger.debug("publish_batch_confirmed", size=len(batch))
+
+    def _physical_queue_name(self, queue_name: str, shard: Optional[int] = None) -> str:
         if queue_name in self.request_queues:
-            await self.direct_exchange.publish(
-                AioPikaMessage(body=message_body, delivery_mode=2),
-                routing_key=queue_name
+            physical_queue = queue_name
+        elif queue_name in self.fanout_queues:
+            physical_queue = f"{queue_name}.{self.service_name}"
+        else:
+            return queue_name  # already physical, e.g. order_requests.shard.3
+        return physical_queue if shard is None else f"{physical_queue}.shard.{shard}"
+
+    async def _declare_retry_topology(self, physical_queue: str):
+        """Delay queues dead-lettering back into the queue, and its dlq.<queue>."""
+        for attempt in range(1, Config.MAX_RETRIES + 1):
+            await self.publish_channel.declare_queue(
+                f"{Config.RETRY_QUEUE_PREFIX}{physical_queue}.{attempt}",
+                durable=True,
+                arguments={
+                    "x-message-ttl": int(Config.RETRY_DELAY * 1000 * 2 ** (attempt - 1)),
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": physical_queue,
+                }
             )
+        dlq = await self.publish_channel.declare_queue(f"{Config.DLX_QUEUE_PREFIX}{physical_queue}", durable=True)
+        await dlq.bind(self.dlx_exchange, routing_key=physical_queue)
+
+    async def _retry_or_dead_letter(self, physical_queue: str, message: IncomingMessage, error: Exception,
+                                    on_dead_letter=None):
+        headers = dict(message.headers or {})
+        retries = int(headers.get(Config.RETRY_COUNT_HEADER, 0))
+        headers[Config.RETRY_COUNT_HEADER] = retries + 1
+        headers["x-last-error"] = f"{type(error).__name__}: {error}"[:255]
+
+        if retries < Config.MAX_RETRIES:
+            exchange_name, routing_key = "", f"{Config.RETRY_QUEUE_PREFIX}{physical_queue}.{retries + 1}"
         else:
-            await self.fanout_exchange.publish(
-                AioPikaMessage(body=message_body, delivery_mode=2),
-                routing_key=queue_name
+            exchange_name, routing_key = Config.DLX_EXCHANGE, physical_queue
+
+        try:
+            await self._enqueue(exchange_name, routing_key, self.transport.copy(message, headers))
+        except Exception as e:
+            # never lose the message, let the broker redeliver it instead
+            logger.error("retry_publish_failed", queue=physical_queue, error=str(e))
+            await message.nack(requeue=True)
+            return
+
+        if exchange_name != "" and on_dead_letter is not None:
+            # a failure is only final, and announced, once the retries are used up
+            try:
+                await on_dead_letter(message, error)
+            except Exception as e:
+                logger.error("dead_letter_callback_failed", queue=physical_queue, error=str(e))
+        await message.ack()
+        logger.warning("message_retry_scheduled" if exchange_name == "" else "message_dead_lettered",
+                       queue=physical_queue, retries=retries + 1, error=str(error))
+
+    def _wrap_handler(self, queue_name: str, physical_queue: str, handler, retry: bool = True, on_dead_letter=None):
+        qos = Config.get_consumer_qos(self.service_name, queue_name)
+        lags: Dict[str, Any] = {}  # message type -> message_lag child
+
+        async def traced_handler(message: IncomingMessage):
+            headers = message.headers or {}
+            published_at = headers.get(PUBLISHED_AT_HEADER)
+            if published_at is not None:
+                lag = lags.get(message.type)
+                if lag is None:
+                    lag = lags[message.type] = message_lag.labels(service=self.service_name, message_type=message.type)
+                # stamped with the publisher's wall clock, skew between hosts can make this negative
+                lag.observe(max(time.time() - float(published_at), 0.0))
+            with tracer.consume(queue_name, message.correlation_id, headers,
+                                order_id=headers.get(Message.ORDER_ID_HEADER), message_type=message.type,
+                                retries=headers.get(Config.RETRY_COUNT_HEADER, 0)):
+                await handler(message)
+
+        if qos["adaptive"]:
+            limiter = AdaptiveLimiter(
+                self.service_name,
+                queue_name,
+                initial_limit=qos["concurrency"],
+                min_limit=qos["min_concurrency"],
+                max_limit=qos["max_concurrency"]
             )
+            limited_handler = limiter.wrap(traced_handler)
+        else:
+            limit = asyncio.Semaphore(qos["concurrency"])
+
+            async def limited_handler(message: IncomingMessage):
+                async with limit:
+                    await traced_handler(message)
+
+        async def reliable_handler(message: IncomingMessage):
+            # handlers only raise, acking and retrying is done here
+            try:
+                await limited_handler(message)
+            except Exception as e:
+                if retry:
+                    await self._retry_or_dead_letter(physical_queue, message, e, on_dead_letter)
+                    return
+                logger.error("message_dropped", queue=physical_queue, error=str(e))
+            await message.ack()
+
+        async def counted_handler(message: IncomingMessage):
+            # lets cancel_shard() wait until every delivered message was acked
+            self._in_flight[physical_queue] = self._in_flight.get(physical_queue, 0) + 1
+            try:
+                await reliable_handler(message)
+            finally:
+                self._in_flight[physical_queue] -= 1
+
+        return counted_handler
 
-        logger.info("message_published", queue=queue_name)
+    async def _consumer_channel(self, queue_name: str, physical_queue: Optional[str] = None):
+        # a dedicated channel keeps a burst on one queue from starving the others
+        qos = Config.get_consumer_qos(self.service_name, queue_name)
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=qos["prefetch_count"])
+        self.consumer_channels[physical_queue or queue_name] = channel
+        return channel
 
-    async def consume(self, queue_name: str, handler):
+    async def consume(self, queue_name: str, handler, on_dead_letter=None):
+        """Consume a queue, failed messages are retried and finally dead-lettered.
+
+        `on_dead_letter(message, error)` runs once a message was moved to its
+        dlq, that is where services announce that a saga step failed.
+        """
         try:
             await self.ensure_connection()
+            channel = await self._consumer_channel(queue_name)
+
+            physical_queue = self._physical_queue_name(queue_name)
             if queue_name in self.request_queues:
-                queue = await self.channel.declare_queue(queue_name, passive=True)
+                queue = await channel.declare_queue(physical_queue, passive=True)
             else:
-                queue = await self.channel.declare_queue(
-                    f"{queue_name}.{self.service_name}",
-                    passive=True
-                )
-            await queue.consume(handler)
+                # only services that consume an event get a queue for it
+                queue = await channel.declare_queue(physical_queue, durable=True, auto_delete=True)
+                await queue.bind(self.fanout_exchange, routing_key=f"{queue_name}.#")
+            await self._declare_retry_topology(physical_queue)
+
+            await queue.consume(self._wrap_handler(queue_name, physical_queue, handler, on_dead_letter=on_dead_letter))
+            logger.info("consuming_queue", queue=queue_name, **Config.get_consumer_qos(self.service_name, queue_name))
         except Exception as e:
-            logger.error("error consuming queue", queue=queue_name)
+            logger.error("error consuming queue", queue=queue_name, error=str(e))
+
+    async def _declare_shard(self, channel, queue_name: str, shard: int):
+        physical_queue = self._physical_queue_name(queue_name, shard)
+        # durable so that a shard keeps its messages while no replica owns it
+        queue = await channel.declare_queue(physical_queue, durable=True,
+                                            arguments={"x-single-active-consumer": True})
+        if queue_name in self.request_queues:
+            await queue.bind(self.direct_exchange, routing_key=physical_queue)
+        else:
+            await queue.bind(self.fanout_exchange, routing_key=f"{queue_name}.{shard}.#")
+        return queue
+
+    async def declare_shards(self, queue_name: str):
+        """Declare every shard queue of a queue and its dlq, messages are kept from then on even if nobody consumes."""
+        if queue_name not in self.sharded_queues:
+            self.sharded_queues.append(queue_name)
+        for shard in range(Config.ORDER_SHARDS):
+            await self._declare_shard(self.publish_channel, queue_name, shard)
+            await self._declare_retry_topology(self._physical_queue_name(queue_name, shard))
+
+    async def consume_shard(self, queue_name: str, shard: int, handler, on_dead_letter=None):
+        """Consume one shard of a queue, see common.sharding.ShardCoordinator.
+
+        Every shard gets its own channel with the QoS configured for the queue.
+        """
+        await self.ensure_connection()
+        physical_queue = self._physical_queue_name(queue_name, shard)
+        if physical_queue in self.shard_consumers:
+            return
+        channel = await self._consumer_channel(queue_name, physical_queue)
+        queue = await self._declare_shard(channel, queue_name, shard)
+        await self._declare_retry_topology(physical_queue)
+        consumer_tag = await queue.consume(
+            self._wrap_handler(queue_name, physical_queue, handler, on_dead_letter=on_dead_letter))
+        self.shard_consumers[physical_queue] = (queue, consumer_tag)
+        logger.info("consuming_shard", queue=physical_queue)
+
+    async def cancel_shard(self, queue_name: str, shard: int):
+        """Stop consuming a shard once the messages already delivered are handled."""
+        physical_queue = self._physical_queue_name(queue_name, shard)
+        if physical_queue not in self.shard_consumers:
+            return
+        queue, consumer_tag = self.shard_consumers.pop(physical_queue)
+        await queue.cancel(consumer_tag)
+        deadline = asyncio.get_running_loop().time() + Config.SHARD_DRAIN_TIMEOUT
+        while self._in_flight.get(physical_queue) and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        # anything still unacked goes back to the shard for its next owner
+        await self.consumer_channels.pop(physical_queue).close()
+        logger.info("shard_cancelled", queue=physical_queue, unfinished=self._in_flight.pop(physical_queue, 0))
+
+    async def consume_private(self, handler):
+        """Consume this instance's exclusive queue.
+
+        It receives the events of every order published with
+        reply_to=instance_key through a single binding, and those of the
+        orders passed to subscribe_order(). Messages of the private queue are
+        not retried, the queue and its bindings disappear together with the
+        instance.
+        """
+        await self.ensure_connection()
+        channel = await self._consumer_channel("private")
+        self.private_queue = await channel.declare_queue(self.instance_id, exclusive=True, auto_delete=True)
+        # <event>.<shard>.<order id>.<reply to>
+        await self.private_queue.bind(self.fanout_exchange, routing_key=f"*.*.*.{self.instance_key}")
+        await self.private_queue.consume(self._wrap_handler("private", self.instance_id, handler, retry=False))
+        logger.info("consuming_private_queue", queue=self.instance_id)
+
+    async def consume_events(self, name: str, handler, event_types: Optional[List[str]] = None):
+        """Consume every order event, or those of `event_types`, on an exclusive queue of this instance.
+
+        Unlike consume(), replicas don't compete for the events, each one
+        gets all of them. Nothing is retried and events published while the
+        instance is down are not kept.
+        """
+        await self.ensure_connection()
+        channel = await self._consumer_channel(name)
+        physical_queue = f"{self.instance_id}.{name}"
+        queue = await channel.declare_queue(physical_queue, exclusive=True, auto_delete=True)
+        for event_type in event_types or self.fanout_queues:
+            await queue.bind(self.fanout_exchange, routing_key=f"{event_type}.#")
+        await queue.consume(self._wrap_handler(name, physical_queue, handler, retry=False))
+        logger.info("consuming_events", queue=physical_queue)
+
+    def broadcast(self, topic: str, body: dict) -> asyncio.Future:
+        """Publish to every instance consuming the topic with consume_broadcast()."""
+        return self._enqueue("order_events", topic, self.transport.message(body))
+
+    async def consume_broadcast(self, topic: str, handler):
+        """Consume a broadcast topic on an exclusive queue of this instance, nothing is retried."""
+        await self.ensure_connection()
+        channel = await self._consumer_channel(topic)
+        physical_queue = f"{self.instance_id}.{topic}"
+        queue = await channel.declare_queue(physical_queue, exclusive=True, auto_delete=True)
+        await queue.bind(self.fanout_exchange, routing_key=topic)
+        await queue.consume(self._wrap_handler(topic, physical_queue, handler, retry=False))
+
+    def _order_routing_keys(self, order_id: str) -> List[str]:
+        shard = shard_of(order_id)
+        return [f"{event_type}.{shard}.{order_id}.#" for event_type in self.fanout_queues]
+
+    async def subscribe_order(self, order_id: str):
+        """Route every event of an order created on another instance to this instance's private queue."""
+        for routing_key in self._order_routing_keys(order_id):
+            await self.private_queue.bind(self.fanout_exchange, routing_key=routing_key)
+
+    async def unsubscribe_order(self, order_id: str):
+        for routing_key in self._order_routing_keys(order_id):
+            await self.private_queue.unbind(self.fanout_exchange, routing_key=routing_key)
+
+    def _dead_lettered_queues(self, queue_name: str, shard: Optional[int] = None) -> List[str]:
+        """Physical queues whose dlq holds the dead letters of a queue, every shard of a sharded one."""
+        if shard is not None:
+            return [self._physical_queue_name(queue_name, shard)]
+        if queue_name in self.sharded_queues:
+            return [self._physical_queue_name(queue_name, shard) for shard in range(Config.ORDER_SHARDS)]
+        return [self._physical_queue_name(queue_name)]
+
+    async def inspect_dlq(self, queue_name: str, limit: int = 10, shard: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Peek at up to `limit` dead-lettered messages of a queue, or of one shard of it, without removing them."""
+        await self.ensure_connection()
+        channel = await self.connection.channel()
+        messages = []
+        try:
+            for physical_queue in self._dead_lettered_queues(queue_name, shard):
+                dlq = await channel.declare_queue(f"{Config.DLX_QUEUE_PREFIX}{physical_queue}", passive=True)
+                while len(messages) < limit:
+                    message = await dlq.get(no_ack=False, fail=False)
+                    if message is None:
+                        break
+                    try:
+                        body = decode_body(message.body, message.content_type)
+                    except Exception:
+                        body = message.body.decode("utf-8", errors="replace")
+                    messages.append({"queue": physical_queue, "headers": dict(message.headers or {}), "body": body})
+                if len(messages) >= limit:
+                    break
+            return messages
+        finally:
+            # closing the channel hands every unacked message back to its dlq
+            await channel.close()
+
+    async def replay_dlq(self, queue_name: str, limit: Optional[int] = None, shard: Optional[int] = None) -> int:
+        """Move dead-lettered messages back onto their queue, or shard, with a fresh retry budget."""
+        await self.ensure_connection()
+        channel = await self.connection.channel()
+        replayed = 0
+        try:
+            for physical_queue in self._dead_lettered_queues(queue_name, shard):
+                dlq = await channel.declare_queue(f"{Config.DLX_QUEUE_PREFIX}{physical_queue}", passive=True)
+                count = 0
+                while limit is None or replayed < limit:
+                    message = await dlq.get(no_ack=False, fail=False)
+                    if message is None:
+                        break
+                    headers = dict(message.headers or {})
+                    headers.pop(Config.RETRY_COUNT_HEADER, None)
+                    await self._enqueue("", physical_queue, self.transport.copy(message, headers))
+                    await message.ack()
+                    count += 1
+                    replayed += 1
+                if count:
+                    logger.info("dlq_replayed", queue=physical_queue, count=count)
+        finally:
+            await channel.close()
+        return replayed
 
     async def close(self):
+        if self._publisher_task:
+            # let the publisher finish its batch and flush whatever is still queued
+            # before tearing down the channel
+            self._closing = True
+            self._publish_queue.put_nowait(None)
+            await asyncio.gather(self._publisher_task, return_exceptions=True)
+            self._publisher_task = None
+            while not self._publish_queue.empty():
+                entry = self._publish_queue.get_nowait()
+                if entry is not None and not entry[3].done():
+                    entry[3].set_exception(RuntimeError("publisher closed"))
         if self.connection:
             await self.connection.close()
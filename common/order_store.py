@@ -0,0 +1,372 @@
+import asyncio
+import bisect
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import structlog
+
+from common.codec import JsonCodec
+from common.config import Config
+from common.monitoring import orders_in_memory, order_history_entries, orders_evicted
+from common.types import OrderStatus
+
+logger = structlog.get_logger()
+
+json_codec = JsonCodec()
+
+TERMINAL_STATUSES = (OrderStatus.INVOICED.value, OrderStatus.FAILED.value)
+
+
+class InMemoryOrderStore:
+    """Orders in a process local dict, lost on restart.
+
+    Secondary indexes are lists of (created_at, order_id) keys kept sorted
+    with bisect, so filtered pages start with a binary search instead of a
+    scan over every order.
+
+    Memory stays bounded: each order keeps its last `history_limit` updates
+    in a deque, and orders that reached INVOICED or FAILED are evicted
+    `retention_ttl` seconds later, into `archive` if one is given. The TTL is
+    the same for every order, so expiries are queued in completion order and
+    every write only pops the due ones off the front.
+    """
+
+    def __init__(self, latency: float = Config.ORDER_DB_LATENCY,
+                 history_limit: int = Config.ORDER_HISTORY_LIMIT,
+                 retention_ttl: float = Config.ORDER_RETENTION_TTL,
+                 archive: Optional["SQLiteOrderStore"] = None):
+        self.latency = latency  # simulated round trip of a remote database
+        self.history_limit = history_limit
+        self.retention_ttl = retention_ttl
+        self.archive = archive
+        self.orders: Dict[str, Dict] = {}
+        self.expiries: deque = deque()  # (deadline, order_id), oldest first
+        self.history_entries = 0
+        self.by_created: List[Tuple[str, str]] = []
+        self.by_status: Dict[str, List[Tuple[str, str]]] = {}
+        self.by_customer: Dict[str, List[Tuple[str, str]]] = {}
+
+    @staticmethod
+    def _key(order_id: str, order: Dict) -> Tuple[str, str]:
+        return order.get("created_at"), order_id
+
+    @staticmethod
+    def _remove(index: List[Tuple[str, str]], key: Tuple[str, str]):
+        position = bisect.bisect_left(index, key)
+        if position < len(index) and index[position] == key:
+            del index[position]
+
+    def _index(self, order_id: str, order: Dict):
+        key = self._key(order_id, order)
+        bisect.insort(self.by_created, key)
+        bisect.insort(self.by_status.setdefault(order.get("status"), []), key)
+        bisect.insort(self.by_customer.setdefault(order.get("customer_id"), []), key)
+
+    def _unindex(self, order_id: str, order: Dict):
+        key = self._key(order_id, order)
+        self._remove(self.by_created, key)
+        self._remove(self.by_status.get(order.get("status"), []), key)
+        self._remove(self.by_customer.get(order.get("customer_id"), []), key)
+
+    def _schedule_expiry(self, order_id: str, order: Dict):
+        if order.get("status") in TERMINAL_STATUSES:
+            self.expiries.append((time.monotonic() + self.retention_ttl, order_id))
+
+    async def _expire(self):
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            _, order_id = self.expiries.popleft()
+            order = self.orders.get(order_id)
+            # orders that left their terminal state in the meantime stay
+            if order is None or order.get("status") not in TERMINAL_STATUSES:
+                continue
+            self._unindex(order_id, order)
+            del self.orders[order_id]
+            self.history_entries -= len(order["updates"])
+            if self.archive is not None:
+                await self.archive.create(order_id, order)
+                orders_evicted.labels(destination="archive").inc()
+            else:
+                orders_evicted.labels(destination="dropped").inc()
+        orders_in_memory.set(len(self.orders))
+        order_history_entries.set(self.history_entries)
+
+    async def create(self, order_id: str, order: Dict) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if order_id in self.orders:
+            previous = self.orders[order_id]
+            self._unindex(order_id, previous)
+            self.history_entries -= len(previous["updates"])
+        order["updates"] = deque(order.get("updates", ()), maxlen=self.history_limit)
+        self.history_entries += len(order["updates"])
+        self.orders[order_id] = order
+        self._index(order_id, order)
+        self._schedule_expiry(order_id, order)
+        await self._expire()
+
+    async def update(self, order_id: str, data: Dict, update: Dict) -> bool:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        order = self.orders.get(order_id)
+        if order is None:
+            return False
+        old_status = order.get("status")
+        order.update(data)
+        updates = order["updates"]
+        if len(updates) < updates.maxlen:
+            self.history_entries += 1
+        updates.append(update)
+        if order.get("status") != old_status:
+            key = self._key(order_id, order)
+            self._remove(self.by_status.get(old_status, []), key)
+            bisect.insort(self.by_status.setdefault(order.get("status"), []), key)
+            self._schedule_expiry(order_id, order)
+        await self._expire()
+        return True
+
+    async def get(self, order_id: str) -> Optional[Dict]:
+        order = self.orders.get(order_id)
+        if order is None and self.archive is not None:
+            return await self.archive.get(order_id)
+        return order
+
+    async def all(self) -> Dict[str, Dict]:
+        return self.orders
+
+    async def find_by_status(self, status: str) -> List[Dict]:
+        return [self.orders[order_id] for _, order_id in self.by_status.get(status, ())]
+
+    async def find_by_customer(self, customer_id: str) -> List[Dict]:
+        return [self.orders[order_id] for _, order_id in self.by_customer.get(customer_id, ())]
+
+    async def query(self, status: Optional[str] = None, customer_id: Optional[str] = None,
+                    created_after: Optional[str] = None, created_before: Optional[str] = None,
+                    cursor: Optional[Tuple[str, str]] = None, limit: int = 100) -> List[Dict]:
+        """Orders matching all filters, ordered by (created_at, order_id) and starting after `cursor`."""
+        # walk the narrowest index, customers usually have far fewer orders than a status
+        if customer_id is not None:
+            index = self.by_customer.get(customer_id, [])
+        elif status is not None:
+            index = self.by_status.get(status, [])
+        else:
+            index = self.by_created
+
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(index, tuple(cursor))
+        if created_after is not None:
+            start = max(start, bisect.bisect_left(index, (created_after, "")))
+
+        page = []
+        for position in range(start, len(index)):
+            created_at, order_id = index[position]
+            if created_before is not None and created_at >= created_before:
+                break
+            order = self.orders[order_id]
+            if status is not None and order.get("status") != status:
+                continue
+            page.append(order)
+            if len(page) >= limit:
+                break
+        return page
+
+    async def close(self) -> None:
+        if self.archive is not None:
+            await self.archive.close()
+
+
+class SQLiteOrderStore:
+    """Orders in SQLite (WAL mode) with indexes on status and customer_id.
+
+    All writes go through one writer thread. Writes queued while a
+    transaction is being committed are grouped into the next transaction, so
+    concurrent handlers share a single fsync. Reads run on their own
+    connection and thread, which WAL lets proceed next to the writer.
+    """
+
+    def __init__(self, path: str = Config.ORDER_DB_PATH, max_batch: int = 500,
+                 history_limit: int = Config.ORDER_HISTORY_LIMIT):
+        self.path = path
+        self.history_limit = history_limit
+        self.max_batch = max_batch
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="order-store-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="order-store-reader")
+        self._write_conn = self._connect()
+        self._write_conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id TEXT PRIMARY KEY,
+                status TEXT,
+                customer_id TEXT,
+                created_at TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, order_id);
+            CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at, order_id);
+            CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders (customer_id, created_at, order_id);
+        """)
+        self._read_conn = self._connect()
+        self._pending: Optional[asyncio.Queue] = None
+        self._commit_task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    async def _write(self, operation: Callable[[sqlite3.Connection], object]):
+        if self._commit_task is None:
+            self._pending = asyncio.Queue()
+            self._commit_task = asyncio.create_task(self._group_commit())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait((operation, future))
+        return await future
+
+    async def _group_commit(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._pending.get()]
+            while len(batch) < self.max_batch and not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+            try:
+                results = await loop.run_in_executor(self._writer, self._commit_batch, batch)
+            except Exception as e:
+                logger.error("order_store_commit_failed", error=str(e), size=len(batch))
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _commit_batch(self, batch) -> List[object]:
+        conn = self._write_conn
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for operation, _ in batch:
+                # a failing write only rolls back itself, not the whole group
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append(operation(conn))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append(e)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+
+    async def _read(self, query: Callable[[sqlite3.Connection], object]):
+        return await asyncio.get_running_loop().run_in_executor(self._reader, query, self._read_conn)
+
+    @staticmethod
+    def _row(order: Dict):
+        return (order.get("status"), order.get("customer_id"), order.get("created_at"), json_codec.encode(order))
+
+    async def create(self, order_id: str, order: Dict) -> None:
+        row = self._row(order)
+
+        def insert(conn: sqlite3.Connection):
+            conn.execute(
+                "INSERT OR REPLACE INTO orders (order_id, status, customer_id, created_at, data) "
+                "VALUES (?, ?, ?, ?, ?)", (order_id, *row)
+            )
+
+        await self._write(insert)
+
+    async def update(self, order_id: str, data: Dict, update: Dict) -> bool:
+        def merge(conn: sqlite3.Connection) -> bool:
+            found = conn.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if found is None:
+                return False
+            order = json_codec.decode(found[0])
+            order.update(data)
+            order["updates"] = [*order["updates"], update][-self.history_limit:]
+            status, customer_id, _, encoded = self._row(order)
+            conn.execute(
+                "UPDATE orders SET status = ?, customer_id = ?, data = ? WHERE order_id = ?",
+                (status, customer_id, encoded, order_id)
+            )
+            return True
+
+        return await self._write(merge)
+
+    async def get(self, order_id: str) -> Optional[Dict]:
+        row = await self._read(
+            lambda conn: conn.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        )
+        return json_codec.decode(row[0]) if row else None
+
+    async def _select(self, where: str = "", params: tuple = ()) -> List[Dict]:
+        rows = await self._read(
+            lambda conn: conn.execute(f"SELECT data FROM orders {where} ORDER BY created_at", params).fetchall()
+        )
+        return [json_codec.decode(row[0]) for row in rows]
+
+    async def all(self) -> Dict[str, Dict]:
+        return {order["order_id"]: order for order in await self._select()}
+
+    async def find_by_status(self, status: str) -> List[Dict]:
+        return await self._select("WHERE status = ?", (status,))
+
+    async def find_by_customer(self, customer_id: str) -> List[Dict]:
+        return await self._select("WHERE customer_id = ?", (customer_id,))
+
+    async def query(self, status: Optional[str] = None, customer_id: Optional[str] = None,
+                    created_after: Optional[str] = None, created_before: Optional[str] = None,
+                    cursor: Optional[Tuple[str, str]] = None, limit: int = 100) -> List[Dict]:
+        """Orders matching all filters, ordered by (created_at, order_id) and starting after `cursor`."""
+        conditions, params = [], []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if customer_id is not None:
+            conditions.append("customer_id = ?")
+            params.append(customer_id)
+        if created_after is not None:
+            conditions.append("created_at >= ?")
+            params.append(created_after)
+        if created_before is not None:
+            conditions.append("created_at < ?")
+            params.append(created_before)
+        if cursor is not None:
+            conditions.append("(created_at, order_id) > (?, ?)")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = await self._read(
+            lambda conn: conn.execute(
+                f"SELECT data FROM orders {where} ORDER BY created_at, order_id LIMIT ?", (*params, limit)
+            ).fetchall()
+        )
+        return [json_codec.decode(row[0]) for row in rows]
+
+    async def close(self) -> None:
+        if self._commit_task:
+            while not self._pending.empty():
+                await asyncio.sleep(0)
+            self._commit_task.cancel()
+            self._commit_task = None
+        self._writer.submit(self._write_conn.close).result()
+        self._reader.submit(self._read_conn.close).result()
+        self._writer.shutdown()
+        self._reader.shutdown()
+
+
+def create_order_store():
+    """Order store selected by Config.ORDER_STORE."""
+    if Config.ORDER_STORE == "memory":
+        archive = SQLiteOrderStore(Config.ORDER_ARCHIVE_PATH) if Config.ORDER_ARCHIVE_PATH else None
+        return InMemoryOrderStore(archive=archive)
+    if Config.ORDER_STORE == "sqlite":
+        return SQLiteOrderStore()
+    raise ValueError(f"Unknown order store: {Config.ORDER_STORE}")
@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import time
+import zlib
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+import structlog
+
+from common.codec import decode_body
+from common.config import Config
+from common.monitoring import shard_rebalances, shards_owned
+
+logger = structlog.get_logger()
+
+
+def shard_of(order_id: str, shards: int = Config.ORDER_SHARDS) -> int:
+    """Shard of an order, the same in every service and process."""
+    return zlib.crc32(order_id.encode()) % shards
+
+
+def owner_of(shard: int, members: Iterable[str]) -> str:
+    """Rendezvous hashing, a member leaving only moves its own shards and one joining takes about 1/n.
+
+    crc32 won't do here, it is linear and member ids share their prefix,
+    so one member would win every shard.
+    """
+    return max(members, key=lambda member: hashlib.blake2b(f"{shard}:{member}".encode(), digest_size=8).digest())
+
+
+class ShardCoordinator:
+    """Spreads the shards of a group of replicas over the replicas alive.
+
+    Replicas broadcast heartbeats over the broker and every one of them
+    computes the same assignment from the members it heard of. Whenever a
+    replica joins, leaves or misses three heartbeats, shards that moved are
+    handed to `revoke` on their old owner and to `assign` on the new one.
+    Shard queues have a single active consumer, so while replicas still
+    disagree during a handover the broker keeps delivering a shard to one.
+    """
+
+    def __init__(self, mq_service, group: str,
+                 assign: Callable[[int], Awaitable[None]], revoke: Callable[[int], Awaitable[None]],
+                 shards: int = Config.ORDER_SHARDS, heartbeat_interval: float = Config.SHARD_HEARTBEAT_INTERVAL):
+        self.mq_service = mq_service
+        self.group = group
+        self.member_id = mq_service.instance_id
+        self.assign = assign
+        self.revoke = revoke
+        self.shards = shards
+        self.heartbeat_interval = heartbeat_interval
+        self.topic = f"members.{group}"
+        self.members: Dict[str, float] = {}  # member id -> monotonic time of its last heartbeat
+        self.owned: Set[int] = set()
+        self._changed = asyncio.Event()
+        self._tasks = []
+        self._owned_gauge = shards_owned.labels(group=group)
+        self._owned_gauge.set_function(lambda: len(self.owned))
+
+    async def start(self):
+        """Join the group, shards are taken once the replicas already running had time to answer."""
+        self.members[self.member_id] = time.monotonic()
+        await self.mq_service.consume_broadcast(self.topic, self._on_message)
+        await self._announce("alive")
+        self._tasks = [asyncio.create_task(self._heartbeat()), asyncio.create_task(self._rebalancer())]
+
+    async def close(self):
+        """Hand every owned shard back and tell the others to take them over."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for shard in sorted(self.owned):
+            await self.revoke(shard)
+        self.owned = set()
+        await self._announce("leaving")
+        logger.info("shard_group_left", group=self.group, member=self.member_id)
+
+    def _announce(self, state: str) -> asyncio.Future:
+        return self.mq_service.broadcast(self.topic, {"member_id": self.member_id, "state": state})
+
+    async def _on_message(self, message):
+        body = decode_body(message.body, message.content_type)
+        member_id = body["member_id"]
+        if member_id == self.member_id:
+            return
+        if body["state"] == "leaving":
+            if self.members.pop(member_id, None) is not None:
+                logger.info("shard_member_left", group=self.group, member=member_id)
+                self._changed.set()
+            return
+        joined = member_id not in self.members
+        self.members[member_id] = time.monotonic()
+        if joined:
+            logger.info("shard_member_joined", group=self.group, member=member_id)
+            # the new replica learns about this one without waiting for a heartbeat
+            await self._announce("alive")
+            self._changed.set()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            self.members[self.member_id] = now
+            try:
+                await self._announce("alive")
+            except Exception as e:
+                logger.error("shard_heartbeat_failed", group=self.group, error=str(e))
+            expired = [member for member, seen in self.members.items()
+                       if now - seen > 3 * self.heartbeat_interval]
+            for member in expired:
+                del self.members[member]
+                logger.warning("shard_member_expired", group=self.group, member=member)
+            if expired:
+                self._changed.set()
+
+    async def _rebalancer(self):
+        await asyncio.sleep(self.heartbeat_interval)
+        self._changed.set()
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error("shard_rebalance_failed", group=self.group, error=str(e))
+                await asyncio.sleep(self.heartbeat_interval)
+                self._changed.set()
+
+    def assignment(self, members: Optional[Iterable[str]] = None) -> Set[int]:
+        """Shards this replica owns when `members` are alive."""
+        members = list(members if members is not None else self.members)
+        return {shard for shard in range(self.shards) if owner_of(shard, members) == self.member_id}
+
+    async def rebalance(self):
+        wanted = self.assignment()
+        revoked, assigned = self.owned - wanted, wanted - self.owned
+        if not revoked and not assigned:
+            return
+        # give shards away first, their new owners are waiting for them
+        for shard in sorted(revoked):
+            await self.revoke(shard)
+            self.owned.discard(shard)
+        for shard in sorted(assigned):
+            await self.assign(shard)
+            self.owned.add(shard)
+        shard_rebalances.labels(group=self.group).inc()
+        logger.info("shards_rebalanced", group=self.group, members=len(self.members),
+                    owned=sorted(self.owned), assigned=sorted(assigned), revoked=sorted(revoked))
@@ -0,0 +1,190 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import structlog
+
+from common.config import Config
+from common.monitoring import trace_spans_dropped
+
+logger = structlog.get_logger()
+
+# trace context travelling with every published message, the trace id is the correlation id
+PARENT_SPAN_HEADER = "x-parent-span-id"
+PUBLISHED_AT_HEADER = "x-published-at"
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "service", "start", "duration", "attributes")
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, service: str,
+                 start: float, attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.service = service
+        self.start = start
+        self.duration = 0.0
+        self.attributes = attributes
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": self.service,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class FileSpanExporter:
+    """Appends finished spans as JSON lines, written by a background thread off the event loop.
+
+    Spans wait on a bounded queue; when the writer falls behind, new spans
+    are dropped and counted instead of piling up in memory.
+    """
+
+    def __init__(self, path: str, max_queue: int = Config.TRACE_QUEUE_SIZE):
+        self.path = path
+        self._spans: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._write, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span):
+        try:
+            self._spans.put_nowait(span)
+        except queue.Full:
+            trace_spans_dropped.inc()
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                span = self._spans.get()
+                if span is None:
+                    return
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+                if self._spans.empty():
+                    f.flush()
+
+    def close(self):
+        self._spans.put(None)
+        self._thread.join(timeout=5)
+
+
+class Tracer:
+    """Spans of the saga, keyed by the correlation id of its messages.
+
+    The current span lives in a context variable, so spans opened inside a
+    handler become its children and publishes made there carry its id in
+    their headers. Whole traces are sampled by their id, every service
+    decides the same way.
+    """
+
+    def __init__(self, service_name: str, exporter: Optional[FileSpanExporter] = None,
+                 sample_rate: float = Config.TRACE_SAMPLE_RATE):
+        self.service_name = service_name
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+    def sampled(self, trace_id: Optional[str]) -> bool:
+        if self.exporter is None or not trace_id:
+            return False
+        return zlib.crc32(trace_id.encode()) % 10000 < self.sample_rate * 10000
+
+    @contextmanager
+    def span(self, name: str, trace_id: Optional[str] = None, parent_id: Optional[str] = None,
+             **attributes) -> Iterator[Optional[Span]]:
+        """Time the block as a span, a child of the current one unless a trace id is given."""
+        current = self._current.get()
+        if trace_id is None and current is not None:
+            trace_id, parent_id = current.trace_id, current.span_id
+        if not self.sampled(trace_id):
+            yield None
+            return
+
+        span = Span(trace_id, parent_id, name, self.service_name, time.time(), attributes)
+        started = time.perf_counter()
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            self._current.reset(token)
+            self.exporter.export(span)
+
+    def record(self, name: str, trace_id: str, parent_id: Optional[str], start: float, end: float,
+               **attributes) -> Optional[Span]:
+        """Export a span that already ended, e.g. the time a message spent queued."""
+        if not self.sampled(trace_id):
+            return None
+        span = Span(trace_id, parent_id, name, self.service_name, start, attributes)
+        span.duration = max(end - start, 0.0)
+        self.exporter.export(span)
+        return span
+
+    @contextmanager
+    def consume(self, queue_name: str, trace_id: Optional[str], headers: Dict[str, Any],
+                **attributes) -> Iterator[Optional[Span]]:
+        """Continue the trace of a received message: a span for its time in the queue, then one for the handler."""
+        parent_id = headers.get(PARENT_SPAN_HEADER)
+        published_at = headers.get(PUBLISHED_AT_HEADER)
+        if published_at is not None:
+            queued = self.record(f"queue {queue_name}", trace_id, parent_id, float(published_at), time.time())
+            if queued is not None:
+                parent_id = queued.span_id
+        with self.span(f"handle {queue_name}", trace_id, parent_id, **attributes) as span:
+            yield span
+
+    def inject(self, headers: Dict[str, Any]) -> Dict[str, Any]:
+        """Add the trace context of the current span to outgoing message headers.
+
+        The publish time the queue span starts at is stamped by the publisher
+        on every message.
+        """
+        current = self._current.get()
+        if current is not None:
+            headers[PARENT_SPAN_HEADER] = current.span_id
+        return headers
+
+    def traced(self, name: str) -> Callable:
+        """Run a coroutine function in a span, inside the current trace only."""
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if self._current.get() is None:
+                    return await func(*args, **kwargs)
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+
+
+def create_tracer(service_name: str = Config.SERVICE_NAME) -> Tracer:
+    exporter = None
+    if Config.TRACE_DIR:
+        exporter = FileSpanExporter(os.path.join(Config.TRACE_DIR, f"{service_name}.jsonl"))
+    return Tracer(service_name, exporter)
+
+
+tracer = create_tracer()
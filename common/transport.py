@@ -0,0 +1,425 @@
+import asyncio
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+
+from aio_pika import connect_robust, Message as AioPikaMessage, DeliveryMode
+from aio_pika.exceptions import QueueEmpty
+from aiormq.exceptions import ChannelNotFoundEntity
+
+from common.codec import get_codec
+from common.config import Config
+from common.types import Message
+
+
+class AmqpTransport:
+    """RabbitMQ through aio_pika, messages travel encoded with the configured codec."""
+
+    name = "amqp"
+
+    async def connect(self, url: str):
+        return await connect_robust(url)
+
+    def message(self, message: Union[Message, dict], headers: Optional[Dict[str, Any]] = None) -> AioPikaMessage:
+        codec = get_codec()
+        if isinstance(message, Message):
+            body, content_type = message.encoded_body(codec)
+            return AioPikaMessage(
+                body=body,
+                content_type=content_type,
+                correlation_id=message.correlation_id,
+                reply_to=message.reply_to,
+                type=message.message_type,
+                headers=headers,
+                delivery_mode=DeliveryMode.PERSISTENT
+            )
+        return AioPikaMessage(
+            body=codec.encode(message),
+            content_type=codec.content_type,
+            delivery_mode=DeliveryMode.PERSISTENT
+        )
+
+    def copy(self, incoming, headers: Dict[str, Any]) -> AioPikaMessage:
+        """Republishable copy of a received message with other headers."""
+        return AioPikaMessage(
+            body=incoming.body,
+            headers=headers,
+            content_type=incoming.content_type,
+            correlation_id=incoming.correlation_id,
+            reply_to=incoming.reply_to,
+            type=incoming.type,
+            delivery_mode=DeliveryMode.PERSISTENT
+        )
+
+
+# In-memory broker
+class LocalMessage:
+    """A message in the in-memory broker: the published object itself, not its bytes.
+
+    Every queue the message is routed to shares the same object, handlers
+    must treat it as read-only. The body is only encoded when something
+    asks for it, e.g. a dead letter queue being inspected.
+    """
+
+    __slots__ = ("message", "headers", "content_type", "correlation_id", "type", "_body")
+
+    def __init__(self, message: Union[Message, dict, None], headers: Optional[Dict[str, Any]] = None,
+                 correlation_id: Optional[str] = None, type: Optional[str] = None,
+                 body: Optional[bytes] = None, content_type: Optional[str] = None):
+        self.message = message
+        self.headers = headers or {}
+        self.correlation_id = correlation_id
+        self.type = type
+        self._body = body
+        self.content_type = content_type
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            codec = get_codec()
+            if isinstance(self.message, Message):
+                self._body, self.content_type = self.message.encoded_body(codec)
+            else:
+                self._body, self.content_type = codec.encode(self.message), codec.content_type
+        return self._body
+
+    @property
+    def reply_to(self) -> Optional[str]:
+        return self.message.reply_to if isinstance(self.message, Message) else None
+
+
+class LocalDelivery:
+    """One delivery of a LocalMessage to a consumer, settled with ack() or nack()."""
+
+    __slots__ = ("_message", "_queue", "_consumer", "_channel")
+
+    def __init__(self, message: LocalMessage, queue: "LocalQueue", consumer: Optional["LocalConsumer"],
+                 channel: "LocalChannel"):
+        self._message = message
+        self._queue = queue
+        self._consumer = consumer
+        self._channel = channel
+
+    def __getattr__(self, name: str):
+        return getattr(self._message, name)
+
+    def _settle(self) -> bool:
+        if self._queue is None:
+            return False
+        self._channel.unacked.discard(self)
+        if self._consumer is not None:
+            self._consumer.unacked -= 1
+        queue, self._queue = self._queue, None
+        queue.dispatch()
+        return True
+
+    async def ack(self):
+        self._settle()
+
+    async def nack(self, requeue: bool = True):
+        queue = self._queue
+        if self._settle() and requeue:
+            queue.put(self._message, front=True)
+
+    async def reject(self, requeue: bool = False):
+        await self.nack(requeue)
+
+
+class LocalConsumer:
+    __slots__ = ("callback", "channel", "unacked")
+
+    def __init__(self, callback: Callable, channel: "LocalChannel"):
+        self.callback = callback
+        self.channel = channel
+        self.unacked = 0
+
+    def has_capacity(self) -> bool:
+        return not self.channel.prefetch_count or self.unacked < self.channel.prefetch_count
+
+
+class LocalQueue:
+    """Queue of the in-memory broker, with AMQP's round-robin delivery, prefetch and TTL dead-lettering.
+
+    With x-single-active-consumer only the oldest consumer gets messages,
+    the next one takes over once it was cancelled.
+    """
+
+    def __init__(self, broker: "InMemoryBroker", name: str, arguments: Dict[str, Any],
+                 owner: Optional["LocalConnection"]):
+        self.broker = broker
+        self.name = name
+        self.owner = owner  # connection of an exclusive queue
+        self.messages: Deque[LocalMessage] = deque()
+        self.consumers: List[LocalConsumer] = []
+        self.ttl = arguments.get("x-message-ttl")
+        self.dead_letter_exchange = arguments.get("x-dead-letter-exchange")
+        self.dead_letter_routing_key = arguments.get("x-dead-letter-routing-key")
+        self.single_active_consumer = bool(arguments.get("x-single-active-consumer"))
+        self._next_consumer = 0
+
+    def put(self, message: LocalMessage, front: bool = False):
+        if front:
+            self.messages.appendleft(message)
+        else:
+            self.messages.append(message)
+            if self.ttl is not None:
+                asyncio.get_running_loop().call_later(self.ttl / 1000, self._expire, message)
+        self.dispatch()
+
+    def _expire(self, message: LocalMessage):
+        # every message of a queue shares its ttl, so they expire in order
+        if self.messages and self.messages[0] is message:
+            self.messages.popleft()
+        else:
+            try:
+                self.messages.remove(message)
+            except ValueError:
+                return  # consumed in the meantime
+        if self.dead_letter_exchange is not None:
+            self.broker.route(self.dead_letter_exchange, self.dead_letter_routing_key or self.name, message)
+
+    def dispatch(self):
+        while self.messages and self.consumers:
+            active = 1 if self.single_active_consumer else len(self.consumers)
+            for _ in range(active):
+                self._next_consumer = (self._next_consumer + 1) % active
+                consumer = self.consumers[self._next_consumer]
+                if consumer.has_capacity():
+                    break
+            else:
+                return  # every consumer is at its prefetch limit
+            delivery = LocalDelivery(self.messages.popleft(), self, consumer, consumer.channel)
+            consumer.unacked += 1
+            consumer.channel.unacked.add(delivery)
+            self.broker.spawn(consumer.callback(delivery))
+
+
+class LocalExchange:
+    """Direct or topic exchange; bindings without wildcards are looked up by key."""
+
+    def __init__(self, name: str, type: str):
+        self.name = name
+        self.type = type
+        self.exact: Dict[str, Set[LocalQueue]] = {}
+        self.patterns: Dict[str, Set[LocalQueue]] = {}
+
+    def bind(self, queue: LocalQueue, routing_key: str):
+        wildcard = self.type == "topic" and ("*" in routing_key or "#" in routing_key)
+        (self.patterns if wildcard else self.exact).setdefault(routing_key, set()).add(queue)
+
+    def unbind(self, queue: LocalQueue, routing_key: str):
+        for bindings in (self.exact, self.patterns):
+            queues = bindings.get(routing_key)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del bindings[routing_key]
+
+    def unbind_queue(self, queue: LocalQueue):
+        for bindings in (self.exact, self.patterns):
+            for routing_key in [key for key, queues in bindings.items() if queue in queues]:
+                self.unbind(queue, routing_key)
+
+    def route(self, routing_key: str) -> Set[LocalQueue]:
+        queues = set(self.exact.get(routing_key, ()))
+        for pattern, bound in self.patterns.items():
+            if topic_matches(pattern, routing_key):
+                queues.update(bound)
+        return queues
+
+
+@lru_cache(maxsize=4096)
+def _topic_regex(pattern: str) -> "re.Pattern":
+    # every word is matched together with the dot before it, the key gets a leading dot
+    words = {"*": r"\.[^.]+", "#": r"(?:\.[^.]+)*"}
+    return re.compile("".join(words.get(word) or r"\." + re.escape(word) for word in pattern.split(".")) + "$")
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """AMQP topic matching, '*' is exactly one word and '#' zero or more."""
+    return _topic_regex(pattern).match("." + routing_key) is not None
+
+
+class InMemoryBroker:
+    """Exchanges and queues shared by every service running in this process.
+
+    Routing follows RabbitMQ: the default exchange delivers to the queue
+    named by the routing key, direct exchanges match keys exactly, topic
+    exchanges by pattern, unroutable messages are dropped and queues with
+    x-message-ttl dead-letter expired messages.
+    """
+
+    def __init__(self):
+        self.exchanges: Dict[str, LocalExchange] = {}
+        self.queues: Dict[str, LocalQueue] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def route(self, exchange_name: str, routing_key: str, message: LocalMessage):
+        if exchange_name == "":
+            queue = self.queues.get(routing_key)
+            queues = (queue,) if queue is not None else ()
+        else:
+            queues = self.exchanges[exchange_name].route(routing_key)
+        for queue in queues:
+            queue.put(message)
+
+    def spawn(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def delete_queue(self, queue: LocalQueue):
+        self.queues.pop(queue.name, None)
+        for exchange in self.exchanges.values():
+            exchange.unbind_queue(queue)
+
+
+class LocalExchangeHandle:
+    def __init__(self, broker: InMemoryBroker, name: str):
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message: LocalMessage, routing_key: str):
+        self.broker.route(self.name, routing_key, message)
+
+
+class LocalQueueHandle:
+    """A queue as seen through one channel, the subset of aio_pika's Queue the services use."""
+
+    def __init__(self, queue: LocalQueue, channel: "LocalChannel"):
+        self.queue = queue
+        self.channel = channel
+        self.name = queue.name
+
+    async def bind(self, exchange: LocalExchangeHandle, routing_key: str):
+        self.channel.broker.exchanges[exchange.name].bind(self.queue, routing_key)
+
+    async def unbind(self, exchange: LocalExchangeHandle, routing_key: str):
+        self.channel.broker.exchanges[exchange.name].unbind(self.queue, routing_key)
+
+    async def consume(self, callback: Callable) -> LocalConsumer:
+        consumer = LocalConsumer(callback, self.channel)
+        self.queue.consumers.append(consumer)
+        self.channel.consumers.append((self.queue, consumer))
+        self.queue.dispatch()
+        return consumer  # stands in for the consumer tag
+
+    async def cancel(self, consumer_tag: LocalConsumer):
+        # deliveries already made stay unacked on the channel, like in AMQP
+        if consumer_tag in self.queue.consumers:
+            self.queue.consumers.remove(consumer_tag)
+        if (self.queue, consumer_tag) in self.channel.consumers:
+            self.channel.consumers.remove((self.queue, consumer_tag))
+        self.queue.dispatch()
+
+    async def get(self, no_ack: bool = False, fail: bool = True) -> Optional[LocalDelivery]:
+        if not self.queue.messages:
+            if fail:
+                raise QueueEmpty(self.name)
+            return None
+        delivery = LocalDelivery(self.queue.messages.popleft(), self.queue, None, self.channel)
+        if no_ack:
+            delivery._queue = None
+        else:
+            self.channel.unacked.add(delivery)
+        return delivery
+
+
+class LocalChannel:
+    def __init__(self, connection: "LocalConnection"):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        self.consumers: List[Tuple[LocalQueue, LocalConsumer]] = []
+        self.unacked: Set[LocalDelivery] = set()
+        self.default_exchange = LocalExchangeHandle(self.broker, "")
+
+    async def set_qos(self, prefetch_count: int = 0):
+        self.prefetch_count = prefetch_count
+
+    async def declare_exchange(self, name: str, type: Any = "direct", durable: bool = False) -> LocalExchangeHandle:
+        if name not in self.broker.exchanges:
+            self.broker.exchanges[name] = LocalExchange(name, getattr(type, "value", type))
+        return LocalExchangeHandle(self.broker, name)
+
+    async def declare_queue(self, name: str, durable: bool = False, passive: bool = False, exclusive: bool = False,
+                            auto_delete: bool = False, arguments: Optional[Dict[str, Any]] = None) -> LocalQueueHandle:
+        queue = self.broker.queues.get(name)
+        if queue is None:
+            if passive:
+                raise ChannelNotFoundEntity(f"NOT_FOUND - no queue '{name}'")
+            queue = self.broker.queues[name] = LocalQueue(
+                self.broker, name, arguments or {}, self.connection if exclusive else None
+            )
+        return LocalQueueHandle(queue, self)
+
+    async def close(self):
+        for queue, consumer in self.consumers:
+            if consumer in queue.consumers:
+                queue.consumers.remove(consumer)
+        self.consumers = []
+        # like AMQP, unacked messages go back to their queues
+        for delivery in list(self.unacked):
+            await delivery.nack(requeue=True)
+
+
+class LocalConnection:
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self.channels: List[LocalChannel] = []
+        self.is_closed = False
+        self.connected = True
+
+    async def channel(self, publisher_confirms: bool = True) -> LocalChannel:
+        channel = LocalChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+        for queue in [queue for queue in self.broker.queues.values() if queue.owner is self]:
+            self.broker.delete_queue(queue)
+        self.is_closed = True
+        self.connected = False
+
+
+class InMemoryTransport:
+    """Transport through an InMemoryBroker, for co-located services, tests and benchmarks.
+
+    Published Message objects are handed to consumers as they are, nothing
+    is encoded, framed or copied.
+    """
+
+    name = "memory"
+
+    def __init__(self, broker: Optional[InMemoryBroker] = None):
+        self.broker = broker or shared_broker
+
+    async def connect(self, url: str) -> LocalConnection:
+        return LocalConnection(self.broker)
+
+    def message(self, message: Union[Message, dict], headers: Optional[Dict[str, Any]] = None) -> LocalMessage:
+        if isinstance(message, Message):
+            return LocalMessage(message, headers, message.correlation_id, message.message_type)
+        return LocalMessage(message, headers)
+
+    def copy(self, incoming, headers: Dict[str, Any]) -> LocalMessage:
+        return LocalMessage(incoming.message, headers, incoming.correlation_id, incoming.type,
+                            incoming._body, incoming.content_type)
+
+
+shared_broker = InMemoryBroker()
+
+TRANSPORTS = {
+    AmqpTransport.name: AmqpTransport,
+    InMemoryTransport.name: InMemoryTransport,
+}
+
+
+def create_transport(name: str = Config.TRANSPORT):
+    try:
+        return TRANSPORTS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown transport {name}, expected one of {', '.join(TRANSPORTS)}")
@@ -1,8 +1,10 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 from enum import Enum
 
+from common.codec import decode_body
+
 class OrderStatus(Enum):
     CREATED = "CREATED"
     PROCESSING = "PROCESSING"
@@ -10,20 +12,133 @@ class OrderStatus(Enum):
     INVOICED = "INVOICED"
     FAILED = "FAILED"
 
-@dataclass
 class Message:
-    correlation_id: str
-    order_id: str
-    timestamp: datetime
-    message_type: str
-    payload: Dict[str, Any]
-    version: str = "1.0"
-    error: Optional[Dict[str, Any]] = None
-
-    def to_json(self):
-        dict_repr = asdict(self)
-        dict_repr['timestamp'] = self.timestamp.isoformat()
-        return dict_repr
+    """Saga message.
+
+    Routing fields travel as AMQP properties/headers, so a received message
+    exposes them without touching the body. The payload is only decoded on
+    first access, and republishing a received message, as is or through
+    `forward`, reuses its original body bytes. Routing fields set in the
+    headers win over the copies inside such a forwarded body. `reply_to`
+    names the api_service replica that created the order, it travels as the
+    AMQP reply-to property only and services echo it back in their events.
+    """
+
+    __slots__ = ("correlation_id", "order_id", "timestamp", "message_type", "version", "reply_to",
+                 "_payload", "_error", "_body", "_content_type")
+
+    ORDER_ID_HEADER = "x-order-id"
+    TIMESTAMP_HEADER = "x-timestamp"
+    VERSION_HEADER = "x-version"
+
+    def __init__(self, correlation_id: str, order_id: str, timestamp: datetime, message_type: str,
+                 payload: Optional[Dict[str, Any]] = None, version: str = "1.0",
+                 error: Optional[Dict[str, Any]] = None, reply_to: Optional[str] = None):
+        self.correlation_id = correlation_id
+        self.order_id = order_id
+        self.timestamp = timestamp
+        self.message_type = message_type
+        self.version = version
+        self.reply_to = reply_to
+        self._payload = payload
+        self._error = error
+        self._body = None
+        self._content_type = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Message":
+        try:
+            timestamp = data["timestamp"]
+            return cls(
+                correlation_id=data["correlation_id"],
+                order_id=data["order_id"],
+                timestamp=datetime.fromisoformat(timestamp) if isinstance(timestamp, str) else timestamp,
+                message_type=data["message_type"],
+                payload=data.get("payload") or {},
+                version=data.get("version", "1.0"),
+                error=data.get("error")
+            )
+        except KeyError as e:
+            raise ServiceException(message="Invalid message format", details={"missing": str(e)})
+
+    @classmethod
+    def from_amqp(cls, incoming) -> "Message":
+        """Build a message from an incoming AMQP message, decoding the body lazily."""
+        local = getattr(incoming, "message", None)
+        if isinstance(local, Message):
+            # handed over as is by the in-memory transport
+            return local
+        headers = incoming.headers or {}
+        if incoming.type is None or cls.ORDER_ID_HEADER not in headers:
+            # published without routing headers, everything lives in the body
+            message = cls.from_dict(decode_body(incoming.body, incoming.content_type))
+        else:
+            message = cls(
+                correlation_id=incoming.correlation_id,
+                order_id=headers[cls.ORDER_ID_HEADER],
+                timestamp=datetime.fromisoformat(headers[cls.TIMESTAMP_HEADER]),
+                message_type=incoming.type,
+                version=headers.get(cls.VERSION_HEADER, "1.0")
+            )
+        message.reply_to = incoming.reply_to
+        message._body = incoming.body
+        message._content_type = incoming.content_type
+        return message
+
+    def _decode_body(self):
+        data = decode_body(self._body, self._content_type)
+        self._payload = data.get("payload") or {}
+        self._error = data.get("error")
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        if self._payload is None:
+            if self._body is None:
+                self._payload = {}
+            else:
+                self._decode_body()
+        return self._payload
+
+    @property
+    def error(self) -> Optional[Dict[str, Any]]:
+        if self._payload is None and self._body is not None:
+            self._decode_body()
+        return self._error
+
+    def forward(self, **changes) -> "Message":
+        """Copy with changed routing fields that still shares the original body."""
+        message = Message.__new__(Message)
+        for slot in Message.__slots__:
+            setattr(message, slot, getattr(self, slot))
+        for field, value in changes.items():
+            if field not in ("correlation_id", "order_id", "timestamp", "message_type", "version", "reply_to"):
+                raise ValueError(f"forward() can only change routing fields, not {field}")
+            setattr(message, field, value)
+        return message
+
+    def amqp_headers(self) -> Dict[str, Any]:
+        return {
+            self.ORDER_ID_HEADER: self.order_id,
+            self.TIMESTAMP_HEADER: self.timestamp.isoformat(),
+            self.VERSION_HEADER: self.version,
+        }
+
+    def encoded_body(self, codec) -> Tuple[bytes, str]:
+        """Body and content type to publish, the received bytes when there are any."""
+        if self._body is not None:
+            return self._body, self._content_type
+        return codec.encode(self.to_json()), codec.content_type
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "correlation_id": self.correlation_id,
+            "order_id": self.order_id,
+            "timestamp": self.timestamp.isoformat(),
+            "message_type": self.message_type,
+            "payload": self.payload,
+            "version": self.version,
+            "error": self.error,
+        }
 
 @dataclass
 class ServiceException(Exception):
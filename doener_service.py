@@ -1,55 +1,285 @@
 from fastapi import FastAPI, Depends, HTTPException
-from prometheus_client import make_asgi_app
+from prometheus_client import Counter, Gauge, make_asgi_app
 
 from common.types import Message, ServiceException, OrderStatus
 from common.monitoring import monitor_message_processing
+from common.tracing import tracer
 from common.mq_service import RabbitMQService
 from common.config import Config
-import json
-import random
+from common.log import configure_logging
+from common.dlq import create_dlq_router
+from common.idempotency import IdempotencyCache
 import asyncio
+import heapq
+import time
+from collections import deque
 from datetime import datetime
-from typing import Dict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import structlog
 
 # Initialize FastAPI app
 app = FastAPI(title="Döner Assignment Service")
 metrics_app = make_asgi_app()
 app.mount("/metrics", metrics_app)
+configure_logging("doener_service")
 logger = structlog.get_logger()
 
+# Metrics
+shop_cache_requests = Counter('shop_cache_requests_total', 'Shop availability lookups by cache result', ['result'])
+shop_cache_refreshes = Counter('shop_cache_refreshes_total', 'Upstream shop availability refreshes', ['outcome'])
+shop_in_flight_orders = Gauge('shop_in_flight_orders', 'Orders assigned to a shop and not yet invoiced or failed', ['shop'])
+shop_assignment_rejections = Counter('shop_assignment_rejections_total', 'Orders rejected because every shop was at capacity')
+shop_lookup_saved_seconds = Counter('shop_lookup_saved_seconds_total', 'Upstream latency avoided by serving lookups from the cache')
+
 # Configuration
 class DoenerServiceSettings:
     rabbitmq_url: str = Config.get_rabbitmq_url()
     service_name: str = "doener_service"
     update_queue: str = "doener_requests"
     response_queue: str = "doener_supplied"
+    # every replica follows the assignments and releases of all replicas
+    shop_event_queues: list[str] = ["doener_supplied", "invoice_supplied"]
+    # events that end an order and free its shop capacity
+    release_events: tuple = ("INVOICE_CREATED", "INVOICE_CREATION_FAILED", "DOENER_ASSIGNMENT_FAILED")
 
 settings = DoenerServiceSettings()
 
+# Shop availability cache
+class ShopAvailabilityCache:
+    """Caches the result of an upstream lookup.
+
+    Entries are fresh for `ttl` seconds. For another `stale_ttl` seconds the
+    stale value is still served while one background refresh runs. Callers
+    that miss at the same time share a single in-flight upstream call.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[List[Dict]]], ttl: float, stale_ttl: float):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.value: Optional[List[Dict]] = None
+        self.fetched_at = 0.0
+        self.last_fetch_duration = 0.0
+        self._in_flight: Optional[asyncio.Future] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def get(self) -> List[Dict]:
+        age = time.monotonic() - self.fetched_at
+        if self.value is not None and age < self.ttl:
+            self._record("hit")
+            return self.value
+        if self.value is not None and age < self.ttl + self.stale_ttl:
+            self._record("stale")
+            if self._in_flight is None:
+                self._start_refresh()
+            return self.value
+        if self._in_flight is not None:
+            self._record("coalesced")
+        else:
+            shop_cache_requests.labels(result="miss").inc()
+            self._start_refresh()
+        return await asyncio.shield(self._in_flight)
+
+    def _record(self, result: str):
+        shop_cache_requests.labels(result=result).inc()
+        shop_lookup_saved_seconds.inc(self.last_fetch_duration)
+
+    def _start_refresh(self):
+        self._in_flight = asyncio.get_running_loop().create_future()
+        self._refresh_task = asyncio.create_task(self._refresh(self._in_flight))
+
+    async def _refresh(self, result: asyncio.Future):
+        start_time = time.monotonic()
+        try:
+            self.value = await self.fetch()
+            self.fetched_at = time.monotonic()
+            self.last_fetch_duration = self.fetched_at - start_time
+            shop_cache_refreshes.labels(outcome="success").inc()
+            result.set_result(self.value)
+        except Exception as e:
+            shop_cache_refreshes.labels(outcome="error").inc()
+            logger.error("shop_cache_refresh_failed", error=str(e))
+            result.set_exception(e)
+            result.exception()  # stale readers don't wait for the refresh
+        finally:
+            self._in_flight = None
+
+
+# Shop assignment
+class ShopAssignmentEngine:
+    """Assigns orders to the best scoring shop that still has capacity.
+
+    A shop's score (lower is better) combines its load, in-flight orders over
+    capacity, with its relative price and the prep time it is expected to
+    need at that load. Scores live in a heap with lazy invalidation: every
+    load change pushes a fresh entry with a new version, outdated entries and
+    full shops are dropped when they surface, so a pick costs O(log n) even
+    with thousands of shops. Capacity is held until the order is invoiced or
+    fails, or until `assignment_timeout` passes without either.
+
+    Assignments made by other replicas are counted through reserve(), so
+    the capacity of a shop holds across replicas, up to the orders assigned
+    at the same time on two of them.
+    """
+
+    def __init__(self, load_weight: float = 1.0, price_weight: float = 0.5, prep_weight: float = 0.5,
+                 assignment_timeout: float = Config.SHOP_ASSIGNMENT_TIMEOUT):
+        self.load_weight = load_weight
+        self.price_weight = price_weight
+        self.prep_weight = prep_weight
+        self.assignment_timeout = assignment_timeout
+        self.shops: Dict[str, Dict] = {}
+        self.in_flight: Dict[str, int] = {}
+        self.assignments: Dict[str, str] = {}  # order_id -> shop_id
+        self.expiries: deque = deque()  # (deadline, order_id), oldest first
+        self._versions: Dict[str, int] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._synced_shops: Optional[List[Dict]] = None
+        self._max_price = 1.0
+        self._max_prep_time = 1.0
+
+    def sync_shops(self, shops: List[Dict]):
+        """Take over a new shop list from the availability lookup, keeping loads of known shops."""
+        if shops is self._synced_shops:
+            return
+        self._synced_shops = shops
+        self.shops = {shop["id"]: shop for shop in shops}
+        self._max_price = max((shop["price"] for shop in shops), default=1.0) or 1.0
+        self._max_prep_time = max((self._prep_time(shop) for shop in shops), default=1.0) or 1.0
+        self._heap = []
+        for shop_id in self.shops:
+            self.in_flight.setdefault(shop_id, 0)
+            self._push(shop_id)
+        heapq.heapify(self._heap)
+
+    @staticmethod
+    def _capacity(shop: Dict) -> int:
+        return shop.get("capacity", Config.SHOP_DEFAULT_CAPACITY)
+
+    @staticmethod
+    def _prep_time(shop: Dict) -> float:
+        return shop.get("prep_time", Config.SHOP_DEFAULT_PREP_TIME)
+
+    def score(self, shop_id: str) -> float:
+        shop = self.shops[shop_id]
+        load = self.in_flight[shop_id] / self._capacity(shop)
+        expected_prep_time = self._prep_time(shop) * (1 + load)
+        return (self.load_weight * load
+                + self.price_weight * shop["price"] / self._max_price
+                + self.prep_weight * expected_prep_time / self._max_prep_time)
+
+    def _push(self, shop_id: str):
+        version = self._versions.get(shop_id, 0) + 1
+        self._versions[shop_id] = version
+        heapq.heappush(self._heap, (self.score(shop_id), version, shop_id))
+        shop_in_flight_orders.labels(shop=shop_id).set(self.in_flight[shop_id])
+        # drop outdated entries once they dominate the heap
+        if len(self._heap) > 4 * len(self.shops) + 64:
+            self._heap = [entry for entry in self._heap if self._versions.get(entry[2]) == entry[1]]
+            heapq.heapify(self._heap)
+
+    def assign(self, order_id: str) -> Optional[Dict]:
+        """Reserve capacity at the best shop for an order, None when every shop is full."""
+        self.expire()
+        if order_id in self.assignments:
+            # redelivered request, keep the reservation it already holds
+            return self.shops.get(self.assignments[order_id])
+
+        while self._heap:
+            _, version, shop_id = self._heap[0]
+            heapq.heappop(self._heap)
+            if shop_id not in self.shops or self._versions.get(shop_id) != version:
+                continue
+            if self.in_flight[shop_id] >= self._capacity(self.shops[shop_id]):
+                # full shops leave the heap, release() pushes them back
+                continue
+            self.in_flight[shop_id] += 1
+            self.assignments[order_id] = shop_id
+            self.expiries.append((time.monotonic() + self.assignment_timeout, order_id))
+            self._push(shop_id)
+            return self.shops[shop_id]
+        return None
+
+    def reserve(self, order_id: str, shop_id: str):
+        """Count an assignment made elsewhere, orders assigned here already hold theirs."""
+        self.expire()
+        if order_id in self.assignments:
+            return
+        self.in_flight[shop_id] = self.in_flight.get(shop_id, 0) + 1
+        self.assignments[order_id] = shop_id
+        self.expiries.append((time.monotonic() + self.assignment_timeout, order_id))
+        if shop_id in self.shops:
+            self._push(shop_id)
+
+    def release(self, order_id: str):
+        shop_id = self.assignments.pop(order_id, None)
+        if shop_id is None:
+            return
+        self.in_flight[shop_id] = max(0, self.in_flight[shop_id] - 1)
+        if shop_id in self.shops:
+            self._push(shop_id)
+
+    def expire(self):
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            _, order_id = self.expiries.popleft()
+            if order_id in self.assignments:
+                logger.warning("shop_assignment_expired", order_id=order_id)
+                self.release(order_id)
+
+
 # Shop Finder
 class DoenerShopFinder:
     def __init__(self):
         self.shops = [
-            {"id": "shop1", "name": "Best Döner", "price": 8.50},
-            {"id": "shop2", "name": "King Döner", "price": 7.50},
-            {"id": "shop3", "name": "Döner Palace", "price": 9.00}
+            {"id": "shop1", "name": "Best Döner", "price": 8.50, "capacity": 20, "prep_time": 300},
+            {"id": "shop2", "name": "King Döner", "price": 7.50, "capacity": 10, "prep_time": 420},
+            {"id": "shop3", "name": "Döner Palace", "price": 9.00, "capacity": 30, "prep_time": 240}
         ]
+        self.engine = ShopAssignmentEngine()
+        self.cache = ShopAvailabilityCache(
+            self._fetch_available_shops,
+            ttl=Config.SHOP_CACHE_TTL,
+            stale_ttl=Config.SHOP_CACHE_STALE_TTL
+        )
 
-    async def find_available_shop(self, message: Dict) -> Dict:
-        """Simulate finding an available shop."""
-        try:
+    async def _fetch_available_shops(self) -> List[Dict]:
+        """Simulate asking the shops which of them currently take orders."""
+        await asyncio.sleep(Config.SHOP_LOOKUP_LATENCY) # HTTP latency simulated
+        return list(self.shops)
 
-            await asyncio.sleep(1.5) # HTTP latency simulated
-            shop = random.choice(self.shops)
-            if not shop:
+    async def find_available_shops(self, messages: List[Message]) -> List[Dict]:
+        """Pick a shop for each of many orders with one availability lookup."""
+        self.engine.sync_shops(await self.cache.get())
+        assigned, reserved = [], []
+        for message in messages:
+            held = message.order_id in self.engine.assignments
+            shop = self.engine.assign(message.order_id)
+            if shop is None:
+                # give back what this call reserved, redelivered orders keep the shop they held before
+                for order_id in reserved:
+                    self.engine.release(order_id)
+                shop_assignment_rejections.inc()
                 raise ServiceException(
                     message="No available shops found",
-                    details={"order_id": message["order_id"]}
+                    details={"order_ids": [message.order_id for message in messages]}
                 )
-            return shop
+            if not held:
+                reserved.append(message.order_id)
+            assigned.append(shop)
+        return assigned
+
+    def release_shop(self, order_id: str):
+        """Free the capacity an order held once it is invoiced or failed."""
+        self.engine.release(order_id)
+
+    @tracer.traced("find_available_shop")
+    async def find_available_shop(self, message: Message) -> Dict:
+        """Find an available shop for one order."""
+        try:
+            return (await self.find_available_shops([message]))[0]
         except Exception as e:
-            logger.error("shop_finder_error", error=str(e), order_id=message["order_id"])
+            logger.error("shop_finder_error", error=str(e), order_id=message.order_id)
             raise
 
 shop_finder = DoenerShopFinder()
@@ -61,52 +291,74 @@ def get_rabbitmq_service() -> RabbitMQService:
         raise HTTPException(status_code=503, detail="Message queue service unavailable")
     return mq
 
+app.include_router(create_dlq_router(get_rabbitmq_service))
+
+# drops redeliveries of messages that were already handled successfully
+idempotency = IdempotencyCache(settings.service_name)
+
+@idempotency.idempotent
 @monitor_message_processing('doener_service')
-async def handle_doener_request(message: Dict, mq_service: RabbitMQService):
-    """Process incoming döner requests."""
+async def handle_doener_request(message: Message, mq_service: RabbitMQService):
+    """Process incoming döner requests.
+
+    Failures, e.g. every shop being full, are retried. DOENER_ASSIGNMENT_FAILED
+    is published by announce_assignment_failure once the retries are used up.
+    """
     try:
-        logger.info("processing_doener_request", order_id=message["order_id"])
+        logger.info("processing_doener_request", order_id=message.order_id)
         shop = await shop_finder.find_available_shop(message)
         
         response = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
+            correlation_id=message.correlation_id,
+            order_id=message.order_id,
             timestamp=datetime.now(),
             message_type="DOENER_ASSIGNED",
             payload={
                 "shop": shop,
                 "price": shop["price"],
                 "status": OrderStatus.DOENER_ASSIGNED.value
-            }
+            },
+            reply_to=message.reply_to
         )
         
-        logger.info("doener_assigned", order_id=message["order_id"], shop_id=shop["id"])
-        await mq_service.publish(settings.response_queue, response.to_json())
+        logger.info("doener_assigned", order_id=message.order_id, shop_id=shop["id"])
+        await mq_service.publish(settings.response_queue, response)
 
     except Exception as e:
-        error_response = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
-            timestamp=datetime.now(),
-            message_type="DOENER_ASSIGNMENT_FAILED",
-            payload={"status": OrderStatus.FAILED.value},
-            error={"message": str(e), "type": type(e).__name__}
-        )
-        await mq_service.publish(settings.response_queue, error_response.to_json())
-        logger.error("doener_request_failed", error=str(e), order_id=message.get("order_id"))
+        logger.error("doener_request_failed", error=str(e), order_id=message.order_id)
         raise
 
+async def announce_assignment_failure(message, error: Exception):
+    """Publish DOENER_ASSIGNMENT_FAILED once a döner request was dead-lettered."""
+    request = Message.from_amqp(message)
+    error_response = Message(
+        correlation_id=request.correlation_id,
+        order_id=request.order_id,
+        timestamp=datetime.now(),
+        message_type="DOENER_ASSIGNMENT_FAILED",
+        payload={"status": OrderStatus.FAILED.value},
+        error={"message": str(error), "type": type(error).__name__},
+        reply_to=request.reply_to
+    )
+    await app.state.rabbitmq_service.publish(settings.response_queue, error_response)
+
 async def message_handler(message):
     """Handle RabbitMQ messages."""
     try:
-        message_body = json.loads(message.body.decode("utf-8"))
+        message_body = Message.from_amqp(message)
         await handle_doener_request(message_body, app.state.rabbitmq_service)
-        await message.ack()
     except Exception as e:
         logger.error("message_processing_failed", error=str(e), message=message.body)
-        await message.nack(requeue=True)
         raise
 
+async def shop_event_handler(message):
+    """Count the assignments of every replica, free shop capacity when an order is invoiced or fails."""
+    message_body = Message.from_amqp(message)
+    if message_body.message_type == "DOENER_ASSIGNED":
+        shop_finder.engine.reserve(message_body.order_id, message_body.payload["shop"]["id"])
+    elif message_body.message_type in settings.release_events:
+        shop_finder.release_shop(message_body.order_id)
+
 @app.on_event("startup")
 async def startup_event():
     """Startup event for initializing RabbitMQ and consuming messages."""
@@ -117,7 +369,9 @@ async def startup_event():
     
     app.state.rabbitmq_service = mq_service
 
-    await mq_service.consume(settings.update_queue, message_handler)
+    await mq_service.consume(settings.update_queue, message_handler, on_dead_letter=announce_assignment_failure)
+    # shop reservations live in memory, every replica needs every event, not one of them
+    await mq_service.consume_events("shops", shop_event_handler, settings.shop_event_queues)
     
     logger.info("Döner Assignment Service started successfully")
 
@@ -127,6 +381,7 @@ async def shutdown_event():
     mq_service = app.state.rabbitmq_service
     if mq_service:
         await mq_service.close()
+    await idempotency.close()
     logger.info("Döner Assignment Service shutdown completed")
 
 @app.get("/health")
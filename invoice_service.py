@@ -1,21 +1,30 @@
 import asyncio
+import contextvars
 from fastapi import FastAPI, Depends, HTTPException
-from prometheus_client import make_asgi_app
+from prometheus_client import Histogram, make_asgi_app
 
 from common.types import Message, ServiceException, OrderStatus
 from common.monitoring import monitor_message_processing
+from common.tracing import tracer
 from common.mq_service import RabbitMQService
 from common.config import Config
-import json
+from common.log import configure_logging
+from common.dlq import create_dlq_router
+from common.idempotency import IdempotencyCache
 from datetime import datetime
+from typing import List, Optional, Tuple, Union
 import structlog
 
 # Initialize FastAPI app
 app = FastAPI(title="Invoice Service")
 metrics_app = make_asgi_app()
 app.mount("/metrics", metrics_app)
+configure_logging("invoice_service")
 logger = structlog.get_logger()
 
+# Metrics
+invoice_batch_size = Histogram('invoice_batch_size', 'Invoices created per backend call', buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
 
 # Configuration
 class InvoiceServiceSettings:
@@ -36,61 +45,156 @@ def get_rabbitmq_service() -> RabbitMQService:
     return mq
 
 
-@monitor_message_processing('invoice_service')
-async def create_invoice(message: dict, mq_service: RabbitMQService) -> None:
+app.include_router(create_dlq_router(get_rabbitmq_service))
+
+# drops redeliveries of messages that were already handled successfully
+idempotency = IdempotencyCache(settings.service_name)
+
+
+# Invoice batching
+class InvoiceBatcher:
+    """Collects invoice requests for up to `window` seconds or `max_batch` items.
+
+    Each batch makes one backend call and publishes all of its
+    INVOICE_CREATED responses together. Every submitter awaits the outcome of
+    its own invoice, so messages are still acked or retried one by one, and
+    an invoice that can't be created only fails its own request. Responses
+    are published in the trace context of their own submitter.
+    """
+
+    def __init__(self, max_batch: int = Config.INVOICE_BATCH_SIZE, window: float = Config.INVOICE_BATCH_WINDOW):
+        self.max_batch = max_batch
+        self.window = window
+        self._pending: List[Tuple[Message, asyncio.Future, contextvars.Context]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    @tracer.traced("create_invoice_batched")
+    async def submit(self, message: Message, mq_service: RabbitMQService) -> Message:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message, future, contextvars.copy_context()))
+        if len(self._pending) >= self.max_batch:
+            self._flush(mq_service)
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush, mq_service)
+        return await future
+
+    def _flush(self, mq_service: RabbitMQService):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            # the batch belongs to no single trace, not to the submitter that filled it
+            task = asyncio.create_task(self._process(batch, mq_service), context=contextvars.Context())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, batch: List[Tuple[Message, asyncio.Future, contextvars.Context]],
+                       mq_service: RabbitMQService):
+        invoice_batch_size.observe(len(batch))
+        try:
+            responses = await create_invoices([message for message, _, _ in batch])
+        except Exception as e:
+            responses = [e] * len(batch)
+
+        confirmations = await asyncio.gather(
+            *(self._publish(response, mq_service, context) for (_, _, context), response in zip(batch, responses)),
+            return_exceptions=True
+        )
+        for (_, future, _), response, confirmation in zip(batch, responses, confirmations):
+            if future.done():
+                continue
+            if isinstance(confirmation, Exception):
+                future.set_exception(confirmation)
+            else:
+                future.set_result(response)
+
+    @staticmethod
+    async def _publish(response: Union[Message, Exception], mq_service: RabbitMQService,
+                       context: contextvars.Context):
+        if isinstance(response, Exception):
+            raise response
+        # the trace headers are injected when the message is queued
+        await context.run(mq_service.publish_nowait, settings.response_queue, response)
+
+
+def invoice_for(message: Message) -> Message:
+    """The INVOICE_CREATED response to an invoice request."""
+    return Message(
+        correlation_id=message.correlation_id,
+        order_id=message.order_id,
+        timestamp=datetime.now(),
+        message_type="INVOICE_CREATED",
+        payload={
+            "invoice_id": f"INV-{message.order_id[:8]}",
+            "total": message.payload["price"] + 1.50,  # Add delivery fee
+            "status": OrderStatus.INVOICED.value
+        },
+        reply_to=message.reply_to
+    )
+
+
+async def create_invoices(messages: List[Message]) -> List[Union[Message, Exception]]:
+    """Create the invoices of a batch with one backend call, in order, each an invoice or the error creating it."""
     # sleep to simulate
-    await asyncio.sleep(0.5)
+    await asyncio.sleep(Config.INVOICE_BACKEND_LATENCY)
 
-    """Process invoice creation requests."""
-    try:
-        logger.info("creating_invoice", order_id=message["order_id"])
-
-        if "payload" not in message or "price" not in message["payload"]:
-            raise ServiceException(
-                message="Invalid message format",
-                details={"order_id": message["order_id"]}
-            )
-
-        response = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
-            timestamp=datetime.now(),
-            message_type="INVOICE_CREATED",
-            payload={
-                "invoice_id": f"INV-{message['order_id'][:8]}",
-                "total": message["payload"]["price"] + 1.50,  # Add delivery fee
-                "status": OrderStatus.INVOICED.value
-            }
-        )
+    invoices = []
+    for message in messages:
+        try:
+            invoices.append(invoice_for(message))
+        except Exception as e:
+            invoices.append(e)
+    return invoices
 
-        logger.info("invoice_created",
-                    order_id=message["order_id"],
-                    invoice_id=response.payload["invoice_id"])
 
-        await mq_service.publish(settings.response_queue, response.to_json())
+invoice_batcher = InvoiceBatcher()
 
-    except Exception as e:
-        error_response = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
-            timestamp=datetime.now(),
-            message_type="INVOICE_CREATION_FAILED",
-            payload={"status": OrderStatus.FAILED.value},
-            error={"message": str(e), "type": type(e).__name__}
+
+@idempotency.idempotent
+@monitor_message_processing('invoice_service')
+async def create_invoice(message: Message, mq_service: RabbitMQService) -> None:
+    """Process invoice creation requests, failures are retried and announced by announce_invoice_failure."""
+    logger.info("creating_invoice", order_id=message.order_id)
+
+    price = message.payload.get("price")
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        raise ServiceException(
+            message="Invalid message format",
+            details={"order_id": message.order_id}
         )
-        await mq_service.publish(settings.response_queue, error_response.to_json())
-        raise
+
+    # created and published as part of a batch
+    response = await invoice_batcher.submit(message, mq_service)
+
+    logger.info("invoice_created",
+                order_id=message.order_id,
+                invoice_id=response.payload["invoice_id"])
+
+
+async def announce_invoice_failure(message, error: Exception):
+    """Publish INVOICE_CREATION_FAILED once an invoice request was dead-lettered."""
+    request = Message.from_amqp(message)
+    error_response = Message(
+        correlation_id=request.correlation_id,
+        order_id=request.order_id,
+        timestamp=datetime.now(),
+        message_type="INVOICE_CREATION_FAILED",
+        payload={"status": OrderStatus.FAILED.value},
+        error={"message": str(error), "type": type(error).__name__},
+        reply_to=request.reply_to
+    )
+    await app.state.rabbitmq_service.publish(settings.response_queue, error_response)
 
 
 async def message_handler(message):
     """Handle RabbitMQ messages."""
     try:
-        message_body = json.loads(message.body.decode("utf-8"))
+        message_body = Message.from_amqp(message)
         await create_invoice(message_body, app.state.rabbitmq_service)
-        await message.ack()
     except Exception as e:
         logger.error("message_processing_failed", error=str(e), message=message.body)
-        await message.nack(requeue=True)
         raise
 
 
@@ -104,7 +208,7 @@ async def startup_event():
 
     app.state.rabbitmq_service = mq_service
 
-    await mq_service.consume(settings.invoice_queue, message_handler)
+    await mq_service.consume(settings.invoice_queue, message_handler, on_dead_letter=announce_invoice_failure)
 
     logger.info("Invoice Service started successfully")
 
@@ -115,6 +219,7 @@ async def shutdown_event():
     mq_service = app.state.rabbitmq_service
     if mq_service:
         await mq_service.close()
+    await idempotency.close()
     logger.info("Invoice Service shutdown completed")
 
 
@@ -1,20 +1,29 @@
 import asyncio
-from fastapi import FastAPI, Depends, HTTPException
+import base64
+from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from prometheus_client import make_asgi_app
 
 from common.types import Message, ServiceException, OrderStatus
+from common.codec import JsonCodec
 from common.monitoring import monitor_message_processing
+from common.tracing import tracer
 from common.mq_service import RabbitMQService
 from common.config import Config
-import json
+from common.log import configure_logging
+from common.dlq import create_dlq_router
+from common.idempotency import IdempotencyCache
+from common.order_store import create_order_store
+from common.sharding import ShardCoordinator
 from datetime import datetime
 import structlog
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 # Initialize FastAPI app
 app = FastAPI(title="Order Service")
 metrics_app = make_asgi_app()
 app.mount("/metrics", metrics_app)
+configure_logging("order_service")
 logger = structlog.get_logger()
 
 
@@ -37,46 +46,54 @@ settings = OrderServiceSettings()
 
 # Order Database
 class OrderDatabase:
-    def __init__(self):
-        self.orders: Dict[str, Dict] = {}
+    def __init__(self, store=None):
+        self.store = store or create_order_store()
 
+    @tracer.traced("db.create_order")
     async def create_order(self, order_id: str, data: dict) -> None:
-        # sleep to simulate
-        await asyncio.sleep(0.5)
-
-        self.orders[order_id] = {
+        await self.store.create(order_id, {
+            "order_id": order_id,
             "created_at": datetime.now().isoformat(),
             "status": OrderStatus.CREATED.value,
             "updates": [],
             **data
-        }
+        })
         logger.info("order_created", order_id=order_id)
 
+    @tracer.traced("db.update_order")
     async def update_order(self, order_id: str, data: dict) -> None:
-        # sleep to simulate
-        await asyncio.sleep(0.5)
-
-        if order_id not in self.orders:
+        update = {
+            "timestamp": datetime.now().isoformat(),
+            "data": data
+        }
+        if not await self.store.update(order_id, data, update):
             raise ServiceException(
                 message="Order not found",
                 details={"order_id": order_id}
             )
-
-        self.orders[order_id].update(data)
-        self.orders[order_id]["updates"].append({
-            "timestamp": datetime.now().isoformat(),
-            "data": data
-        })
         logger.info("order_updated", order_id=order_id, updates=data)
 
     async def get_order(self, order_id: str) -> Optional[Dict]:
-        return self.orders.get(order_id)
+        return await self.store.get(order_id)
 
     async def get_all_orders(self) -> Dict:
-        return self.orders
+        return await self.store.all()
+
+    async def query_orders(self, **filters) -> List[Dict]:
+        return await self.store.query(**filters)
+
+    async def get_orders_by_status(self, status: str) -> List[Dict]:
+        return await self.store.find_by_status(status)
+
+    async def get_orders_by_customer(self, customer_id: str) -> List[Dict]:
+        return await self.store.find_by_customer(customer_id)
+
+    async def close(self) -> None:
+        await self.store.close()
 
 
 db = OrderDatabase()
+json_codec = JsonCodec()
 
 
 # Dependency for RabbitMQ
@@ -87,80 +104,108 @@ def get_rabbitmq_service() -> RabbitMQService:
     return mq
 
 
+app.include_router(create_dlq_router(get_rabbitmq_service))
+
+# drops redeliveries of messages that were already handled successfully
+idempotency = IdempotencyCache(settings.service_name)
+
+
+@idempotency.idempotent
+@monitor_message_processing('order_service', track_saga=True)
+async def handle_order_request(message: Message, mq_service: RabbitMQService):
+    """Process incoming order requests, failures are retried and announced by announce_order_failure."""
+    await db.create_order(message.order_id, message.payload)
+
+    response = Message(
+        correlation_id=message.correlation_id,
+        order_id=message.order_id,
+        timestamp=datetime.now(),
+        message_type="ORDER_ACKNOWLEDGED",
+        payload={"status": OrderStatus.PROCESSING.value},
+        reply_to=message.reply_to
+    )
+
+    # both publishes share one batch and are confirmed together
+    await asyncio.gather(
+        mq_service.publish_nowait(settings.order_response_queue, response),
+        # pass on to find a doener, the request shares the body of the order
+        mq_service.publish_nowait(settings.doener_queue,
+                                  message.forward(message_type="DOENER_REQUESTED", timestamp=datetime.now()))
+    )
+
+
+async def announce_order_failure(message, error: Exception):
+    """Publish ORDER_CREATION_FAILED once an order request was dead-lettered."""
+    request = Message.from_amqp(message)
+    error_response = Message(
+        correlation_id=request.correlation_id,
+        order_id=request.order_id,
+        timestamp=datetime.now(),
+        message_type="ORDER_CREATION_FAILED",
+        payload={"status": OrderStatus.FAILED.value},
+        error={"message": str(error), "type": type(error).__name__},
+        reply_to=request.reply_to
+    )
+    await app.state.rabbitmq_service.publish(settings.order_response_queue, error_response)
+
+
+@idempotency.idempotent
 @monitor_message_processing('order_service')
-async def handle_order_request(message: Dict, mq_service: RabbitMQService):
-    """Process incoming order requests."""
-    try:
-        await db.create_order(message["order_id"], message.get("payload", {}))
-
-        response = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
-            timestamp=datetime.now(),
-            message_type="ORDER_ACKNOWLEDGED",
-            payload={"status": OrderStatus.PROCESSING.value}
-        )
-
-        await mq_service.publish(settings.order_response_queue, response.to_json())
-
-        # pass on to find a doener
-        await mq_service.publish(settings.doener_queue, message)
-
-    except Exception as e:
-        error_response = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
-            timestamp=datetime.now(),
-            message_type="ORDER_CREATION_FAILED",
-            payload={"status": OrderStatus.FAILED.value},
-            error={"message": str(e), "type": type(e).__name__}
-        )
-        await mq_service.publish(settings.order_response_queue, error_response.to_json())
-        raise
-
-
-@monitor_message_processing('order_service')
-async def handle_doener_supplied(message: Dict, mq_service: RabbitMQService):
+async def handle_doener_supplied(message: Message, mq_service: RabbitMQService):
     """Process incoming döner assignment responses."""
     try:
-        await db.update_order(message["order_id"], {
-            "doener_shop": message["payload"]["shop"],
-            "price": message["payload"]["price"],
+        if message.message_type == "DOENER_ASSIGNMENT_FAILED":
+            # announced once doener_service gave up, the order ends here
+            await db.update_order(message.order_id, {"status": OrderStatus.FAILED.value, "error": message.error})
+            logger.warning("order_failed", order_id=message.order_id, reason=message.message_type)
+            return
+
+        await db.update_order(message.order_id, {
+            "doener_shop": message.payload["shop"],
+            "price": message.payload["price"],
             "status": "DOENER_ASSIGNED"
         })
 
         invoice_request = Message(
-            correlation_id=message["correlation_id"],
-            order_id=message["order_id"],
+            correlation_id=message.correlation_id,
+            order_id=message.order_id,
             timestamp=datetime.now(),
             message_type="INVOICE_REQUESTED",
             payload={
-                "price": message["payload"]["price"],
-                "shop": message["payload"]["shop"]
-            }
+                "price": message.payload["price"],
+                "shop": message.payload["shop"]
+            },
+            reply_to=message.reply_to
         )
 
         logger.info("requesting_invoice",
-                    order_id=message["order_id"],
-                    shop_id=message["payload"]["shop"]["id"])
+                    order_id=message.order_id,
+                    shop_id=message.payload["shop"]["id"])
 
-        await mq_service.publish(settings.invoice_queue, invoice_request.to_json())
+        await mq_service.publish(settings.invoice_queue, invoice_request)
 
     except Exception as e:
         logger.error("doener_update_failed",
                      error=str(e),
-                     order_id=message["order_id"])
+                     order_id=message.order_id)
         raise
 
-async def handle_invoice_supplied(message: Dict, mq_service: RabbitMQService):
+@idempotency.idempotent
+@monitor_message_processing('order_service', track_saga=True)
+async def handle_invoice_supplied(message: Message, mq_service: RabbitMQService):
     """Process incoming invoice responses."""
     try:
-        await db.update_order(message["order_id"], {
-            "invoice_id": message["payload"]["invoice_id"],
+        if message.message_type == "INVOICE_CREATION_FAILED":
+            await db.update_order(message.order_id, {"status": OrderStatus.FAILED.value, "error": message.error})
+            logger.warning("order_failed", order_id=message.order_id, reason=message.message_type)
+            return
+
+        await db.update_order(message.order_id, {
+            "invoice_id": message.payload["invoice_id"],
             "status": "INVOICED"
         })
         logger.info("order updated with invoice",
-                    order_id=message["order_id"],
+                    order_id=message.order_id,
         )
     except Exception as e:
         logger.error("invoice_update_failed",
@@ -168,26 +213,20 @@ async def handle_invoice_supplied(message: Dict, mq_service: RabbitMQService):
         )
 
 
-async def message_handler(message):
-    """Handle RabbitMQ messages."""
-    try:
-        message_body = json.loads(message.body.decode("utf-8"))
+def message_handler(handler):
+    """Build the RabbitMQ callback of a queue.
 
-        if message.routing_key == settings.order_queue:
-            await handle_order_request(message_body, app.state.rabbitmq_service)
-        elif message.routing_key == settings.doener_response_queue:
-            await handle_doener_supplied(message_body, app.state.rabbitmq_service)
-        elif message.routing_key == settings.invoice_response_queue:
-            await handle_invoice_supplied(message_body, app.state.rabbitmq_service)
-        else:
-            logger.error("invalid_message_type", message=message.body)
-
-
-        await message.ack()
-    except Exception as e:
-        logger.error("message_processing_failed", error=str(e), message=message.body)
-        await message.nack(requeue=True)
-        raise
+    Dispatch happens per queue rather than on the routing key because
+    retried messages come back through the default exchange.
+    """
+    async def handle_message(message):
+        try:
+            message_body = Message.from_amqp(message)
+            await handler(message_body, app.state.rabbitmq_service)
+        except Exception as e:
+            logger.error("message_processing_failed", error=str(e), message=message.body)
+            raise
+    return handle_message
 
 
 @app.on_event("startup")
@@ -200,9 +239,36 @@ async def startup_event():
 
     app.state.rabbitmq_service = mq_service
 
-    await mq_service.consume(settings.order_queue, message_handler)
-    await mq_service.consume(settings.doener_response_queue, message_handler)
-    await mq_service.consume(settings.invoice_response_queue, message_handler)
+    # every message of an order goes to the same shard, and every shard is
+    # consumed by one replica, so replicas never race on an order
+    handlers = {
+        settings.order_queue: (message_handler(handle_order_request), announce_order_failure),
+        settings.doener_response_queue: (message_handler(handle_doener_supplied), None),
+        settings.invoice_response_queue: (message_handler(handle_invoice_supplied), None),
+    }
+    for queue_name in handlers:
+        await mq_service.declare_shards(queue_name)
+
+    async def assign(shard: int):
+        for queue_name, (handler, on_dead_letter) in handlers.items():
+            await mq_service.consume_shard(queue_name, shard, handler, on_dead_letter)
+
+    async def revoke(shard: int):
+        for queue_name in handlers:
+            await mq_service.cancel_shard(queue_name, shard)
+
+    if Config.ORDER_STORE == "memory":
+        # the memory store only knows the orders of its own process, so shards
+        # must not move between replicas. Shard queues have a single active
+        # consumer, the first replica handles every shard and others wait
+        logger.warning("shard_group_not_joined", order_store=Config.ORDER_STORE,
+                       reason="orders are not shared between replicas")
+        app.state.shards = None
+        for shard in range(Config.ORDER_SHARDS):
+            await assign(shard)
+    else:
+        app.state.shards = ShardCoordinator(mq_service, settings.service_name, assign, revoke)
+        await app.state.shards.start()
 
     logger.info("Order Service started successfully")
 
@@ -212,7 +278,11 @@ async def shutdown_event():
     """Shutdown event to clean up resources."""
     mq_service = app.state.rabbitmq_service
     if mq_service:
+        if app.state.shards:
+            await app.state.shards.close()
         await mq_service.close()
+    await idempotency.close()
+    await db.close()
     logger.info("Order Service shutdown completed")
 
 
@@ -224,14 +294,76 @@ async def get_order(order_id: str):
         raise HTTPException(status_code=404, detail="Order not found")
     return order
 
+def encode_cursor(order: Dict) -> str:
+    return base64.urlsafe_b64encode(json_codec.encode([order["created_at"], order["order_id"]])).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, order_id = json_codec.decode(base64.urlsafe_b64decode(cursor.encode()))
+        return created_at, order_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def project(order: Dict, fields: Optional[List[str]]) -> Dict:
+    if not fields:
+        return order
+    return {field: order[field] for field in fields if field in order}
+
+
 @app.get("/orders")
-async def get_orders():
-    """Get all orders."""
-    return list((await db.get_all_orders()).values())
+async def get_orders(
+    status: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, e.g. order_id,status"),
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    """List orders page by page, newest last.
+
+    Pass `next_cursor` of a page as `cursor` to get the next one. With
+    format=ndjson every matching order is streamed as one JSON line, fetched
+    from the store `limit` orders at a time.
+    """
+    filters = {
+        "status": status,
+        "customer_id": customer_id,
+        "created_after": created_after.isoformat() if created_after else None,
+        "created_before": created_before.isoformat() if created_before else None,
+    }
+    selected_fields = [field.strip() for field in fields.split(",")] if fields else None
+    start = decode_cursor(cursor) if cursor else None
+
+    if format == "ndjson":
+        async def stream_orders():
+            position = start
+            while True:
+                page = await db.query_orders(**filters, cursor=position, limit=limit)
+                for order in page:
+                    yield json_codec.encode(project(order, selected_fields)) + b"\n"
+                if len(page) < limit:
+                    break
+                position = (page[-1]["created_at"], page[-1]["order_id"])
+
+        return StreamingResponse(stream_orders(), media_type="application/x-ndjson")
+
+    page = await db.query_orders(**filters, cursor=start, limit=limit)
+    return {
+        "orders": [project(order, selected_fields) for order in page],
+        "next_cursor": encode_cursor(page[-1]) if len(page) == limit else None,
+    }
 
 
 @app.get("/health")
 async def health_check(mq_service: RabbitMQService = Depends(get_rabbitmq_service)):
     """Health check endpoint."""
     rabbitmq_status = "connected" if mq_service.connection and mq_service.connection.connected else "disconnected"
-    return {"status": "healthy", "service": "order_service", "rabbitmq_status": rabbitmq_status}
\ No newline at end of file
+    shards = app.state.shards
+    return {"status": "healthy", "service": "order_service", "rabbitmq_status": rabbitmq_status,
+            # without a shard group (ORDER_STORE=memory) every shard is consumed, maybe as a standby
+            "shards": sorted(shards.owned) if shards else list(range(Config.ORDER_SHARDS)),
+            "replicas": len(shards.members) if shards else None}
\ No newline at end of file
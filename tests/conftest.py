@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+from datetime import datetime
+from typing import List, Optional
+
+import pytest
+
+# the services read their configuration on import, set it before any test module imports them
+os.environ.setdefault("TRANSPORT", "memory")
+os.environ.setdefault("ORDER_STORE", "memory")
+os.environ.setdefault("ORDER_DB_LATENCY", "0")
+os.environ.setdefault("SHOP_LOOKUP_LATENCY", "0")
+os.environ.setdefault("INVOICE_BACKEND_LATENCY", "0")
+os.environ.setdefault("STATUS_SNAPSHOT_PATH", "")
+os.environ.setdefault("MAX_RETRIES", "2")
+os.environ.setdefault("RETRY_DELAY", "0.01")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.pop("IDEMPOTENCY_DB_PATH", None)
+os.environ.pop("TRACE_DIR", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.mq_service import RabbitMQService  # noqa: E402
+from common.transport import InMemoryBroker, InMemoryTransport  # noqa: E402
+from common.types import Message  # noqa: E402
+
+
+@pytest.fixture(autouse=True, scope="session")
+def close_log_sink():
+    yield
+    from common import log
+    # the sink writes to the stdout pytest captured, which is closed before atexit runs
+    if log._sink is not None:
+        log._sink.close()
+
+
+# helpers shared by the test modules, imported with `from conftest import ...`
+
+def request(order_id: str, message_type: str = "DOENER_REQUESTED", **payload) -> Message:
+    return Message(f"corr-{order_id}", order_id, datetime.now(), message_type, payload)
+
+
+def event(order_id: str, message_type: str = "DOENER_ASSIGNED", reply_to=None) -> Message:
+    return Message("corr", order_id, datetime.now(), message_type, {"status": "DOENER_ASSIGNED"}, reply_to=reply_to)
+
+
+async def settle(condition, timeout: float = 2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+async def services(*names, broker: Optional[InMemoryBroker] = None) -> List[RabbitMQService]:
+    """Started RabbitMQService instances on one in-memory broker."""
+    broker = broker or InMemoryBroker()
+    started = []
+    for name in names:
+        mq_service = RabbitMQService(name, "", InMemoryTransport(broker))
+        await mq_service.initialize()
+        started.append(mq_service)
+    return started
+
+
+async def close(*mq_services):
+    for mq_service in mq_services:
+        await mq_service.close()
+
+
+def collector(received: list):
+    """A handler appending every message it gets to `received`."""
+    async def handler(message):
+        received.append(Message.from_amqp(message))
+    return handler
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from common.concurrency import AdaptiveLimiter
+
+
+def test_limit_grows_while_saturated_and_backs_off_once_per_round_trip():
+    limiter = AdaptiveLimiter("test", "aimd", initial_limit=4, min_limit=2, max_limit=6)
+
+    async def scenario():
+        for _ in range(4):
+            await limiter.acquire()
+        for _ in range(10):
+            limiter.release(0.01, failed=False)
+            await limiter.acquire()
+        grown = limiter.limit
+        limiter.release(0.01, failed=True)
+        backed_off = limiter.limit
+        # started before the last backoff, it says nothing about the new limit
+        limiter.release(time.perf_counter(), failed=True)
+        return grown, backed_off, limiter.limit
+
+    grown, backed_off, after_stale_failure = asyncio.run(scenario())
+    assert grown == 6
+    assert backed_off == 6 * 0.9
+    assert after_stale_failure == backed_off
+
+
+def test_limit_backs_off_on_slow_messages_down_to_the_minimum():
+    limiter = AdaptiveLimiter("test", "slow", initial_limit=10, min_limit=2, max_limit=10, latency_tolerance=2.0)
+
+    async def scenario():
+        await limiter.acquire()
+        limiter.release(0.0001, failed=False)
+        limits = []
+        for _ in range(30):
+            # each slow message started after the previous backoff
+            await asyncio.sleep(0.002)
+            await limiter.acquire()
+            limiter.release(0.001, failed=False)
+            limits.append(limiter.limit)
+        return limits
+
+    limits = asyncio.run(scenario())
+    assert limits[0] == 10 * 0.9
+    assert limits[-1] == 2
+    assert limiter.baseline_latency == 0.0001
+
+
+def test_baseline_forgets_the_fastest_latency_after_two_windows():
+    limiter = AdaptiveLimiter("test", "baseline", baseline_window=0.05)
+
+    async def scenario():
+        baselines = []
+        for latency in (0.01, 0.1, 0.1):
+            await limiter.acquire()
+            limiter.release(latency, failed=False)
+            baselines.append(limiter.baseline_latency)
+            await asyncio.sleep(0.06)
+        return baselines
+
+    # the previous window still counts after the first rotation, not after the second
+    assert asyncio.run(scenario()) == [0.01, 0.01, 0.1]
+
+
+def test_waiters_get_a_slot_once_one_is_released():
+    limiter = AdaptiveLimiter("test", "waiters", initial_limit=1, min_limit=1, max_limit=1)
+
+    async def scenario():
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        blocked = not waiter.done()
+        limiter.release(0.01, failed=False)
+        await asyncio.wait_for(waiter, 1)
+        return blocked, limiter.in_flight
+
+    blocked, in_flight = asyncio.run(scenario())
+    assert blocked
+    assert in_flight == 1
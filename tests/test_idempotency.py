@@ -0,0 +1,154 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from common.idempotency import IdempotencyCache, SQLiteProcessedStore
+from common.types import Message
+
+
+def message(correlation_id: str = "corr") -> Message:
+    return Message(correlation_id, "order-1", datetime.now(), "ORDER_CREATED", {})
+
+
+def test_duplicates_are_dropped():
+    cache = IdempotencyCache("test")
+    calls = []
+
+    @cache.idempotent
+    async def handler(message):
+        calls.append(message.correlation_id)
+
+    async def scenario():
+        await handler(message("a"))
+        await handler(message("a"))
+        await handler(message("b"))
+
+    asyncio.run(scenario())
+    assert calls == ["a", "b"]
+
+
+def test_failed_deliveries_are_not_remembered():
+    cache = IdempotencyCache("test")
+    attempts = []
+
+    @cache.idempotent
+    async def handler(message):
+        attempts.append(message.correlation_id)
+        if len(attempts) == 1:
+            raise RuntimeError("transient")
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await handler(message())
+        await handler(message())
+        await handler(message())
+
+    asyncio.run(scenario())
+    assert len(attempts) == 2
+
+
+def test_concurrent_duplicates_run_once():
+    cache = IdempotencyCache("test")
+    calls = []
+
+    @cache.idempotent
+    async def handler(message):
+        calls.append(message.correlation_id)
+        await asyncio.sleep(0.01)
+
+    async def scenario():
+        await asyncio.gather(*(handler(message()) for _ in range(5)))
+
+    asyncio.run(scenario())
+    assert calls == ["corr"]
+
+
+def test_expired_keys_are_processed_again():
+    cache = IdempotencyCache("test", ttl=0.01)
+    calls = []
+
+    @cache.idempotent
+    async def handler(message):
+        calls.append(message.correlation_id)
+
+    async def scenario():
+        await handler(message())
+        await asyncio.sleep(0.02)
+        await handler(message())
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_store_survives_a_restart(tmp_path):
+    path = str(tmp_path / "processed.db")
+    calls = []
+
+    async def run_once():
+        cache = IdempotencyCache("test", store=SQLiteProcessedStore(path))
+
+        @cache.idempotent
+        async def handler(message):
+            calls.append(message.correlation_id)
+
+        await handler(message())
+        await cache.close()
+
+    asyncio.run(run_once())
+    asyncio.run(run_once())
+    assert calls == ["corr"]
+
+
+def test_store_prunes_expired_keys(tmp_path):
+    async def scenario():
+        store = SQLiteProcessedStore(str(tmp_path / "processed.db"), ttl=0.05, prune_interval=0)
+        await asyncio.gather(*(store.add((f"old-{i}", "ORDER_CREATED")) for i in range(10)))
+        await asyncio.sleep(0.1)
+        await store.add(("new", "ORDER_CREATED"))
+        rows = store._read_conn.execute("SELECT correlation_id FROM processed_messages").fetchall()
+        found = await store.contains(("new", "ORDER_CREATED")), await store.contains(("old-0", "ORDER_CREATED"))
+        await store.close()
+        return rows, found
+
+    rows, (new_found, old_found) = asyncio.run(scenario())
+    assert rows == [("new",)]
+    assert new_found and not old_found
+
+
+class FlakyStore:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.keys = set()
+
+    async def contains(self, key) -> bool:
+        return key in self.keys
+
+    async def add(self, key):
+        await asyncio.sleep(0.01)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        self.keys.add(key)
+
+
+def test_unpersisted_keys_are_not_processed():
+    cache = IdempotencyCache("test", store=FlakyStore(failures=1))
+    calls = []
+
+    @cache.idempotent
+    async def handler(message):
+        calls.append(message.correlation_id)
+        await asyncio.sleep(0.01)
+
+    async def scenario():
+        first, duplicate = await asyncio.gather(handler(message()), handler(message()), return_exceptions=True)
+        await handler(message())
+        return first, duplicate
+
+    first, duplicate = asyncio.run(asyncio.wait_for(scenario(), 1))
+    assert isinstance(first, OSError)
+    # the waiting duplicate took over once the first delivery failed
+    assert duplicate is None
+    assert calls == ["corr", "corr"]
+    assert cache.store.keys == {("corr", "ORDER_CREATED")}
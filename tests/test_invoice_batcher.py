@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from common.types import ServiceException
+from conftest import close, collector, request, services, settle
+from invoice_service import InvoiceBatcher, create_invoice
+
+
+def invoice_request(order_id: str, price=8.5):
+    return request(order_id, "INVOICE_REQUESTED", price=price)
+
+
+async def invoicing():
+    """An invoice_service and what it published as invoice_supplied."""
+    invoice, order = await services("invoice_service", "order_service")
+    published = []
+    await order.consume_events("invoices", collector(published), ["invoice_supplied"])
+    return invoice, order, published
+
+
+def test_full_batches_are_created_and_published_together():
+    batcher = InvoiceBatcher(max_batch=3, window=10)
+
+    async def scenario():
+        invoice, order, published = await invoicing()
+        responses = await asyncio.gather(*(batcher.submit(invoice_request(f"order-{i}"), invoice)
+                                           for i in range(3)))
+        await settle(lambda: len(published) == 3)
+        await close(invoice, order)
+        return responses, published
+
+    responses, published = asyncio.run(scenario())
+    assert [response.payload["total"] for response in responses] == [10.0] * 3
+    assert {message.order_id for message in published} == {"order-0", "order-1", "order-2"}
+
+
+def test_a_partial_batch_is_flushed_after_the_window():
+    batcher = InvoiceBatcher(max_batch=100, window=0.01)
+
+    async def scenario():
+        invoice, order, published = await invoicing()
+        response = await asyncio.wait_for(batcher.submit(invoice_request("order-1"), invoice), 1)
+        await close(invoice, order)
+        return response
+
+    assert asyncio.run(scenario()).payload["invoice_id"] == "INV-order-1"
+
+
+def test_an_invoice_that_fails_only_fails_its_own_request():
+    batcher = InvoiceBatcher(max_batch=3, window=10)
+
+    async def scenario():
+        invoice, order, published = await invoicing()
+        results = await asyncio.gather(
+            batcher.submit(invoice_request("order-1"), invoice),
+            batcher.submit(invoice_request("poison", price="8.50"), invoice),
+            batcher.submit(invoice_request("order-2"), invoice),
+            return_exceptions=True
+        )
+        await settle(lambda: len(published) == 2)
+        await close(invoice, order)
+        return results, published
+
+    (first, poison, second), published = asyncio.run(scenario())
+    assert isinstance(poison, TypeError)
+    assert (first.order_id, second.order_id) == ("order-1", "order-2")
+    assert {message.order_id for message in published} == {"order-1", "order-2"}
+
+
+@pytest.mark.parametrize("price", ["8.50", True, None])
+def test_requests_without_a_numeric_price_are_rejected(price):
+    async def scenario():
+        invoice, = await services("invoice_service")
+        try:
+            with pytest.raises(ServiceException):
+                await create_invoice(invoice_request(f"order-{price}", price=price), invoice)
+        finally:
+            await close(invoice)
+
+    asyncio.run(scenario())
@@ -0,0 +1,78 @@
+import asyncio
+
+from common.order_store import InMemoryOrderStore, SQLiteOrderStore
+
+
+def order(created_at: str, customer_id: str = "c1", status: str = "CREATED") -> dict:
+    return {"created_at": created_at, "customer_id": customer_id, "status": status, "updates": []}
+
+
+def test_query_filters_and_pages_by_created_at():
+    async def scenario():
+        store = InMemoryOrderStore(latency=0)
+        for i in range(6):
+            await store.create(f"o{i}", order(f"2026-01-0{i + 1}", customer_id="c1" if i % 2 else "c2"))
+        await store.update("o3", {"status": "INVOICED"}, {"status": "INVOICED"})
+
+        first = await store.query(limit=2)
+        cursor = (first[-1]["created_at"], "o1")
+        second = await store.query(cursor=cursor, limit=2)
+        by_customer = await store.query(customer_id="c1")
+        invoiced = await store.query(status="INVOICED")
+        window = await store.query(created_after="2026-01-02", created_before="2026-01-05")
+        filtered = await store.query(customer_id="c1", status="CREATED")
+        return first, second, by_customer, invoiced, window, filtered
+
+    first, second, by_customer, invoiced, window, filtered = asyncio.run(scenario())
+    assert [o["created_at"] for o in first] == ["2026-01-01", "2026-01-02"]
+    assert [o["created_at"] for o in second] == ["2026-01-03", "2026-01-04"]
+    assert [o["created_at"] for o in by_customer] == ["2026-01-02", "2026-01-04", "2026-01-06"]
+    assert [o["created_at"] for o in invoiced] == ["2026-01-04"]
+    assert [o["created_at"] for o in window] == ["2026-01-02", "2026-01-03", "2026-01-04"]
+    assert [o["created_at"] for o in filtered] == ["2026-01-02", "2026-01-06"]
+
+
+def test_history_is_bounded():
+    async def scenario():
+        store = InMemoryOrderStore(latency=0, history_limit=3)
+        await store.create("o1", order("2026-01-01"))
+        for i in range(10):
+            await store.update("o1", {"step": i}, {"step": i})
+        return store
+
+    store = asyncio.run(scenario())
+    assert [update["step"] for update in store.orders["o1"]["updates"]] == [7, 8, 9]
+    assert store.history_entries == 3
+
+
+def test_completed_orders_are_evicted_into_the_archive(tmp_path):
+    async def scenario():
+        archive = SQLiteOrderStore(str(tmp_path / "archive.db"))
+        store = InMemoryOrderStore(latency=0, retention_ttl=0, archive=archive)
+        await store.create("done", order("2026-01-01"))
+        await store.create("open", order("2026-01-02"))
+        await store.update("done", {"status": "INVOICED"}, {"status": "INVOICED"})
+        # expiries are popped on the next write
+        await store.update("open", {"status": "PROCESSING"}, {"status": "PROCESSING"})
+        result = (set(store.orders), await store.query(status="INVOICED"), await store.get("done"))
+        await store.close()
+        return result
+
+    in_memory, invoiced, archived = asyncio.run(scenario())
+    assert in_memory == {"open"}
+    assert invoiced == []
+    assert archived["status"] == "INVOICED"
+
+
+def test_orders_that_left_their_terminal_state_are_kept():
+    async def scenario():
+        store = InMemoryOrderStore(latency=0, retention_ttl=0.01)
+        await store.create("o1", order("2026-01-01"))
+        await store.update("o1", {"status": "FAILED"}, {"status": "FAILED"})
+        await store.update("o1", {"status": "PROCESSING"}, {"status": "PROCESSING"})
+        await asyncio.sleep(0.02)
+        await store.create("o2", order("2026-01-02"))
+        return store
+
+    store = asyncio.run(scenario())
+    assert set(store.orders) == {"o1", "o2"}
@@ -0,0 +1,92 @@
+import asyncio
+
+from common.config import Config
+from common.sharding import shard_of
+from common.types import Message
+from conftest import close, request, services, settle
+
+
+def test_failures_are_retried_then_dead_lettered_once():
+    attempts, dead_letters = [], []
+
+    async def handler(message):
+        attempts.append(message.headers.get(Config.RETRY_COUNT_HEADER, 0))
+        raise RuntimeError("shop closed")
+
+    async def on_dead_letter(message, error):
+        dead_letters.append((Message.from_amqp(message).order_id, str(error)))
+
+    async def scenario():
+        mq_service, = await services("doener_service")
+        await mq_service.consume("doener_requests", handler, on_dead_letter=on_dead_letter)
+        await mq_service.publish("doener_requests", request("order-1"))
+        await settle(lambda: dead_letters)
+        await asyncio.sleep(0.05)
+        inspected = await mq_service.inspect_dlq("doener_requests")
+        await mq_service.close()
+        return inspected
+
+    inspected = asyncio.run(scenario())
+    assert attempts == list(range(Config.MAX_RETRIES + 1))
+    assert dead_letters == [("order-1", "shop closed")]
+    assert [entry["queue"] for entry in inspected] == ["doener_requests"]
+    assert inspected[0]["headers"]["x-last-error"] == "RuntimeError: shop closed"
+
+
+def test_replayed_dead_letters_get_a_fresh_retry_budget():
+    attempts = []
+
+    async def handler(message):
+        attempts.append(message.headers.get(Config.RETRY_COUNT_HEADER, 0))
+        if len(attempts) <= Config.MAX_RETRIES + 1:
+            raise RuntimeError("backend down")
+
+    async def scenario():
+        mq_service, = await services("invoice_service")
+        await mq_service.consume("invoice_requests", handler)
+        await mq_service.publish("invoice_requests", request("order-1", "INVOICE_REQUESTED"))
+        await settle(lambda: len(attempts) == Config.MAX_RETRIES + 1)
+        await asyncio.sleep(0.05)
+        replayed = await mq_service.replay_dlq("invoice_requests")
+        await settle(lambda: len(attempts) == Config.MAX_RETRIES + 2)
+        left = await mq_service.inspect_dlq("invoice_requests")
+        await mq_service.close()
+        return replayed, left
+
+    replayed, left = asyncio.run(scenario())
+    assert replayed == 1
+    assert attempts[-1] == 0
+    assert left == []
+
+
+def test_dead_letters_of_a_sharded_queue_are_read_over_all_shards():
+    order_ids = [f"order-{i}" for i in range(8)]
+
+    async def handler(message):
+        raise RuntimeError("database down")
+
+    async def scenario():
+        api, order = await services("api_service", "order_service")
+        await order.declare_shards("doener_supplied")
+        for shard in range(Config.ORDER_SHARDS):
+            await order.consume_shard("order_requests", shard, handler)
+            await order.consume_shard("doener_supplied", shard, handler)
+        for order_id in order_ids:
+            await api.publish("order_requests", request(order_id, "ORDER_CREATED"))
+            await api.publish("doener_supplied", request(order_id, "DOENER_ASSIGNED"))
+        await asyncio.sleep(0.3)
+        requests = await order.inspect_dlq("order_requests", limit=100)
+        events = await order.inspect_dlq("doener_supplied", limit=100)
+        limited = await order.inspect_dlq("order_requests", limit=3)
+        one_shard = await order.inspect_dlq("doener_supplied", shard=shard_of("order-0"))
+        replayed = await order.replay_dlq("order_requests", limit=5)
+        await close(api, order)
+        return requests, events, limited, one_shard, replayed
+
+    requests, events, limited, one_shard, replayed = asyncio.run(scenario())
+    assert len(requests) == len(events) == len(order_ids)
+    assert {entry["queue"] for entry in requests} == \
+           {f"order_requests.shard.{shard_of(order_id)}" for order_id in order_ids}
+    assert len(limited) == 3
+    assert {entry["queue"] for entry in one_shard} == {f"doener_supplied.order_service.shard.{shard_of('order-0')}"}
+    assert replayed == 5
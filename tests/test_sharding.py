@@ -0,0 +1,65 @@
+import asyncio
+
+from common.mq_service import RabbitMQService
+from common.sharding import ShardCoordinator, owner_of, shard_of
+from common.transport import InMemoryBroker, InMemoryTransport
+from conftest import settle
+
+SHARDS = 16
+
+
+def test_shard_of_is_stable_and_in_range():
+    order_ids = [f"order-{i}" for i in range(200)]
+    shards = [shard_of(order_id, SHARDS) for order_id in order_ids]
+    assert shards == [shard_of(order_id, SHARDS) for order_id in order_ids]
+    assert set(shards) == set(range(SHARDS))
+
+
+def test_owner_of_only_moves_the_shards_of_a_leaving_member():
+    members = [f"order_service.{i:012x}" for i in range(4)]
+    before = {shard: owner_of(shard, members) for shard in range(SHARDS)}
+    after = {shard: owner_of(shard, members[1:]) for shard in range(SHARDS)}
+    assert len(set(before.values())) > 1
+    assert {shard for shard in range(SHARDS) if before[shard] != after[shard]} == \
+           {shard for shard in range(SHARDS) if before[shard] == members[0]}
+
+
+class Replica:
+    def __init__(self, broker: InMemoryBroker):
+        self.mq_service = RabbitMQService("order_service", "", InMemoryTransport(broker))
+        self.owned = set()
+        self.coordinator = ShardCoordinator(self.mq_service, "order_service", self.assign, self.revoke,
+                                            shards=SHARDS, heartbeat_interval=0.02)
+
+    async def assign(self, shard: int):
+        self.owned.add(shard)
+
+    async def revoke(self, shard: int):
+        self.owned.discard(shard)
+
+    async def start(self):
+        await self.mq_service.initialize()
+        await self.coordinator.start()
+
+    async def close(self):
+        await self.coordinator.close()
+        await self.mq_service.close()
+
+
+def test_replicas_split_the_shards_and_take_over_on_leave():
+    async def scenario():
+        broker = InMemoryBroker()
+        first, second = Replica(broker), Replica(broker)
+        await first.start()
+        await settle(lambda: first.owned == set(range(SHARDS)))
+        await second.start()
+        await settle(lambda: first.owned | second.owned == set(range(SHARDS))
+                     and not first.owned & second.owned and second.owned)
+        split = set(first.owned), set(second.owned)
+        await second.close()
+        await settle(lambda: first.owned == set(range(SHARDS)))
+        await first.close()
+        return split
+
+    first_owned, second_owned = asyncio.run(scenario())
+    assert first_owned and second_owned
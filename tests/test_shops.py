@@ -0,0 +1,154 @@
+import asyncio
+import time
+
+import pytest
+
+from common.types import ServiceException
+from conftest import request, settle
+from doener_service import DoenerShopFinder, ShopAssignmentEngine, ShopAvailabilityCache
+
+
+def shop(shop_id: str, price: float = 8.0, capacity: int = 10, prep_time: float = 300) -> dict:
+    return {"id": shop_id, "name": shop_id, "price": price, "capacity": capacity, "prep_time": prep_time}
+
+
+class Upstream:
+    """Shop lookups answering with the number of the call, failing when told to."""
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.calls = 0
+        self.fail = False
+
+    async def fetch(self):
+        self.calls += 1
+        call = self.calls
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("upstream down")
+        return [shop(f"shop-{call}")]
+
+
+def test_concurrent_misses_share_one_lookup():
+    upstream = Upstream()
+    cache = ShopAvailabilityCache(upstream.fetch, ttl=10, stale_ttl=10)
+
+    async def scenario():
+        first = await asyncio.gather(*(cache.get() for _ in range(5)))
+        return first, await cache.get()
+
+    first, cached = asyncio.run(scenario())
+    assert upstream.calls == 1
+    assert all(shops is first[0] for shops in first)
+    assert cached is first[0]
+
+
+def test_stale_shops_are_served_while_one_refresh_runs():
+    upstream = Upstream()
+    cache = ShopAvailabilityCache(upstream.fetch, ttl=0.01, stale_ttl=10)
+
+    async def scenario():
+        fresh = await cache.get()
+        await asyncio.sleep(0.02)
+        stale = await asyncio.gather(*(cache.get() for _ in range(3)))
+        await settle(lambda: cache.value is not fresh)
+        return fresh, stale
+
+    fresh, stale = asyncio.run(scenario())
+    assert all(shops is fresh for shops in stale)
+    assert upstream.calls == 2
+    assert cache.value[0]["id"] == "shop-2"
+
+
+def test_a_failed_refresh_keeps_the_stale_shops_until_they_expire():
+    upstream = Upstream()
+    cache = ShopAvailabilityCache(upstream.fetch, ttl=0.01, stale_ttl=0.05)
+
+    async def scenario():
+        fresh = await cache.get()
+        upstream.fail = True
+        await asyncio.sleep(0.02)
+        stale = await cache.get()
+        await asyncio.sleep(0.05)
+        with pytest.raises(RuntimeError):
+            await cache.get()
+        return fresh, stale
+
+    fresh, stale = asyncio.run(scenario())
+    assert stale is fresh
+
+
+def test_orders_go_to_the_best_scoring_shop_with_capacity():
+    engine = ShopAssignmentEngine()
+    engine.sync_shops([shop("cheap", price=5.0, capacity=1), shop("pricey", price=10.0, capacity=1)])
+
+    assigned = [engine.assign(order_id) for order_id in ("a", "b", "c")]
+    assert [shop and shop["id"] for shop in assigned] == ["cheap", "pricey", None]
+    # a redelivered request keeps its shop and doesn't take more capacity
+    assert engine.assign("a")["id"] == "cheap"
+    assert engine.in_flight == {"cheap": 1, "pricey": 1}
+
+
+def test_load_spreads_orders_over_shops():
+    engine = ShopAssignmentEngine()
+    engine.sync_shops([shop("cheap", price=5.0), shop("pricey", price=6.0)])
+
+    picks = [engine.assign(f"order-{i}")["id"] for i in range(10)]
+    assert picks[0] == "cheap"
+    assert engine.in_flight["cheap"] >= engine.in_flight["pricey"] > 0
+
+
+def test_released_capacity_can_be_assigned_again():
+    engine = ShopAssignmentEngine()
+    engine.sync_shops([shop("only", capacity=1)])
+
+    engine.assign("a")
+    assert engine.assign("b") is None
+    engine.release("a")
+    engine.release("a")
+    assert engine.in_flight["only"] == 0
+    assert engine.assign("b")["id"] == "only"
+
+
+def test_reservations_of_other_replicas_take_capacity():
+    engine = ShopAssignmentEngine()
+    engine.sync_shops([shop("cheap", price=5.0, capacity=1), shop("pricey", price=10.0, capacity=1)])
+
+    engine.reserve("elsewhere", "cheap")
+    assert engine.assign("a")["id"] == "pricey"
+
+
+def test_lost_orders_give_their_capacity_back_after_the_timeout():
+    engine = ShopAssignmentEngine(assignment_timeout=0.01)
+    engine.sync_shops([shop("only", capacity=1)])
+
+    engine.assign("lost")
+    time.sleep(0.02)
+    assert engine.assign("next")["id"] == "only"
+    assert engine.assignments == {"next": "only"}
+
+
+def test_outdated_heap_entries_are_dropped():
+    engine = ShopAssignmentEngine()
+    engine.sync_shops([shop(f"shop-{i}") for i in range(5)])
+
+    for i in range(1000):
+        engine.assign(f"order-{i}")
+        engine.release(f"order-{i}")
+    assert len(engine._heap) <= 4 * len(engine.shops) + 64
+    assert sum(engine.in_flight.values()) == 0
+
+
+def test_a_rejected_batch_keeps_the_reservations_of_redelivered_orders():
+    finder = DoenerShopFinder()
+    finder.shops = [shop("shop1", capacity=2)]
+    finder.engine = ShopAssignmentEngine()
+
+    async def scenario():
+        await finder.find_available_shops([request("a")])
+        with pytest.raises(ServiceException):
+            await finder.find_available_shops([request("a"), request("b"), request("c")])
+
+    asyncio.run(scenario())
+    assert finder.engine.assignments == {"a": "shop1"}
+    assert finder.engine.in_flight["shop1"] == 1
@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from api_service import OrderStatusView
+from common.types import Message
+
+START = datetime(2026, 1, 1, 12, 0)
+
+
+def apply(view: OrderStatusView, message_type: str, status: str, seconds: int, **payload) -> str:
+    view.apply(Message("corr", "order-1", START + timedelta(seconds=seconds), message_type,
+                       {"status": status, **payload}))
+    return view.get("order-1")["status"]
+
+
+def test_statuses_only_move_forward():
+    view = OrderStatusView(snapshot_path="")
+    apply(view, "ORDER_CREATED", "CREATED", 0)
+    apply(view, "DOENER_ASSIGNED", "DOENER_ASSIGNED", 2, shop={"id": "shop1"})
+    assert apply(view, "ORDER_ACKNOWLEDGED", "PROCESSING", 1) == "DOENER_ASSIGNED"
+    assert apply(view, "INVOICE_CREATED", "INVOICED", 3, invoice_id="INV-1") == "INVOICED"
+    assert view.get("order-1")["shop_id"] == "shop1"
+    assert view.get("order-1")["invoice_id"] == "INV-1"
+
+
+def test_failed_is_not_sticky():
+    view = OrderStatusView(snapshot_path="")
+    apply(view, "ORDER_CREATED", "CREATED", 0)
+    assert apply(view, "DOENER_ASSIGNMENT_FAILED", "FAILED", 2) == "FAILED"
+    # published before the failure, arriving late
+    assert apply(view, "ORDER_ACKNOWLEDGED", "PROCESSING", 1) == "FAILED"
+    # the dead letter was replayed and the order went on
+    assert apply(view, "DOENER_ASSIGNED", "DOENER_ASSIGNED", 3) == "DOENER_ASSIGNED"
+    assert apply(view, "INVOICE_CREATED", "INVOICED", 4) == "INVOICED"
+
+
+def test_failed_does_not_override_invoiced():
+    view = OrderStatusView(snapshot_path="")
+    apply(view, "INVOICE_CREATED", "INVOICED", 1)
+    assert apply(view, "INVOICE_CREATION_FAILED", "FAILED", 2) == "INVOICED"
+
+
+def test_least_recently_updated_orders_are_evicted():
+    view = OrderStatusView(max_orders=2, snapshot_path="")
+    for order_id in ("a", "b", "c"):
+        view.apply(Message("corr", order_id, START, "ORDER_CREATED", {"status": "CREATED"}))
+    assert view.get("a") is None
+    assert view.get("c")["status"] == "CREATED"
+
+
+def test_restored_orders_are_revalidated_until_updated(tmp_path):
+    fetched = []
+
+    async def fetch(order_id):
+        fetched.append(order_id)
+        return {"order_id": order_id, "status": "INVOICED", "created_at": "2026-01-01T12:00:05", "updates": []}
+
+    async def scenario():
+        before = OrderStatusView(snapshot_path=str(tmp_path / "status.json"))
+        apply(before, "ORDER_ACKNOWLEDGED", "PROCESSING", 0)
+        await before.save()
+        after = OrderStatusView(snapshot_path=str(tmp_path / "status.json"), fetch=fetch)
+        after.load()
+        revalidated = await after.lookup("order-1")
+        apply(after, "DOENER_ASSIGNED", "DOENER_ASSIGNED", 1)
+        return revalidated, await after.lookup("order-1")
+
+    revalidated, updated = asyncio.run(scenario())
+    assert revalidated["status"] == "INVOICED"
+    assert updated["status"] == "DOENER_ASSIGNED"
+    assert fetched == ["order-1"]
@@ -0,0 +1,105 @@
+import asyncio
+
+from common.sharding import shard_of
+from common.transport import AmqpTransport, topic_matches
+from common.types import Message
+from conftest import close, collector, event, services
+
+
+def test_topic_matches():
+    assert topic_matches("doener_supplied.#", "doener_supplied.3.order")
+    assert topic_matches("doener_supplied.#", "doener_supplied")
+    assert topic_matches("doener_supplied.3.#", "doener_supplied.3.order.replica")
+    assert not topic_matches("doener_supplied.3.#", "doener_supplied.13.order")
+    assert topic_matches("*.*.*.replica", "invoice_supplied.0.order.replica")
+    assert not topic_matches("*.*.*.replica", "invoice_supplied.0.order")
+    assert not topic_matches("*.*.*.replica", "invoice_supplied.0.order.other")
+
+
+def test_request_queue_routes_to_the_shard_of_the_order():
+    async def scenario():
+        api, order = await services("api_service", "order_service")
+        received = []
+        shard = shard_of("order-1")
+        await order.consume_shard("order_requests", shard, collector(received))
+        await api.publish("order_requests", event("order-1", "ORDER_CREATED"))
+        await asyncio.sleep(0.05)
+        await close(api, order)
+        return received
+
+    received = asyncio.run(scenario())
+    assert [message.order_id for message in received] == ["order-1"]
+
+
+def test_events_reach_the_replica_named_by_reply_to():
+    async def scenario():
+        creator, other, doener = await services("api_service", "api_service", "doener_service")
+        at_creator, at_other = [], []
+        await creator.consume_private(collector(at_creator))
+        await other.consume_private(collector(at_other))
+        await doener.publish("doener_supplied", event("order-1", reply_to=creator.instance_key))
+        await asyncio.sleep(0.05)
+        await close(creator, other, doener)
+        return creator.instance_key, at_creator, at_other
+
+    creator_key, at_creator, at_other = asyncio.run(scenario())
+    assert [message.order_id for message in at_creator] == ["order-1"]
+    assert at_creator[0].reply_to == creator_key
+    assert at_other == []
+
+
+def test_subscribe_order_routes_an_order_of_another_replica_once():
+    async def scenario():
+        creator, other, doener = await services("api_service", "api_service", "doener_service")
+        at_creator, at_other = [], []
+        await creator.consume_private(collector(at_creator))
+        await other.consume_private(collector(at_other))
+        await other.subscribe_order("order-1")
+        # matches the replica binding as well, the queue still gets one copy
+        await creator.subscribe_order("order-1")
+        await doener.publish("doener_supplied", event("order-1", reply_to=creator.instance_key))
+        await asyncio.sleep(0.05)
+        await other.unsubscribe_order("order-1")
+        await doener.publish("doener_supplied", event("order-1", "DOENER_ASSIGNMENT_FAILED",
+                                                      reply_to=creator.instance_key))
+        await asyncio.sleep(0.05)
+        await close(creator, other, doener)
+        return at_creator, at_other
+
+    at_creator, at_other = asyncio.run(scenario())
+    assert [message.message_type for message in at_creator] == ["DOENER_ASSIGNED", "DOENER_ASSIGNMENT_FAILED"]
+    assert [message.message_type for message in at_other] == ["DOENER_ASSIGNED"]
+
+
+def test_reply_to_survives_forward():
+    message = event("order-1", reply_to="replica")
+    forwarded = message.forward(message_type="DOENER_REQUESTED")
+    assert forwarded.reply_to == "replica"
+    assert "reply_to" not in forwarded.to_json()
+
+
+def test_reply_to_travels_as_amqp_property():
+    outgoing = AmqpTransport().message(event("order-1", reply_to="replica"), event("order-1").amqp_headers())
+    received = Message.from_amqp(outgoing)
+    assert outgoing.reply_to == "replica"
+    assert (received.order_id, received.reply_to) == ("order-1", "replica")
+
+
+def test_close_publishes_the_batch_waiting_for_its_window():
+    async def scenario():
+        api, order = await services("api_service", "order_service")
+        api.batch_window = 0.2
+        received = []
+        await order.consume_shard("order_requests", shard_of("order-1"), collector(received))
+        confirmation = api.publish_nowait("order_requests", event("order-1", "ORDER_CREATED"))
+        await asyncio.sleep(0.01)
+        await api.close()
+        await asyncio.wait_for(confirmation, 1)
+        after_close = api.publish_nowait("order_requests", event("order-2", "ORDER_CREATED"))
+        await asyncio.sleep(0.05)
+        await close(order)
+        return received, after_close
+
+    received, after_close = asyncio.run(scenario())
+    assert [message.order_id for message in received] == ["order-1"]
+    assert isinstance(after_close.exception(), RuntimeError)
@@ -0,0 +1,190 @@
+"""Rebuild the critical path of orders from the span files written by common.tracing.
+
+    python tools/trace_report.py traces/                 # where the time went, over all orders
+    python tools/trace_report.py traces/ --order <id>    # critical path of one order
+    python tools/trace_report.py traces/ --slowest 5     # critical paths of the 5 slowest orders
+
+The critical path of an order is the chain of spans that its end-to-end
+latency waited on: starting from the span that finished last, walk back
+through the children that were still running, attributing every moment to
+exactly one span. Time in the queues, in handlers and in the spans inside
+them, e.g. database writes or the shop lookup, is shown separately.
+
+docker-compose.yml records 1% of the orders, run it with TRACE_SAMPLE_RATE=1
+to trace every order.
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+Segment = Tuple[str, float, float]  # (span name, start, end)
+
+
+class SpanNode:
+    __slots__ = ("span_id", "parent_id", "name", "service", "start", "end", "attributes", "children", "tree_end")
+
+    def __init__(self, span: dict):
+        self.span_id = span["span_id"]
+        self.parent_id = span["parent_id"]
+        self.name = span["name"]
+        self.service = span["service"]
+        self.start = span["start"]
+        self.end = span["start"] + span["duration"]
+        self.attributes = span.get("attributes") or {}
+        self.children: List["SpanNode"] = []
+        self.tree_end = self.end
+
+
+def load_spans(paths: List[str]) -> Dict[str, List[dict]]:
+    """Spans of all files, grouped by trace id."""
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "*.jsonl"))) if os.path.isdir(path) else [path])
+
+    traces: Dict[str, List[dict]] = defaultdict(list)
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    span = json.loads(line)
+                    traces[span["trace_id"]].append(span)
+    return traces
+
+
+def build_tree(spans: List[dict]) -> List[SpanNode]:
+    """Link the spans of a trace, returning its roots."""
+    nodes = {span["span_id"]: SpanNode(span) for span in spans}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node.parent_id)
+        if parent is None:
+            roots.append(node)
+        else:
+            parent.children.append(node)
+
+    # messages are handled after their publisher finished, a subtree may end after its root
+    def close(node: SpanNode) -> float:
+        for child in node.children:
+            node.tree_end = max(node.tree_end, close(child))
+        return node.tree_end
+
+    for root in roots:
+        close(root)
+    return roots
+
+
+def critical_path(node: SpanNode, cursor: float) -> List[Segment]:
+    """Segments of the node's subtree the time up to `cursor` waited on, latest first."""
+    segments = []
+    for child in sorted(node.children, key=lambda child: child.tree_end, reverse=True):
+        if child.tree_end <= node.start or child.start >= cursor:
+            continue
+        child_end = min(child.tree_end, cursor)
+        if child_end < cursor:
+            segments.append((node.name, child_end, cursor))
+        segments.extend(critical_path(child, child_end))
+        cursor = max(child.start, node.start)
+        if cursor <= node.start:
+            break
+    if cursor > node.start:
+        segments.append((node.name, node.start, cursor))
+    return segments
+
+
+def analyze(spans: List[dict]) -> Optional[dict]:
+    roots = build_tree(spans)
+    if not roots:
+        return None
+    # clock skew or missing files can break a trace apart, report its biggest piece
+    root = max(roots, key=lambda root: root.tree_end - root.start)
+    segments = list(reversed(critical_path(root, root.tree_end)))
+
+    # merge consecutive segments of the same span
+    path: List[List] = []
+    for name, start, end in segments:
+        if path and path[-1][0] == name:
+            path[-1][2] = end
+        else:
+            path.append([name, start, end])
+
+    order_id = next((span["attributes"].get("order_id") for span in spans
+                     if (span.get("attributes") or {}).get("order_id")), None)
+    return {
+        "order_id": order_id,
+        "trace_id": spans[0]["trace_id"],
+        "duration": root.tree_end - root.start,
+        "spans": len(spans),
+        "path": [(name, end - start) for name, start, end in path],
+    }
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def print_path(report: dict):
+    print(f"order {report['order_id']}  trace {report['trace_id']}  "
+          f"{report['duration'] * 1000:.1f} ms  {report['spans']} spans")
+    for name, duration in report["path"]:
+        share = duration / report["duration"] * 100 if report["duration"] else 0
+        print(f"  {duration * 1000:10.1f} ms  {share:5.1f}%  {name}")
+
+
+def print_summary(reports: List[dict]):
+    per_name: Dict[str, List[float]] = defaultdict(list)
+    for report in reports:
+        totals: Dict[str, float] = defaultdict(float)
+        for name, duration in report["path"]:
+            totals[name] += duration
+        for name, duration in totals.items():
+            per_name[name].append(duration)
+
+    durations = [report["duration"] for report in reports]
+    total = sum(durations)
+    print(f"{len(reports)} orders  p50 {percentile(durations, 0.5) * 1000:.1f} ms  "
+          f"p95 {percentile(durations, 0.95) * 1000:.1f} ms  max {max(durations) * 1000:.1f} ms")
+    print(f"{'share':>6}  {'mean ms':>9}  {'p95 ms':>9}  span")
+    for name, values in sorted(per_name.items(), key=lambda item: sum(item[1]), reverse=True):
+        # orders whose path doesn't pass through the span count as 0
+        values = values + [0.0] * (len(reports) - len(values))
+        print(f"{sum(values) / total * 100:5.1f}%  {statistics.mean(values) * 1000:9.1f}  "
+              f"{percentile(values, 0.95) * 1000:9.1f}  {name}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="span files or directories of *.jsonl span files")
+    parser.add_argument("--order", help="show the critical path of this order id")
+    parser.add_argument("--slowest", type=int, default=0, help="show the critical paths of the N slowest orders")
+    parser.add_argument("--json", action="store_true", help="print the per order reports as JSON lines")
+    args = parser.parse_args(argv)
+
+    reports = [report for report in map(analyze, load_spans(args.paths).values()) if report]
+    if args.order:
+        reports = [report for report in reports if report["order_id"] == args.order]
+    if not reports:
+        print("no traces found", file=sys.stderr)
+        return 1
+
+    if args.json:
+        for report in reports:
+            print(json.dumps(report))
+    elif args.order:
+        for report in reports:
+            print_path(report)
+    else:
+        print_summary(reports)
+        for report in sorted(reports, key=lambda report: report["duration"], reverse=True)[:args.slowest]:
+            print()
+            print_path(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())